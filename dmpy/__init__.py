@@ -1,2 +1,36 @@
-from dmpy.dmpy import state, list_files, get_file_content, archive_preview, stream_text_from_archive, upload_data, stream_data_from_archive
-from dmpy.dmpy import get_study_fields, create_new_field, get_data_records, upload_data_in_array, delete_study_field
+import importlib
+
+# the public API is imported on first use, so `import dmpy` (and the command line) does not pay for
+# pandas and the other heavy dependencies of functions that are never called
+_EXPORTS = {
+    'dmpy.dmpy': ['state', 'list_files', 'files_overlapping', 'get_file_content', 'archive_preview',
+                  'stream_text_from_archive', 'upload_data', 'stream_data_from_archive', 'stream_frames_from_archive', 'get_file_catalog',
+                  'iter_files', 'iter_file_content', 'download_file', 'download_files', 'upload_files',
+                  'upload_directory', 'get_study_fields',
+                  'create_new_field', 'create_new_fields', 'get_data_records', 'get_data_records_df',
+                  'iter_data_records', 'get_data_records_batch', 'upload_data_in_array',
+                  'upload_data_in_array_chunked', 'delete_study_field'],
+    'dmpy.connections': ['DMPConnection', 'get_default_connection', 'set_default_connection'],
+    'dmpy.cache': ['FileCache', 'get_default_cache', 'set_default_cache'],
+    'dmpy.catalog': ['FileCatalog'],
+    'dmpy.mirror': ['FileMirror'],
+    'dmpy.fields': ['FieldCache', 'get_default_field_cache', 'set_default_field_cache'],
+    'dmpy.record_cache': ['RecordCache', 'get_default_record_cache', 'set_default_record_cache'],
+    'dmpy.metrics': ['MetricsAggregator'],
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name: str):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module 'dmpy' has no attribute '{name}'")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,5 @@
+import sys
+
+from dmpy.cli import main
+
+sys.exit(main())
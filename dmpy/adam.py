@@ -0,0 +1,250 @@
+"""
+Builders for the ADaM domains returned by fetch_adam_data
+"""
+from dmpy.records import records_to_frame
+from typing import Any, Callable, Dict, List, Optional
+import itertools
+import numpy as np
+import pandas as pd
+import json
+
+ATUP_MAPPING = {
+    "1": "Start of TUP 1",
+    "2": "End of TUP 1",
+    "3": "Start of TUP 2",
+    "4": "End of TUP 2",
+    "5": "Start of TUP 3",
+    "6": "End of TUP 3",
+    "7": "Start of TUP 4",
+    "8": "End of TUP 4",
+}
+ANALYSIS_SETS = {"1": "ISA", "2": "ESA"}
+
+ADDI_COLUMNS = ['USUBJID', 'STUDYID', 'ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'ATM', 'TIMING',
+                'AVAL', 'AVALC', 'PARAM', 'PARAMCD']
+ADDI_STUDY = 'IDEAFAST COS'
+ADPRO_COLUMNS = ['USUBJID', 'STUDYID', 'ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'ADY', 'AVAL',
+                 'AVALC', 'FORMID', 'FORMNAME', 'PARAM', 'PARAMCD']
+ADCL_COLUMNS = ['USUBJID', 'STUDYID', 'ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'AVAL', 'AVALC',
+                'FORMID', 'FORMNAME', 'PARAM', 'PARAMCD']
+ADSL_COLUMNS = ['USUBJID', 'SITE', 'REGION', 'COUNTRY', 'STUDYID', 'COHORT', 'DEMOCOLLDTC', 'ANALYSISSET', 'BMI',
+                'HEIGHT', 'WEIGHT', 'AGE', 'AGEU', 'AGECAT', 'GENDER', 'OCCUPATION', 'EDUCATION', 'ETHNICITY',
+                'TIMESINCEDIAG', 'TUP1DT', 'TUP1TZ', 'TUP2DT', 'TUP2TZ', 'TUP3DT', 'TUP3TZ', 'TUP4DT', 'TUP4TZ']
+ADT_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+TUP_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+TUP_START_FIELDS = ['derived_TUP1_start_date', 'derived_TUP2_start_date', 'derived_TUP3_start_date',
+                    'derived_TUP4_start_date']
+
+DERIVED_FIELDS = ["1144", "1167", "derived_Demographics_Region", "derived_Demographics_Country", "derived_Demographics_Country", "1168", "dataset_id", "derived_Demographics_BMI", "1145", "1151", "derived_Demographics_Age", "derived_Demographics_AgeCat", "1148", "1146", "1141", "1143", "NONE", "derived_FACITF_score", "derived_fVAS_fvas", "derived_mMFS_score", "695", "derived_ESS_score", "derived_sqVAS_sqvas", "derived_MOSSS_SLPD4", "derived_MOSSS_SLPSNR1", "derived_MOSSS_SLPSOB1", "derived_MOSSS_SLPA2", "derived_MOSSS_SLPS3", "derived_MOSSS_SLP6", "derived_MOSSS_SLP9", "derived_MOSSS_SLPQRAW", "derived_MOSSS_SLPOP1", "1241", "1242", "1249", "1250", "1235", "1236", "NONE", "derived_MDSUPDRSII_mdsupdrs2_score", "derived_MDSUPDRSII_disease_severity_cat_id", "derived_MDSUPDRSIII_mdsupdrs3_score", "derived_MDSUPDRSIII_disease_severity_cat_id", "derived_UHDRS_tfc_score", "derived_UHDRS_disease_severity_cat_id", "derived_ESSDAI_ESSDAI_score", "derived_ESSDAI_disease_severity_cat_id", "derived_SLEDAI2K_SLEDAI_score", "derived_SLEDAI2K_disease_severity_cat_id", "derived_DiseaseActivityScore_DAS28_CRP", "derived_DiseaseActivityScore_disease_severity_cat_id", "derived_LabParameters_calprotectin", "derived_LabParameters_disease_severity_cat_id","derived_FACITF_DateofAssessment", "derived_fVAS_DateofAssessment", "derived_mMFS_DateofAssessment", "derived_KSS_DateofAssessment", "derived_ESS_DateofAssessment","derived_sqVAS_DateofAssessment","derived_MOSSS_DateofAssessment","derived_PGIF_DateofAssessment","derived_PGISQ_DateofAssessment","derived_PGIDS_DateofAssessment",
+    "derived_SubjectgroupCharacterisation_timesincediagnosis", "derived_TUP1_start_date", "derived_TUP2_start_date","derived_TUP3_start_date","derived_TUP4_start_date","derived_TUP1_stop_date","derived_TUP2_stop_date","derived_TUP3_stop_date","derived_TUP4_stop_date", "derived_Demographics_DateofAssessment"
+]
+
+ADDI_PARAMS = {
+    'ACTIVI01': "Where were you mainly in the last hour, inside, outside, motorised transport (bus, car, train?)",
+    'ACTIVI02': "Were you mainly doing (employed) work or studies, yes, no.",
+    'ACTIVI03': "Were you mostly on a break during your last hour of (paid) work or studies, yes, no.",
+    'ACTIVI04': "Mark on the line the level of physical activity during this time, 0 = low physical activity (desk work), 100 = High physical activity (physical work)",
+    'ACTIVI05': "What activity have you mainly done in the last hour, Housekeeping/Gardening",
+    'ACTIVI06': "What activity have you mainly done in the last hour, Shopping, Walking, Sports incl. cycling, Gardening, Relaxing, Social interaction/events",
+    'DIARY01': "How fatigued to you feel overall, 0 = Not at all fatigued, 100 = worst possible fatigued",
+    'DIARY02': "How fatigued to you feel physically, 0 = Not at all fatigued physically, 100 = worst possible fatigued physically",
+    'DIARY03': "How fatigued to you feel mentally, 0 = Not at all fatigued mentally, 100 = worst possible fatigued mentally",
+    'DIARY04': "How anxious do you feel, 0 = No at all anxious, 100 = worst possible anxiousness",
+    'DIARY05': "How low is your mood, 0 = My mood is not low at all, 100 = Lowest possible mood",
+    'DIARY06': "How much pain are you having, 0 = No pain at all, 100 = Worst possible pain",
+    'DIARY07': "How was your sleep last night 0 = Best possible sleep, 100 = Worst possible sleep",
+    'DIARY08': "Please choose the response below that best describes your sleep quality last night, 1 = No sleep problems, 2 = Mild sleep problems, 3 = Moderate sleep problems, 4 = Severe sleep problems, 5 = Very severe sleep problems",
+    'DIARY09': "Please choose the response below that best describes the overall change in your sleep quality today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse",
+    'KSS': "How do you feel at the moment, where 1 = extremely alert, 2 = very alert, 3 = alert, 4 = rather alert, 5 = neither alert nor sleepy, 6 = some signs of sleepiness, 7 = sleepy, but no effort to keep awake, 8 = sleepy, but some effort to keep awake,",
+    'MOBILY01': "How do you rate your mobility with regard to stiffness, rigidity and/or slowness that affects your daily life within this last hour, 0 =Normal, -1 = Mild impaired mobility, -2 = Moderately impaired mobility, -3 Severely impaired mobility",
+    'MOBILY02': "How do you rate your mobility with regard to involuntary extra movements that affects your daily life within this last hour, 0 = Normal, 1 = Mild dyskinesia, 2 = Moderate dyskinesia, 3 = Severe dyskinesia",
+    'PGISCE1': "Please choose the response below that best describes the severity of your overall fatigue in the past 24 hours, 1 = No fatigue, 2 ? Mild fatigue, 3 = Moderate fatigue, 4 = Severe fatigue, 5 = Very severe fatigue",
+    'PGISCE2': "Please choose the response below that best described the change in your overall fatigue today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse",
+    'PGISCE3': "Please choose the response below that best describes the severity of your daytime sleepiness in the past 24 hours, 1 = No daytime sleepiness, 2 = Mild daytime sleepiness, 3 = Moderate daytime sleepiness, 4 = Severe daytime sleepiness, 5 = Very severe daytime sleepiness",
+    'PGISCE4': "Please choose the response below that best describes the change in your daytime sleepiness today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse"
+}
+
+
+def parse_addi_clips(values: List[str]) -> List[List[Dict[str, Any]]]:
+    """
+    Decode derived_ADDI values, each a JSON string holding a list of clips written with single
+    quotes. All values are decoded together, with two json.loads calls in total.
+    """
+    texts = json.loads('[' + ','.join(values) + ']')
+    return json.loads('[' + ','.join(text.replace("'", '"') for text in texts) + ']')
+
+
+def _present_keys(rows: List[Dict[str, Any]], columns: List[str]) -> pd.DataFrame:
+    """
+    A boolean frame telling, for each row and column, whether the row has the key at all, so that
+    absent keys can be told apart from keys the server sent as null
+    """
+    keys = pd.Series(rows, dtype=object).map(list).explode()
+    keys = keys[keys.notna()]
+    present = pd.crosstab(keys.index, keys.to_numpy())
+    return present.reindex(index=pd.RangeIndex(len(rows)), columns=columns, fill_value=0).astype(bool)
+
+
+def _visit_columns(visits: pd.DataFrame, dataset_ids: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Derive the per-visit ADDI columns for a frame of subjectId/visitId pairs
+    """
+    dataset = records_to_frame(dataset_ids, layout='wide')
+    if 'dataset_id' not in dataset:
+        dataset['dataset_id'] = None
+    keys = pd.MultiIndex.from_arrays([dataset['subjectId'].astype(object), dataset['visitId'].astype(object)])
+    analysis_set = pd.Series(dataset['dataset_id'].map(ANALYSIS_SETS).to_numpy(), index=keys)
+    subjects = visits['subjectId'].astype(object).to_numpy()
+    visit_ids = visits['visitId'].astype(object).to_numpy()
+    visit_numbers = pd.Series(visit_ids).astype(int)
+    return pd.DataFrame({
+        'USUBJID': subjects,
+        'STUDYID': ADDI_STUDY,
+        'ANALYSISSET': analysis_set.reindex(pd.MultiIndex.from_arrays([subjects, visit_ids])).fillna('').to_numpy(),
+        'VISITNUM': visit_numbers.to_numpy(),
+        'AVISIT': 'Visit ' + pd.Series(visit_ids, dtype=object),
+        'TUPNUM': 'TUP ' + ((visit_numbers + 1) // 2).astype(str),
+        'ATUP': pd.Series(visit_ids).map(ATUP_MAPPING).to_numpy(),
+    })
+
+
+def build_addi(addi_data: Dict[str, Dict[str, Dict[str, Any]]],
+               dataset_ids: Dict[str, Dict[str, Dict[str, Any]]]) -> pd.DataFrame:
+    """
+    Build the ADDI domain from the derived_ADDI and dataset_id data records: one row per clip and
+    answered parameter, ordered by subject, visit, clip and then parameter as listed in ADDI_PARAMS
+    """
+    visits = records_to_frame(addi_data, layout='wide')
+    if 'derived_ADDI' not in visits:
+        visits['derived_ADDI'] = None
+    visits = visits[(visits['visitId'].astype(object) != '0') & visits['derived_ADDI'].notna()]
+    clips = parse_addi_clips(visits['derived_ADDI'].tolist())
+    flat = list(itertools.chain.from_iterable(clips))
+    # object columns keep the nulls the clips hold, which are answers too
+    items = pd.DataFrame(flat, index=pd.RangeIndex(len(flat)), dtype=object)
+    items = items.reindex(columns=items.columns.union(['ADT', 'ATM', 'TIMING'], sort=False))
+    items['visit'] = np.repeat(np.arange(len(visits)), [len(clip) for clip in clips])
+    answered = [param for param in ADDI_PARAMS if param in items.columns]
+
+    rows = items.melt(id_vars=['visit', 'ADT', 'ATM', 'TIMING'], value_vars=answered, var_name='PARAMCD',
+                      value_name='AVALC', ignore_index=False)
+    # melt stacks the parameters one after the other, as a column-major ravel does; the answers are
+    # taken from the object columns since melt infers a string dtype that turns nulls into NaN
+    rows['AVALC'] = pd.Series(items[answered].to_numpy(dtype=object).ravel(order='F'), index=rows.index, dtype=object)
+    rows = rows[_present_keys(flat, answered).to_numpy().ravel(order='F')]
+    rows['PARAMCD'] = pd.Categorical(rows['PARAMCD'], categories=list(ADDI_PARAMS))
+    rows = rows.rename_axis('clip').sort_values(['clip', 'PARAMCD'], kind='stable').reset_index(drop=True)
+
+    frame = _visit_columns(visits, dataset_ids).iloc[rows['visit'].to_numpy()].reset_index(drop=True)
+    frame['ADT'] = rows['ADT'].astype(object)
+    frame['ATM'] = rows['ATM'].astype(object)
+    frame['TIMING'] = rows['TIMING']
+    frame['AVAL'] = pd.to_numeric(rows['AVALC'], errors='coerce')
+    frame['AVALC'] = rows['AVALC'].astype(object)
+    frame['PARAM'] = rows['PARAMCD'].map(ADDI_PARAMS)
+    frame['PARAMCD'] = rows['PARAMCD']
+    frame = frame[ADDI_COLUMNS]
+    frame['VISITNUM'] = frame['VISITNUM'].astype('Int64')
+    for column in ['USUBJID', 'STUDYID', 'ANALYSISSET', 'AVISIT', 'TUPNUM', 'ATUP', 'TIMING', 'PARAM', 'PARAMCD']:
+        frame[column] = frame[column].astype('category')
+    return frame
+
+
+def format_timedelta(deltas: pd.Series) -> pd.Series:
+    """
+    Format non-negative timedeltas as str(datetime.timedelta) does, e.g. '4 days, 2:11:12' or
+    '1 day, 0:00:00.500000'
+    """
+    if deltas.empty:
+        return pd.Series([], index=deltas.index, dtype=object)
+    micros = deltas.to_numpy(dtype='timedelta64[us]').astype(np.int64)
+    days, micros = np.divmod(micros, 86400 * 10 ** 6)
+    seconds, micros = np.divmod(micros, 10 ** 6)
+    hours, seconds = np.divmod(seconds, 3600)
+    minutes, seconds = np.divmod(seconds, 60)
+    text = np.char.add(np.char.add(np.char.add(hours.astype(str), ':'), np.char.zfill(minutes.astype(str), 2)),
+                       np.char.add(':', np.char.zfill(seconds.astype(str), 2)))
+    text = np.where(micros == 0, text, np.char.add(text, np.char.add('.', np.char.zfill(micros.astype(str), 6))))
+    prefix = np.char.add(days.astype(str), np.where(days == 1, ' day, ', ' days, '))
+    text = np.where(days == 0, text, np.char.add(prefix, text))
+    return pd.Series(text.astype(object), index=deltas.index)
+
+
+def study_day(frame: pd.DataFrame, records: Dict[str, Any]) -> pd.Series:
+    """
+    ADY: the time from the start of the row's TUP (visits 2n-1 and 2n belong to TUP n) to ADT, as
+    str(timedelta), 'Invalid' when ADT is before the TUP start, or 'NA' when either date is unknown
+    """
+    tup = records_to_frame(records['tup_start'], layout='long')
+    tup = tup[tup['visitId'].astype(object) == '0']
+    starts = pd.Series(tup['value'].to_numpy(),
+                       index=pd.MultiIndex.from_arrays([tup['subjectId'].astype(object),
+                                                        tup['fieldId'].astype(object)]))
+    tup_number = np.ceil(pd.to_numeric(frame['VISITNUM'], errors='coerce') / 2)
+    tup_keys = 'derived_TUP' + tup_number.astype('Int64').astype(str) + '_start_date'
+    start = starts.reindex(pd.MultiIndex.from_arrays([frame['USUBJID'].astype(object), tup_keys])).to_numpy()
+    start = pd.to_datetime(pd.Series(start, index=frame.index), format=TUP_DATE_FORMAT, errors='coerce')
+    adt = pd.to_datetime(frame['ADT'].where(frame['ADT'] != ''), format=ADT_FORMAT, errors='coerce')
+    known = start.notna() & adt.notna()
+    result = pd.Series('NA', index=frame.index, dtype=object)
+    invalid = known & (adt < start)
+    result[invalid] = 'Invalid'
+    valid = known & ~invalid
+    result[valid] = format_timedelta(adt[valid] - start[valid]).to_numpy()
+    return result
+
+
+class AdamDomain:
+    def __init__(self,
+                 name: str,
+                 columns: List[str],
+                 data_format: str,
+                 derivations: Optional[Dict[str, Callable[[pd.DataFrame, Dict[str, Any]], pd.Series]]] = None,
+                 requires: Optional[Dict[str, Dict[str, Any]]] = None,
+                 field_ids: Optional[List[str]] = None,
+                 version_id: str = '-1'):
+        """
+        An ADaM domain read from one of the server's standardized tables (data_format), described
+        declaratively: its output columns, '' where a row has no value, and the derivations that
+        compute columns from the table and from extra data records. requires names the extra
+        get_data_records queries (their arguments without study_id) the derivations read, and each
+        derivation is called as derive(frame, records) with the named results.
+        """
+        self.name = name
+        self.columns = columns
+        self.data_format = data_format
+        self.derivations = derivations or {}
+        self.requires = requires or {}
+        self.field_ids = field_ids or DERIVED_FIELDS
+        self.version_id = version_id
+
+    def queries(self, study_id: str) -> List[Dict[str, Any]]:
+        """
+        Return the get_data_records queries for this domain, the table first and then the required records
+        """
+        table = dict(study_id=study_id, field_ids=self.field_ids, data_format=self.data_format,
+                     version_id=self.version_id)
+        return [table] + [dict(query, study_id=study_id) for query in self.requires.values()]
+
+    def build(self, results: List[Any]) -> pd.DataFrame:
+        """
+        Build the domain frame from the results of queries(), in the same order
+        """
+        table, extra = results[0], results[1:]
+        rows = (table or {}).get(self.name) or []
+        # only absent keys become '', values the server sent as null are kept
+        frame = pd.DataFrame(rows, index=pd.RangeIndex(len(rows)), dtype=object).reindex(columns=self.columns)
+        frame = frame.mask(~_present_keys(rows, self.columns), '')
+        records = dict(zip(self.requires, extra))
+        for column, derive in self.derivations.items():
+            frame[column] = derive(frame, records)
+        return frame[self.columns]
+
+
+ADAM_DOMAINS = {
+    'ADPRO': AdamDomain('ADPRO', ADPRO_COLUMNS, 'standardized-cdisc:adam:adpro',
+                        derivations={'ADY': study_day},
+                        requires={'tup_start': dict(field_ids=TUP_START_FIELDS, version_id='-1')}),
+    'ADCL': AdamDomain('ADCL', ADCL_COLUMNS, 'standardized-cdisc:adam:adcl'),
+    'ADSL': AdamDomain('ADSL', ADSL_COLUMNS, 'standardized-cdisc:adam:adsl'),
+}
@@ -0,0 +1,252 @@
+"""
+asyncio versions of the DMP connection and of the main dmpy functions, built on aiohttp:
+
+    async with AsyncDMPConnection(limit_per_host=32) as conn:
+        files = await list_files(study_id, conn=conn)
+        await asyncio.gather(*(conn.download_file(f['fileId'], f['fileName'], f['fileHash']) for f in files))
+"""
+from dmpy.catalog import FileCatalog
+from dmpy.connections import DOWNLOAD_CHUNK_SIZE, hash_file, persisted_query_error, resolve_host_and_cookie
+from dmpy.utils import data_records_variables, file_description, load_query, query_hash
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+import aiohttp
+import asyncio
+import hashlib
+import json
+import io
+import os
+
+
+class AsyncDMPConnection:
+    def __init__(self,
+                 host: Optional[str] = None,
+                 cookie: Optional[str] = None,
+                 limit: int = 100,
+                 limit_per_host: int = 10,
+                 max_concurrency: Optional[int] = None,
+                 timeout: Optional[aiohttp.ClientTimeout] = None,
+                 persisted_queries: bool = False):
+        """
+        An asyncio connection to the DMP. At most limit connections are opened, and at most
+        limit_per_host to the portal; max_concurrency additionally caps the number of operations in
+        flight. Cancelling a task releases its connection, and a cancelled download_file can be resumed.
+        """
+        self._host, cookie = resolve_host_and_cookie(host, cookie)
+        self._host_graphql = f'{self._host}/graphql'
+        self._cookies = {"connect.sid": cookie} if cookie else {}
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = timeout or aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
+        self._persisted_queries = persisted_queries
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # the session belongs to the running event loop, so it is created on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, cookies=self._cookies, timeout=self._timeout)
+        return self._session
+
+    async def _slot(self):
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+
+    def _release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self) -> 'AsyncDMPConnection':
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _post(self, payload: Dict):
+        async with self._get_session().post(self._host_graphql, json=payload) as response:
+            text = await response.text()
+            try:
+                return response.status, json.loads(text), text
+            except ValueError:
+                return response.status, None, text
+
+    async def graphql_request(self, name: str, variables: Any) -> Dict:
+        query = load_query(name)
+        payload = {'query': query, 'variables': variables}
+        await self._slot()
+        try:
+            if self._persisted_queries:
+                extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash(name)}}
+                status, body, text = await self._post({'variables': variables, 'extensions': extensions})
+                error = persisted_query_error(body)
+                if error is None:
+                    if status != 200 or body is None:
+                        raise Exception(f'Failed to query {name}: {text}')
+                    return body
+                if error == 'PERSISTED_QUERY_NOT_SUPPORTED':
+                    self._persisted_queries = False
+                else:
+                    payload['extensions'] = extensions
+            status, body, text = await self._post(payload)
+            if status != 200 or body is None:
+                raise Exception(f'Failed to query {name}: {text}')
+            return body
+        finally:
+            self._release()
+
+    async def iter_file(self, file_id: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE, offset: int = 0):
+        """
+        Yield the content of a file in chunks, starting at offset (HTTP Range)
+        """
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        await self._slot()
+        try:
+            async with self._get_session().get(f'{self._host}/file/{file_id}', headers=headers) as response:
+                if response.status not in (200, 206):
+                    raise Exception(f'Failed to download file {file_id}: {await response.text()}')
+                # the server ignored the range request, drop the bytes we already have
+                skip = offset if response.status == 200 else 0
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    yield chunk
+        finally:
+            self._release()
+
+    async def download_file(self, file_id: str, path: str, file_hash: Optional[str] = None, resume: bool = True,
+                            chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_attempts: int = 5) -> str:
+        """
+        Stream a file to path through path + '.part', resuming a previous or interrupted download
+        and checking the content against file_hash, as DMPConnection.download_file does
+        """
+        part_path = f'{path}.part'
+        hasher = hashlib.sha256()
+        offset = 0
+        if resume and os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            attempt = 1
+            while True:
+                try:
+                    async for chunk in self.iter_file(file_id, chunk_size=chunk_size, offset=offset):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        offset += len(chunk)
+                    break
+                except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt >= max_attempts:
+                        raise
+                    attempt += 1
+        if file_hash and hasher.hexdigest() != file_hash:
+            os.remove(part_path)
+            raise Exception(f'Hash mismatch for file {file_id}: expected {file_hash}, got {hasher.hexdigest()}')
+        os.replace(part_path, path)
+        return path
+
+    async def upload_file(self, file_name: str, file_content: Union[bytes, str, BinaryIO], variables: Any) -> Dict:
+        """
+        Upload a file from bytes, a path or a seekable binary file object, streaming it from disk and
+        filling in the 'fileLength' and 'hash' variables unless already set
+        """
+        variables = dict(variables)
+        if isinstance(file_content, (bytes, bytearray, memoryview)):
+            file = io.BytesIO(file_content)
+        elif isinstance(file_content, (str, os.PathLike)):
+            file = open(file_content, 'rb')
+        else:
+            file = file_content
+        try:
+            start = file.tell()
+            if variables.get('hash') is None or variables.get('fileLength') is None:
+                # hashing is blocking file I/O, keep it off the event loop
+                variables['hash'], variables['fileLength'] = await asyncio.to_thread(hash_file, file)
+                file.seek(start)
+            form = aiohttp.FormData()
+            form.add_field('operations', json.dumps({'query': load_query('upload'), 'variables': variables}))
+            form.add_field('map', json.dumps({'x': ['variables.file']}))
+            form.add_field('x', file, filename=file_name, content_type='application/octet-stream')
+            await self._slot()
+            try:
+                async with self._get_session().post(self._host_graphql, data=form) as response:
+                    response.raise_for_status()
+                    text = await response.text()
+                    try:
+                        return json.loads(text)
+                    except ValueError:
+                        raise Exception(f'Failed to upload {file_name}: {text}')
+            finally:
+                self._release()
+        finally:
+            if file is not file_content:
+                file.close()
+
+
+async def _with_connection(conn: Optional[AsyncDMPConnection], call):
+    if conn is not None:
+        return await call(conn)
+    async with AsyncDMPConnection() as conn:
+        return await call(conn)
+
+
+async def list_files(
+        study_id: str,
+        participants: Optional[List[str]] = None,
+        kinds: Optional[List[str]] = None,
+        devices: Optional[List[str]] = None,
+        file_ids: Optional[List[str]] = None,
+        conn: Optional[AsyncDMPConnection] = None,
+):
+    """
+    List files in a study
+    """
+    all_files = await _with_connection(conn, lambda c: c.graphql_request("files", {"studyId": study_id}))
+    if 'data' not in all_files:
+        raise Exception(f'Failed to list files in study {study_id}: {all_files.get("errors")}')
+    catalog = FileCatalog.from_files(all_files['data']['getStudy']['files'])
+    return catalog.filter(participants=participants, kinds=kinds, devices=devices, file_ids=file_ids).to_records()
+
+
+async def get_data_records(study_id: str,
+                           field_ids: List[str] = None,
+                           data_format: str = None,
+                           version_id: str = '0',
+                           table_requested: str = None,
+                           conn: Optional[AsyncDMPConnection] = None):
+    variables = data_records_variables(study_id, field_ids, data_format, version_id, table_requested)
+    data_records = await _with_connection(conn, lambda c: c.graphql_request('data_records', variables))
+    return data_records['data']['getDataRecords']["data"]
+
+
+async def upload_data(study_id: str, file_name: str, file_content: Union[bytes, str, BinaryIO], participant_id: str,
+                      device_id: str, start_date: int, end_date: int, conn: Optional[AsyncDMPConnection] = None):
+    """
+    Upload a file to a study and return its id
+    """
+    variables = {
+        'studyId': study_id,
+        'file': None,
+        'description': file_description(participant_id, device_id, start_date, end_date)
+    }
+    response = await _with_connection(conn, lambda c: c.upload_file(file_name, file_content, variables))
+    if response.get('errors'):
+        raise Exception(f'Error uploading file {file_name}: {response["errors"]}')
+    return response['data']['uploadFile']['id']
+
+
+async def upload_data_in_array(study_id: str, data: List[dict], conn: Optional[AsyncDMPConnection] = None):
+    variables = {
+        'studyId': study_id,
+        'data': data
+    }
+    return await _with_connection(conn, lambda c: c.graphql_request('upload_data_in_array', variables))
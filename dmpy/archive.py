@@ -0,0 +1,510 @@
+from contextlib import contextmanager
+from dmpy.cache import get_default_cache
+from dmpy.utils import get_file_type
+from collections import OrderedDict, deque
+from typing import Iterator, Optional
+import itertools
+import tempfile
+import struct
+import tarfile
+import codecs
+import zipfile
+import mmap
+import os
+import io
+
+ARCHIVE_TYPES = ["zip", "tar.gz", "rar", "7z"]
+# the end of central directory record plus the largest possible zip comment
+ZIP_TAIL_SIZE = 22 + 65535
+RANGE_BLOCK_SIZE = 64 * 1024
+ZIP_INDEX_MEMORY_ENTRIES = 64
+TEXT_CHUNK_SIZE = 1024 * 1024
+
+_zip_indexes: OrderedDict = OrderedDict()
+
+
+class RangeRequestsNotSupported(Exception):
+    pass
+
+
+class MappedFile(io.RawIOBase):
+    """
+    Read-only seekable file object over a memory-mapped file, so archive members are read
+    straight from the page cache instead of from a copy of the archive in memory
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        # mmap cannot map an empty file
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._size else b''
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        end = self._size if size is None or size < 0 else min(self._size, self._pos + size)
+        data = self._map[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._size:
+                self._map.close()
+            self._file.close()
+        super().close()
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only seekable file object over a remote study file that fetches byte ranges on demand.
+
+    The end of the file (where zip archives keep their central directory) is held in one tail
+    buffer, which grows downwards when a read touches it, so it can be saved and reused as an index.
+    Other reads fetch at least RANGE_BLOCK_SIZE bytes.
+    """
+
+    def __init__(self, conn, file_id: str, tail: Optional[tuple] = None):
+        self._conn = conn
+        self._file_id = file_id
+        if tail is None:
+            fetched = conn.get_range(file_id, None, ZIP_TAIL_SIZE)
+            if fetched is None:
+                raise RangeRequestsNotSupported(f'The server does not support range requests for {file_id}')
+            data, size = fetched
+            tail = (size, size - len(data), data)
+        self._size, self._tail_offset, self._tail = tail
+        self._block_offset, self._block = 0, b''
+        self._pos = 0
+
+    @property
+    def tail(self) -> tuple:
+        return self._size, self._tail_offset, self._tail
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        fetched = self._conn.get_range(self._file_id, start, end - 1)
+        if fetched is None:
+            raise RangeRequestsNotSupported(f'The server does not support range requests for {self._file_id}')
+        return fetched[0]
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._pos
+        end = self._size if size is None or size < 0 else min(self._size, start + size)
+        if start >= end:
+            return b''
+        if end > self._tail_offset:
+            if start < self._tail_offset:
+                self._tail = self._fetch(start, self._tail_offset) + self._tail
+                self._tail_offset = start
+            data = self._tail[start - self._tail_offset:end - self._tail_offset]
+        else:
+            block_end = self._block_offset + len(self._block)
+            if not (self._block_offset <= start and end <= block_end):
+                fetch_end = min(self._tail_offset, max(end, start + RANGE_BLOCK_SIZE))
+                self._block_offset, self._block = start, self._fetch(start, fetch_end)
+            data = self._block[start - self._block_offset:end - self._block_offset]
+        self._pos = end
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _load_zip_index(file_hash: Optional[str]) -> Optional[tuple]:
+    if not file_hash:
+        return None
+    if file_hash in _zip_indexes:
+        _zip_indexes.move_to_end(file_hash)
+        return _zip_indexes[file_hash]
+    cache = get_default_cache()
+    path = cache.get(f'zipindex.{file_hash}') if cache is not None else None
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            size, tail_offset = struct.unpack('<QQ', f.read(16))
+            return size, tail_offset, f.read()
+    except FileNotFoundError:
+        # evicted by another process since the lookup
+        return None
+
+
+def _save_zip_index(file_hash: Optional[str], tail: tuple):
+    if not file_hash:
+        return
+    _zip_indexes[file_hash] = tail
+    if len(_zip_indexes) > ZIP_INDEX_MEMORY_ENTRIES:
+        _zip_indexes.popitem(last=False)
+    cache = get_default_cache()
+    if cache is not None and cache.get(f'zipindex.{file_hash}') is None:
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack('<QQ', tail[0], tail[1]))
+                f.write(tail[2])
+        cache.put(f'zipindex.{file_hash}', write)
+
+
+@contextmanager
+def open_remote_zip(conn, file_id: str, file_hash: Optional[str] = None):
+    """
+    Open a zip archive on the server without downloading it. Only the central directory is read
+    (and cached per file hash); members are fetched with range requests when opened.
+    Raises RangeRequestsNotSupported when the server ignores range requests.
+    """
+    remote = RangeFile(conn, file_id, tail=_load_zip_index(file_hash))
+    with zipfile.ZipFile(remote) as zf:
+        _save_zip_index(file_hash, remote.tail)
+        yield zf
+
+
+def _use_range_requests(file_id: str, file_hash: Optional[str], use_cache: bool) -> bool:
+    # a local copy is cheaper than any number of range requests
+    cache = get_default_cache() if use_cache else None
+    return cache is None or cache.lookup_file(file_id, file_hash) is None
+
+
+@contextmanager
+def local_copy(conn, file_id: str, file_hash: Optional[str] = None, use_cache: bool = True):
+    """
+    Yield the path of a local copy of a study file, from the file cache or spooled to a temporary file
+    """
+    cache = get_default_cache() if use_cache else None
+    if cache is not None:
+        with cache.pinned_file(conn, file_id, file_hash) as path:
+            yield path
+        return
+    with tempfile.TemporaryDirectory(prefix='dmpy-') as tmp_dir:
+        yield conn.download_file(file_id, os.path.join(tmp_dir, file_id), file_hash=file_hash, resume=False)
+
+
+@contextmanager
+def open_sequential(conn, file_id: str, file_hash: Optional[str] = None, use_cache: bool = True):
+    """
+    Yield a sequential reader over a study file. With the file cache it is read from the cache,
+    downloading it there first, so the next read does not download it again; without it the file
+    is read straight off the HTTP response
+    """
+    cache = get_default_cache() if use_cache else None
+    if cache is not None:
+        with cache.open_file(conn, file_id, file_hash) as f:
+            yield f
+    else:
+        with conn.open_file(file_id, file_hash=file_hash) as f:
+            yield f
+
+
+def iter_archive_members(conn, file_id: str, file_name: str, file_hash: Optional[str] = None,
+                         use_cache: bool = True):
+    """
+    Yield (member name, file object) for each regular file in an archive. Members are decompressed
+    lazily while being read, and each file object is only valid until the next member is requested.
+
+    tar.gz archives are read sequentially, from the file cache or, with the cache disabled, straight
+    off the download; zip, 7z and rar archives need random access and are read from a local
+    (memory-mapped) copy.
+    """
+    file_type = get_file_type(file_name)
+    if file_type == 'tar.gz':
+        with open_sequential(conn, file_id, file_hash, use_cache) as stream:
+            with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+                for tar_info in tar:
+                    if tar_info.isfile():
+                        yield tar_info.name, tar.extractfile(tar_info)
+        return
+    if file_type not in ARCHIVE_TYPES:
+        raise Exception(f'{file_name} is not an archive')
+    with local_copy(conn, file_id, file_hash, use_cache) as path:
+        if file_type == 'zip':
+            with MappedFile(path) as mapped, zipfile.ZipFile(mapped) as zf:
+                for file_info in zf.infolist():
+                    if file_info.is_dir():
+                        continue
+                    with zf.open(file_info, 'r') as file:
+                        yield file_info.filename, file
+        elif file_type == '7z':
+            import py7zr
+            # 7z blocks are usually solid, so members are spilled to disk in one decompression pass
+            with tempfile.TemporaryDirectory(prefix='dmpy-') as tmp_dir:
+                with MappedFile(path) as mapped, py7zr.SevenZipFile(mapped, mode='r') as z:
+                    names = [info.filename for info in z.list() if not info.is_directory]
+                    z.extractall(path=tmp_dir)
+                for name in names:
+                    with open(os.path.join(tmp_dir, name), 'rb') as file:
+                        yield name, file
+        elif file_type == 'rar':
+            import rarfile
+            with rarfile.RarFile(path) as rf:
+                for file_info in rf.infolist():
+                    if file_info.is_dir():
+                        continue
+                    with rf.open(file_info, 'r') as file:
+                        yield file_info.filename, file
+
+
+def list_archive_members(conn, file_id: str, file_name: str, file_hash: Optional[str] = None,
+                         use_cache: bool = True, range_requests: bool = True):
+    file_type = get_file_type(file_name)
+    if file_type == 'tar.gz':
+        with open_sequential(conn, file_id, file_hash, use_cache) as stream:
+            with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+                return [tar_info.name for tar_info in tar]
+    if file_type not in ARCHIVE_TYPES:
+        raise Exception(f'{file_name} is not an archive')
+    if file_type == 'zip' and range_requests and _use_range_requests(file_id, file_hash, use_cache):
+        try:
+            with open_remote_zip(conn, file_id, file_hash) as zf:
+                return zf.namelist()
+        except RangeRequestsNotSupported:
+            pass
+    with local_copy(conn, file_id, file_hash, use_cache) as path:
+        if file_type == 'zip':
+            with MappedFile(path) as mapped, zipfile.ZipFile(mapped) as zf:
+                return zf.namelist()
+        elif file_type == '7z':
+            import py7zr
+            with MappedFile(path) as mapped, py7zr.SevenZipFile(mapped, mode='r') as z:
+                return z.getnames()
+        elif file_type == 'rar':
+            import rarfile
+            with rarfile.RarFile(path) as rf:
+                return rf.namelist()
+
+
+def read_archive_member(conn, file_id: str, file_name: str, member: str, file_hash: Optional[str] = None,
+                        use_cache: bool = True, range_requests: bool = True) -> Optional[bytes]:
+    """
+    Return the content of one archive member, or None if there is no such member. Zip members are
+    range-read from the server unless the archive is already cached locally
+    """
+    if get_file_type(file_name) == 'zip' and range_requests and _use_range_requests(file_id, file_hash, use_cache):
+        try:
+            with open_remote_zip(conn, file_id, file_hash) as zf:
+                try:
+                    file_info = zf.getinfo(member)
+                except KeyError:
+                    return None
+                return None if file_info.is_dir() else zf.read(file_info)
+        except RangeRequestsNotSupported:
+            pass
+    for name, file in iter_archive_members(conn, file_id, file_name, file_hash, use_cache):
+        if name == member:
+            return file.read()
+    return None
+
+
+def decode_text(data: bytes) -> str:
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('ISO-8859-1')
+
+
+def detect_encoding(sample: bytes, final: bool = False) -> str:
+    """
+    Pick the encoding of a text member from its first chunk: utf-8-sig with a byte order mark,
+    utf-8 when the chunk decodes as such (a character cut off at the end of the chunk is allowed
+    unless final), and ISO-8859-1 otherwise
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=final)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'ISO-8859-1'
+
+
+def iter_text(file, chunk_size: int = TEXT_CHUNK_SIZE, encoding: Optional[str] = None) -> Iterator[str]:
+    """
+    Decode a binary file object chunk by chunk, so the raw bytes and the text of a member are never
+    held in full. Without an encoding it is detected from the first chunk (see detect_encoding);
+    if a detected UTF-8 member later turns out not to be UTF-8, the rest is decoded as ISO-8859-1.
+    """
+    chunk = file.read(chunk_size)
+    detected = encoding is None
+    if detected:
+        encoding = detect_encoding(chunk, final=len(chunk) < chunk_size)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while chunk:
+        pending = decoder.getstate()[0]
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError:
+            if not detected:
+                raise
+            decoder = codecs.getincrementaldecoder('ISO-8859-1')()
+            text = decoder.decode(pending + chunk)
+        if text:
+            yield text
+        chunk = file.read(chunk_size)
+    try:
+        text = decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        if not detected:
+            raise
+        text = decoder.getstate()[0].decode('ISO-8859-1')
+    if text:
+        yield text
+
+
+def iter_lines(file, chunk_size: int = TEXT_CHUNK_SIZE, encoding: Optional[str] = None) -> Iterator[str]:
+    """
+    Yield the lines of a binary file object, decoded incrementally as by iter_text, with their line
+    endings as file iteration keeps them
+    """
+    pending = ''
+    for text in iter_text(file, chunk_size, encoding):
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+class DecodedReader(io.TextIOBase):
+    """
+    Read-only text file object over a binary one, decoded incrementally as by iter_text
+    """
+    def __init__(self, file, chunk_size: int = TEXT_CHUNK_SIZE, encoding: Optional[str] = None):
+        self._chunks = iter_text(file, chunk_size, encoding)
+        self._buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        if size is None or size < 0:
+            text = self._buffer + ''.join(self._chunks)
+            self._buffer = ''
+            return text
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        text, self._buffer = self._buffer[:size], self._buffer[size:]
+        return text
+
+    def readline(self, size: Optional[int] = -1) -> str:
+        while '\n' not in self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+
+def member_separator(name: str) -> str:
+    return '\t' if name.lower().endswith(('.tsv', '.tab')) else ','
+
+
+def read_member_frames(file, name: str, chunk_rows: int = 100000, encoding: Optional[str] = None,
+                       **read_csv_kwargs):
+    """
+    Yield a CSV or TSV member (tab-separated when named .tsv or .tab) as DataFrames of up to
+    chunk_rows rows, decoded incrementally as by iter_text; read_csv_kwargs go to pandas.read_csv
+    """
+    import pandas as pd
+    read_csv_kwargs.setdefault('sep', member_separator(name))
+    try:
+        reader = pd.read_csv(DecodedReader(file, encoding=encoding), chunksize=chunk_rows, **read_csv_kwargs)
+    except pd.errors.EmptyDataError:
+        return
+    with reader:
+        yield from reader
+
+
+def _read_member_frames_at(path: str, file_type: str, name: str, chunk_rows: int, encoding: Optional[str],
+                           read_csv_kwargs: dict) -> list:
+    # runs in a worker process, which opens its own handle on the local copy of the archive
+    if file_type == 'zip':
+        with MappedFile(path) as mapped, zipfile.ZipFile(mapped) as zf, zf.open(name) as file:
+            return list(read_member_frames(file, name, chunk_rows, encoding, **read_csv_kwargs))
+    import rarfile
+    with rarfile.RarFile(path) as rf, rf.open(name) as file:
+        return list(read_member_frames(file, name, chunk_rows, encoding, **read_csv_kwargs))
+
+
+def iter_member_frames_parallel(conn, file_id: str, file_name: str, file_hash: Optional[str] = None,
+                                chunk_rows: int = 100000, encoding: Optional[str] = None, processes: int = 2,
+                                use_cache: bool = True, **read_csv_kwargs):
+    """
+    Yield (member name, DataFrame) chunks of a zip or rar archive in member order, with up to
+    processes members parsed at the same time in a process pool. Each member's frames are sent
+    back whole, so memory grows with the size of the members in flight.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    file_type = get_file_type(file_name)
+    if file_type not in ('zip', 'rar'):
+        raise Exception(f'Members of {file_name} cannot be read in parallel, only zip and rar archives can')
+    with local_copy(conn, file_id, file_hash, use_cache) as path:
+        if file_type == 'zip':
+            with MappedFile(path) as mapped, zipfile.ZipFile(mapped) as zf:
+                names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        else:
+            import rarfile
+            with rarfile.RarFile(path) as rf:
+                names = [info.filename for info in rf.infolist() if not info.is_dir()]
+        executor = ProcessPoolExecutor(max_workers=processes)
+        try:
+            pending = deque()
+            for name in itertools.chain(names, [None]):
+                if name is not None:
+                    pending.append((name, executor.submit(_read_member_frames_at, path, file_type, name,
+                                                          chunk_rows, encoding, read_csv_kwargs)))
+                # keep every worker busy while the oldest member is handed out
+                while pending and (len(pending) > processes or name is None):
+                    done_name, future = pending.popleft()
+                    for frame in future.result():
+                        yield done_name, frame
+        finally:
+            executor.shutdown(cancel_futures=True)
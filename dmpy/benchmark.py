@@ -0,0 +1,293 @@
+"""
+Benchmarks of the dmpy client against a local MockDMPServer filled with a synthetic study:
+
+    python -m dmpy.benchmark --files-per-device 10 --file-size 4000000 --repeat 5 --output bench.json
+    python -m dmpy.benchmark --baseline bench.json
+
+Each benchmark runs in its own process, so its peak RSS is measured without the server or the
+other benchmarks. Results are written as JSON; with --baseline the median latencies are compared
+with an earlier run.
+"""
+from typing import Any, Callable, Dict, List, Optional
+import multiprocessing
+import contextlib
+import argparse
+import platform
+import queue
+import tempfile
+import json
+import time
+import sys
+import os
+
+STUDY_ID = 'benchmark'
+BENCHMARKS = ['list_files', 'get_file_content', 'archive_preview', 'stream_text_from_archive',
+              'stream_data_from_archive', 'upload_data', 'get_data_records', 'fetch_adam_data:ADDI',
+              'fetch_adam_data:ADPRO', 'fetch_adam_data:ADCL', 'fetch_adam_data:ADSL']
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None where it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _operation(name: str, conn, files: List[Dict[str, Any]], upload: bytes) -> Callable[[int], int]:
+    """
+    Return a callable running one iteration of a benchmark and returning how much it processed:
+    bytes for file transfers, and files, subjects or rows for listings and records
+    """
+    import dmpy
+    if name == 'list_files':
+        return lambda i: len(dmpy.list_files(STUDY_ID, conn=conn))
+    if name == 'get_file_content':
+        return lambda i: len(dmpy.get_file_content(files[i % len(files)]['fileId'], conn=conn))
+    if name == 'archive_preview':
+        def preview(i):
+            record = files[i % len(files)]
+            return len(dmpy.archive_preview(record['fileId'], record['fileName'], record['fileHash'], conn=conn))
+        return preview
+    if name in ('stream_text_from_archive', 'stream_data_from_archive'):
+        def stream(i):
+            record = files[i % len(files)]
+            if name == 'stream_text_from_archive':
+                members = dmpy.stream_text_from_archive(record['fileId'], record['fileName'], record['fileHash'],
+                                                        conn=conn)
+                return sum(len(text.getvalue()) for _, text in members)
+            members = dmpy.stream_data_from_archive(record['fileId'], record['fileName'], 'binary',
+                                                    record['fileHash'], conn=conn)
+            return sum(len(data) for _, data in members)
+        return stream
+    if name == 'upload_data':
+        def upload_one(i):
+            dmpy.upload_data(STUDY_ID, f'U{i:05d}-AX600000-20230101-20230102.txt', upload, f'U{i:05d}',
+                             'AX600000', 1672531200, 1672703999, conn=conn)
+            return len(upload)
+        return upload_one
+    if name == 'get_data_records':
+        return lambda i: len(dmpy.get_data_records(STUDY_ID, use_cache=False, conn=conn))
+    if name.startswith('fetch_adam_data:'):
+        from dmpy.dmpy import fetch_adam_data
+        return lambda i: len(fetch_adam_data(STUDY_ID, name.split(':', 1)[1], conn=conn))
+    raise Exception(f"Unknown benchmark {name}, expected one of {', '.join(BENCHMARKS)}")
+
+
+def run_benchmark(name: str, url: str, repeat: int = 5, warmup: int = 1, upload_size: int = 1024 * 1024,
+                  file_format: str = 'zip') -> Dict[str, Any]:
+    """
+    Run one benchmark against the server at url and return its latencies, throughput and peak RSS
+    """
+    import dmpy
+    from dmpy.connections import DMPConnection
+    from dmpy.mock_server import synthetic_text
+    import random
+    conn = DMPConnection(host=url, cookie='mock')
+    metrics = dmpy.MetricsAggregator()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        files = [f for f in dmpy.list_files(STUDY_ID, conn=conn) if f['fileName'].endswith(file_format)]
+        upload = synthetic_text(random.Random(0), upload_size)
+        operation = _operation(name, conn, files, upload)
+        for i in range(warmup):
+            operation(i)
+        conn.add_hook(metrics)
+        baseline_rss = peak_rss()
+        seconds, processed, errors = [], 0, []
+        for i in range(warmup, warmup + repeat):
+            started = time.perf_counter()
+            try:
+                processed += operation(i) or 0
+            except Exception as e:
+                errors.append(repr(e))
+            seconds.append(time.perf_counter() - started)
+    conn.close()
+    total = sum(seconds)
+    requests = metrics.summary()
+    return {
+        'name': name,
+        'repeat': repeat,
+        'errors': errors,
+        'seconds': {
+            'total': total,
+            'mean': total / len(seconds) if seconds else 0.0,
+            'min': min(seconds, default=0.0),
+            'p50': percentile(seconds, 0.5),
+            'p95': percentile(seconds, 0.95),
+            'p99': percentile(seconds, 0.99),
+            'max': max(seconds, default=0.0),
+        },
+        'ops_per_second': len(seconds) / total if total else None,
+        'processed': processed,
+        'processed_per_second': processed / total if total else None,
+        'requests': sum(row['requests'] for row in requests),
+        'response_bytes': sum(row['response_bytes'] for row in requests),
+        'request_bytes': sum(row['request_bytes'] for row in requests),
+        'parse_seconds': sum(row['parse_seconds_total'] for row in requests),
+        'baseline_rss_bytes': baseline_rss,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def _run_isolated(results, name: str, url: str, cache_dir: str, kwargs: Dict[str, Any]):
+    # the client caches would turn every repeat after the first into a local read
+    os.environ['DMP_CACHE_DIR'] = os.path.join(cache_dir, 'cache')
+    os.environ['DMP_CACHE_SIZE'] = '0'
+    os.environ['DMP_RECORD_CACHE_SIZE'] = '0'
+    os.environ['DMP_FIELD_CACHE_TTL'] = '0'
+    try:
+        results.put(run_benchmark(name, url, **kwargs))
+    except Exception as e:
+        results.put({'name': name, 'errors': [repr(e)]})
+
+
+def _isolated_result(results, process, name: str, timeout: float) -> Dict[str, Any]:
+    """
+    Wait for the result of a benchmark process; a process that crashes or runs longer than timeout
+    seconds is reported as a failed benchmark instead of blocking the run
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return results.get(timeout=max(0.0, min(1.0, deadline - time.monotonic())))
+        except queue.Empty:
+            if time.monotonic() >= deadline:
+                process.terminate()
+                return {'name': name, 'errors': [f'no result after {timeout:g}s']}
+            if not process.is_alive():
+                # a result put just before exiting may still be on its way through the pipe
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return {'name': name, 'errors': [f'process exited with code {process.exitcode}']}
+
+
+def run_benchmarks(names: Optional[List[str]] = None, repeat: int = 5, warmup: int = 1,
+                   upload_size: int = 1024 * 1024, isolate: bool = True, timeout: float = 3600,
+                   verbose: bool = True, **study) -> Dict[str, Any]:
+    """
+    Start a MockDMPServer with a synthetic study (study holds the arguments of add_synthetic_study)
+    and run the benchmarks, each in a fresh process with the client caches disabled. With isolate
+    False they run in this process, with whatever caches it has configured. An isolated benchmark
+    without a result after timeout seconds is stopped and reported with an error.
+    """
+    from dmpy.mock_server import MockDMPServer
+    names = names or BENCHMARKS
+    study.setdefault('archive_format', 'zip')
+    results = []
+    with MockDMPServer() as server, tempfile.TemporaryDirectory(prefix='dmpy-benchmark-') as cache_dir:
+        started = time.perf_counter()
+        server.add_synthetic_study(STUDY_ID, **study)
+        setup_seconds = time.perf_counter() - started
+        kwargs = dict(repeat=repeat, warmup=warmup, upload_size=upload_size, file_format=study['archive_format'])
+        context = multiprocessing.get_context('spawn')
+        for name in names:
+            before = dict(server.stats)
+            if isolate:
+                results_queue = context.Queue()
+                process = context.Process(target=_run_isolated,
+                                          args=(results_queue, name, server.url, cache_dir, kwargs))
+                process.start()
+                result = _isolated_result(results_queue, process, name, timeout)
+                process.join()
+            else:
+                result = run_benchmark(name, server.url, **kwargs)
+            result['server'] = {key: server.stats[key] - before[key] for key in before}
+            results.append(result)
+            if verbose:
+                seconds = result.get('seconds') or {}
+                errors = result.get('errors') or []
+                print(f"{name:<28} p50 {seconds.get('p50', 0):8.4f}s  p95 {seconds.get('p95', 0):8.4f}s  "
+                      f"peak RSS {(result.get('peak_rss_bytes') or 0) / 2 ** 20:8.1f} MiB"
+                      f"{f'  errors: {len(errors)} ({errors[0]})' if errors else ''}",
+                      file=sys.stderr)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict(study, repeat=repeat, warmup=warmup, upload_size=upload_size, isolate=isolate,
+                      timeout=timeout),
+        'setup_seconds': setup_seconds,
+        'results': results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Compare the median latency and peak RSS of two benchmark runs; ratios above 1 are regressions
+    """
+    previous = {result['name']: result for result in baseline.get('results', [])}
+    rows = []
+    for result in current.get('results', []):
+        old = previous.get(result['name'])
+        if old is None or not old.get('seconds') or not result.get('seconds'):
+            continue
+        old_p50, new_p50 = old['seconds']['p50'], result['seconds']['p50']
+        old_rss, new_rss = old.get('peak_rss_bytes'), result.get('peak_rss_bytes')
+        rows.append({
+            'name': result['name'],
+            'p50_before': old_p50,
+            'p50_after': new_p50,
+            'p50_ratio': new_p50 / old_p50 if old_p50 else None,
+            'peak_rss_ratio': new_rss / old_rss if old_rss and new_rss else None,
+        })
+    return rows
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='python -m dmpy.benchmark', description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run (default all): {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--participants', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--files-per-device', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='bytes of text per device file')
+    parser.add_argument('--archive-format', choices=['zip', 'tar.gz'], default='zip')
+    parser.add_argument('--archive-members', type=int, default=4)
+    parser.add_argument('--subjects', type=int, default=50)
+    parser.add_argument('--visits', type=int, default=6)
+    parser.add_argument('--fields', type=int, default=20)
+    parser.add_argument('--upload-size', type=int, default=1024 * 1024)
+    parser.add_argument('--no-isolate', action='store_true', help='run all benchmarks in this process')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for each isolated benchmark')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        args.benchmarks or None, repeat=args.repeat, warmup=args.warmup, upload_size=args.upload_size,
+        isolate=not args.no_isolate, timeout=args.timeout, participants=args.participants, devices=args.devices,
+        files_per_device=args.files_per_device, file_size=args.file_size, archive_format=args.archive_format,
+        archive_members=args.archive_members, subjects=args.subjects, visits=args.visits, fields=args.fields)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(json.load(f), report)
+        for row in report['comparison']:
+            print(f"{row['name']:<28} p50 {row['p50_before']:8.4f}s -> {row['p50_after']:8.4f}s "
+                  f"({row['p50_ratio'] or 0:.2f}x)", file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
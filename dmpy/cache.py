@@ -0,0 +1,202 @@
+from contextlib import contextmanager
+from dmpy.utils import dmpy_home
+from typing import BinaryIO, Iterator, Optional
+import threading
+import glob
+import time
+import uuid
+import os
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, eviction is then only safe within one process
+    fcntl = None
+
+DEFAULT_CACHE_SIZE = 5 * 1024 ** 3
+STALE_TEMP_SECONDS = 24 * 3600
+# how often an entry evicted by another process between lookup and open is fetched again
+FETCH_ATTEMPTS = 3
+
+
+class FileCache:
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None):
+        """
+        A size-bounded LRU cache of downloaded study files, keyed by file id and hash.
+
+        Entries are written to a temporary name and renamed into place, and eviction runs under a
+        file lock, so one cache directory can be shared by several processes.
+        """
+        if directory is None:
+            directory = os.environ.get('DMP_CACHE_DIR') or os.path.join(dmpy_home(), 'cache')
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('DMP_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the path of a cached entry, marking it as recently used
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, write) -> str:
+        """
+        Store an entry by calling write(tmp_path), which must create tmp_path, then evict old entries
+        """
+        tmp_path = self._path(f'.{key}.{os.getpid()}.{threading.get_ident()}')
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, self._path(key))
+        finally:
+            for leftover in (tmp_path, f'{tmp_path}.part'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self.evict(keep=key)
+        return self._path(key)
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        with self._lock, open(self._path('.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith('.'):
+                    # temporary files left behind by crashed downloads
+                    if entry.name != '.lock' and now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(entry.path)
+                    continue
+                total += stat.st_size
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name != '.lock':
+                os.remove(self._path(name))
+
+    def lookup_file(self, file_id: str, file_hash: Optional[str] = None) -> Optional[str]:
+        """
+        Return the cached path of a study file. Without a hash any cached copy of the file id is used
+        """
+        if file_hash:
+            return self.get(f'{file_id}.{file_hash}')
+        for path in glob.glob(self._path(f'{glob.escape(file_id)}.*')):
+            return self.get(os.path.basename(path))
+        return None
+
+    def fetch_file(self, conn, file_id: str, file_hash: Optional[str] = None) -> str:
+        """
+        Return the cached path of a study file, downloading it into the cache if needed
+        """
+        path = self.lookup_file(file_id, file_hash)
+        if path is not None:
+            return path
+        return self.put(f'{file_id}.{file_hash or ""}',
+                        lambda tmp_path: conn.download_file(file_id, tmp_path, file_hash=file_hash, resume=False))
+
+    # Readers take no lock, so another process may evict an entry between resolving its path and
+    # opening it. An open file stays readable after eviction, so these open first and treat a
+    # vanished entry as a miss.
+
+    def open_cached(self, file_id: str, file_hash: Optional[str] = None) -> Optional[BinaryIO]:
+        """
+        Open the cached copy of a study file for reading, or return None when it is not cached
+        """
+        path = self.lookup_file(file_id, file_hash)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def open_file(self, conn, file_id: str, file_hash: Optional[str] = None) -> BinaryIO:
+        """
+        Open a study file from the cache for reading, downloading it into the cache if needed
+        """
+        for attempt in range(FETCH_ATTEMPTS):
+            path = self.fetch_file(conn, file_id, file_hash)
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                if attempt == FETCH_ATTEMPTS - 1:
+                    raise
+
+    @contextmanager
+    def pinned_file(self, conn, file_id: str, file_hash: Optional[str] = None) -> Iterator[str]:
+        """
+        Yield the path of a study file that stays valid until the with block exits, for readers that
+        need a path rather than an open file: the cache entry is hard-linked to a temporary name,
+        which eviction skips
+        """
+        pin_path = self._path(f'.pin.{file_id}.{uuid.uuid4().hex}')
+        for attempt in range(FETCH_ATTEMPTS):
+            path = self.fetch_file(conn, file_id, file_hash)
+            try:
+                os.link(path, pin_path)
+                break
+            except FileNotFoundError:
+                if attempt == FETCH_ATTEMPTS - 1:
+                    raise
+            except OSError:
+                # no hard links on this filesystem, fall back to the entry itself
+                yield path
+                return
+        try:
+            yield pin_path
+        finally:
+            os.remove(pin_path)
+
+
+_default_cache: Optional[FileCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[FileCache]:
+    """
+    Return the process-wide file cache, or None when it is disabled with DMP_CACHE_SIZE=0
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = FileCache()
+        if _default_cache.max_bytes <= 0:
+            return None
+        return _default_cache
+
+
+def set_default_cache(cache: Optional[FileCache]):
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = cache
@@ -0,0 +1,239 @@
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+import json
+import time
+
+RECORD_COLUMNS = ["fileId", "fileName", "fileSize", "fileHash", "participantId", "deviceKind", "deviceId",
+                  "timeStart", "timeEnd", "timeUpload", "stampStart", "stampEnd", "stampUpload", "uploadedBy",
+                  "studyId"]
+INDEXED_COLUMNS = ["participantId", "deviceId", "deviceKind", "fileId"]
+FILE_COLUMNS = ["fileId", "fileName", "fileSize", "fileHash", "participantId", "deviceId", "stampStart", "stampEnd",
+                "stampUpload", "uploadedBy", "studyId"]
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+# (device id, rows, starts, running maximum of ends, ends) of one participant's device
+DeviceIntervals = Tuple[str, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def _local_time(stamps: pd.Series) -> pd.Series:
+    """
+    Convert millisecond stamps to naive local times, as datetime.fromtimestamp does. UTC offsets
+    only change on hour boundaries, so the local offset is looked up once per distinct hour.
+    """
+    hours = stamps // HOUR_MS
+    offsets = {hour: time.localtime(hour * 3600).tm_gmtoff * 1000 for hour in hours.dropna().unique()}
+    return pd.to_datetime(stamps + hours.map(offsets).astype("Int64"), unit='ms')
+
+
+def _format_time(times: pd.Series) -> np.ndarray:
+    if times.empty:
+        return np.empty(0, dtype=object)
+    text = np.datetime_as_string(times.to_numpy(dtype='datetime64[s]'), unit='s')
+    text = np.char.replace(text, 'T', ' ').astype(object)
+    text[times.isna().to_numpy()] = None
+    return text
+
+
+def to_stamp(value: Union[int, float, str, date, datetime], end: bool = False) -> int:
+    """
+    Convert a time to a millisecond stamp like stampStart and stampEnd. Numbers are taken as stamps,
+    and datetimes and ISO strings without a timezone as local times, like timeStart. Dates and
+    date-only strings ('2023-05-22' or '20230522') mean the start of the day, or with end the last
+    millisecond of the day.
+    """
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return int(value)
+    if isinstance(value, str):
+        text = value.strip()
+        if len(text) in (8, 10) and text.replace('-', '').isdigit():
+            value = datetime.strptime(text.replace('-', ''), '%Y%m%d').date()
+        else:
+            value = datetime.fromisoformat(text)
+    if not isinstance(value, datetime):
+        stamp = int(datetime(value.year, value.month, value.day).timestamp() * 1000)
+        return stamp + DAY_MS - 1 if end else stamp
+    return int(value.timestamp() * 1000)
+
+
+def file_columns(files: Iterable[dict]) -> Dict[str, list]:
+    """
+    Flatten file entries of the files.graphql query, parsing each description once, into the
+    FILE_COLUMNS lists
+    """
+    files = list(files)
+    descriptions = [json.loads(f["description"]) for f in files]
+    uploads = [f.get("uploadTime") for f in files]
+    return {
+        "fileId": [f["id"] for f in files],
+        "fileName": [f.get("fileName") for f in files],
+        "fileSize": [f["fileSize"] for f in files],
+        "fileHash": [f.get("hash") for f in files],
+        "participantId": [d.get("participantId") for d in descriptions],
+        "deviceId": [d.get("deviceId") for d in descriptions],
+        "stampStart": [d.get("startDate") for d in descriptions],
+        "stampEnd": [d.get("endDate") for d in descriptions],
+        "stampUpload": [int(u) if isinstance(u, str) else u for u in uploads],
+        "uploadedBy": [f.get("uploadedBy") for f in files],
+        "studyId": [f.get("studyId") for f in files],
+    }
+
+
+class FileCatalog:
+    def __init__(self, frame: pd.DataFrame):
+        """
+        A columnar listing of a study's files, with one row per file and the columns of list_files.
+        Lookups by participant, device, device kind and file id go through hash indexes built on first use.
+        """
+        self.frame = frame
+        self._indexes: Dict[str, Dict[str, np.ndarray]] = {}
+        self._file_id_index: Optional[pd.Index] = None
+        self._interval_index: Optional[Dict[str, List[DeviceIntervals]]] = None
+
+    @classmethod
+    def from_files(cls, files: Iterable[dict]) -> 'FileCatalog':
+        """
+        Build a catalog from the file entries of the files.graphql query
+        """
+        return cls.from_columns(file_columns(files))
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Sequence]) -> 'FileCatalog':
+        """
+        Build a catalog from the columns returned by file_columns
+        """
+        device_ids = pd.Series(columns["deviceId"], dtype=object)
+        frame = pd.DataFrame({
+            "fileId": pd.Series(columns["fileId"], dtype=object),
+            "fileName": pd.Series(columns["fileName"], dtype=object),
+            "fileSize": pd.Series(columns["fileSize"], dtype=object),
+            "fileHash": pd.Series(columns["fileHash"], dtype=object),
+            "participantId": pd.Categorical(columns["participantId"]),
+            "deviceKind": pd.Categorical(device_ids.str[0:3]),
+            "deviceId": pd.Categorical(device_ids),
+            "stampStart": pd.array(columns["stampStart"], dtype="Int64"),
+            "stampEnd": pd.array(columns["stampEnd"], dtype="Int64"),
+            "stampUpload": pd.array(columns["stampUpload"], dtype="Int64"),
+            "uploadedBy": pd.Categorical(columns["uploadedBy"]),
+            "studyId": pd.Categorical(columns["studyId"]),
+        })
+        frame["timeStart"] = _local_time(frame["stampStart"])
+        frame["timeEnd"] = _local_time(frame["stampEnd"])
+        frame["timeUpload"] = _local_time(frame["stampUpload"])
+        return cls(frame[RECORD_COLUMNS])
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def index(self, column: str) -> Dict[str, np.ndarray]:
+        """
+        Return the row positions of each value of an indexed column
+        """
+        if column not in self._indexes:
+            self._indexes[column] = self.frame.groupby(column, observed=True, sort=False).indices
+        return self._indexes[column]
+
+    def positions(self, column: str, values: Iterable[str]) -> np.ndarray:
+        if column == "fileId":
+            # file ids are unique, a plain hash index is cheaper than grouping
+            if self._file_id_index is None:
+                self._file_id_index = pd.Index(self.frame["fileId"])
+            rows = self._file_id_index.get_indexer(list(set(values)))
+            return np.sort(rows[rows >= 0])
+        index = self.index(column)
+        found = [index[value] for value in set(values) if value in index]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+    def filter(self,
+               participants: Optional[List[str]] = None,
+               kinds: Optional[List[str]] = None,
+               devices: Optional[List[str]] = None,
+               file_ids: Optional[List[str]] = None) -> 'FileCatalog':
+        """
+        Return the files matching all given filters, each a list of accepted values
+        """
+        selected = None
+        for column, values in zip(INDEXED_COLUMNS, (participants, devices, kinds, file_ids)):
+            if values is None:
+                continue
+            rows = self.positions(column, values)
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        if selected is None:
+            return self
+        return FileCatalog(self.frame.iloc[selected])
+
+    def intervals(self) -> Tuple[DeviceIntervals, Dict[str, List[DeviceIntervals]]]:
+        """
+        Return the interval index: (None, rows, starts, running maximum of ends, ends) of all files
+        ordered by stampStart, and the same per device for each participant. Files without both
+        stamps are left out.
+        """
+        if self._interval_index is None:
+            starts = self.frame["stampStart"].to_numpy(dtype="float64", na_value=np.nan)
+            ends = self.frame["stampEnd"].to_numpy(dtype="float64", na_value=np.nan)
+            rows = np.flatnonzero(~(np.isnan(starts) | np.isnan(ends)))
+            rows = rows[np.argsort(starts[rows], kind="stable")]
+
+            def intervals(device, rows):
+                return device, rows, starts[rows], np.maximum.accumulate(ends[rows]), ends[rows]
+
+            # grouping the sorted rows keeps each group sorted by start
+            dated = self.frame.iloc[rows]
+            groups = dated.groupby(["participantId", "deviceId"], observed=True, sort=False, dropna=False).indices
+            by_participant: Dict[str, List[DeviceIntervals]] = {}
+            for (participant, device), positions in groups.items():
+                by_participant.setdefault(participant, []).append(intervals(device, rows[positions]))
+            self._interval_index = (intervals(None, rows), by_participant)
+        return self._interval_index
+
+    def overlapping(self,
+                    start: Union[int, float, str, date, datetime],
+                    end: Union[int, float, str, date, datetime],
+                    participants: Optional[List[str]] = None,
+                    kinds: Optional[List[str]] = None,
+                    devices: Optional[List[str]] = None) -> 'FileCatalog':
+        """
+        Return the files whose [stampStart, stampEnd] overlaps [start, end] (see to_stamp), in
+        catalog order. Files are kept sorted by start, per participant's device and overall. The
+        candidates are found by bisection, since the running maximum of the ends bounds them from
+        below, so a query does not scan the files outside its time window.
+        """
+        start, end = to_stamp(start), to_stamp(end, end=True)
+        all_files, by_participant = self.intervals()
+        devices = set(devices) if devices is not None else None
+        kinds = set(kinds) if kinds is not None else None
+        if participants is None:
+            groups = [all_files]
+        else:
+            groups = [group for participant in set(participants) for group in by_participant.get(participant, [])]
+            if devices is not None:
+                groups = [group for group in groups if group[0] in devices]
+            if kinds is not None:
+                groups = [group for group in groups if isinstance(group[0], str) and group[0][0:3] in kinds]
+        found = []
+        for _, rows, starts, max_ends, ends in groups:
+            first = np.searchsorted(max_ends, start, side="left")
+            last = np.searchsorted(starts, end, side="right")
+            if first < last:
+                found.append(rows[first:last][ends[first:last] >= start])
+        selected = np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+        if participants is None:
+            for column, values in (("deviceId", devices), ("deviceKind", kinds)):
+                if values is not None:
+                    selected = selected[self.frame[column].iloc[selected].isin(list(values)).to_numpy()]
+        return FileCatalog(self.frame.iloc[selected])
+
+    def to_records(self) -> List[dict]:
+        """
+        Return the files as list_files dictionaries
+        """
+        columns = []
+        for column in RECORD_COLUMNS:
+            values = self.frame[column]
+            if column.startswith("time"):
+                columns.append(_format_time(values))
+            else:
+                values = values.astype(object)
+                columns.append(values.where(values.notna(), None).tolist())
+        return [dict(zip(RECORD_COLUMNS, row)) for row in zip(*columns)]
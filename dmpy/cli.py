@@ -0,0 +1,173 @@
+"""
+The dmpy command line:
+
+    python -m dmpy state
+    python -m dmpy ls <study_id> [-p PARTICIPANT] [-k KIND] [-d DEVICE] [--json]
+    python -m dmpy get <file_id> [-o PATH] [--hash HASH]
+    python -m dmpy put <study_id> PATH... [--participant ID --device ID --start YYYYMMDD --end YYYYMMDD]
+
+The portal and credentials come from DMP_URL/DMP_COOKIE or the portal login files, as for the
+library; --host overrides the portal.
+"""
+from datetime import datetime, timezone
+from typing import List, Optional
+import argparse
+import json
+import sys
+
+LS_COLUMNS = ["fileId", "fileName", "fileSize", "participantId", "deviceId", "timeStart", "timeEnd"]
+
+
+def _day_start(day: str) -> int:
+    return int(datetime.strptime(day, "%Y%m%d").replace(tzinfo=timezone.utc).timestamp())
+
+
+def _connection(args):
+    from dmpy.connections import DMPConnection
+    return DMPConnection(host=args.host)
+
+
+def _state(args) -> int:
+    from dmpy.dmpy import state
+    return 0 if state(conn=_connection(args)) is not None else 1
+
+
+def _local_time(stamp: Optional[int]) -> Optional[str]:
+    return None if stamp is None else datetime.fromtimestamp(stamp / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _file_records(files: List[dict], participants: Optional[List[str]], kinds: Optional[List[str]],
+                  devices: Optional[List[str]]) -> List[dict]:
+    """
+    Filter and format file entries as list_files does, down to an empty filter matching nothing.
+    list_files builds a pandas FileCatalog, and importing pandas takes longer than a whole listing
+    from the command line; tests/test_cli.py checks the two give the same records.
+    """
+    records = []
+    for f in files:
+        description = json.loads(f["description"])
+        device_id = description.get("deviceId")
+        device_kind = device_id[0:3] if device_id is not None else None
+        if participants is not None and description.get("participantId") not in participants:
+            continue
+        if kinds is not None and device_kind not in kinds:
+            continue
+        if devices is not None and device_id not in devices:
+            continue
+        upload = f.get("uploadTime")
+        upload = int(upload) if isinstance(upload, str) else upload
+        records.append({
+            "fileId": f["id"],
+            "fileName": f.get("fileName"),
+            "fileSize": f["fileSize"],
+            "fileHash": f.get("hash"),
+            "participantId": description.get("participantId"),
+            "deviceKind": device_kind,
+            "deviceId": device_id,
+            "timeStart": _local_time(description.get("startDate")),
+            "timeEnd": _local_time(description.get("endDate")),
+            "timeUpload": _local_time(upload),
+            "stampStart": description.get("startDate"),
+            "stampEnd": description.get("endDate"),
+            "stampUpload": upload,
+            "uploadedBy": f.get("uploadedBy"),
+            "studyId": f.get("studyId"),
+        })
+    return records
+
+
+def _ls(args) -> int:
+    response = _connection(args).graphql_request("files", {"studyId": args.study_id})
+    if not response.get('data'):
+        raise Exception(f'Failed to list files in study {args.study_id}: {response.get("errors")}')
+    files = _file_records(response['data']['getStudy']['files'], args.participant, args.kind, args.device)
+    for record in files:
+        if args.json:
+            print(json.dumps(record))
+        else:
+            print('\t'.join('' if record[column] is None else str(record[column]) for column in LS_COLUMNS))
+    return 0
+
+
+def _get(args) -> int:
+    from dmpy.dmpy import download_file, iter_file_content
+    if args.output and args.output != '-':
+        download_file(args.file_id, args.output, file_hash=args.hash, conn=_connection(args))
+        return 0
+    out = sys.stdout.buffer
+    for chunk in iter_file_content(args.file_id, file_hash=args.hash, conn=_connection(args)):
+        out.write(chunk)
+    out.flush()
+    return 0
+
+
+def _put(args) -> int:
+    from dmpy.dmpy import parse_device_file_name, upload_files
+    uploads = []
+    for path in args.paths:
+        upload = parse_device_file_name(path) or {}
+        if args.participant:
+            upload['participantId'] = args.participant
+        if args.device:
+            upload['deviceId'] = args.device
+        if args.start:
+            upload['startDate'] = _day_start(args.start)
+        if args.end:
+            upload['endDate'] = _day_start(args.end) + 24 * 3600 - 1
+        missing = [key for key in ('participantId', 'deviceId', 'startDate', 'endDate') if key not in upload]
+        if missing:
+            print(f"{path}: not named <participant>-<device>-<start>-<end>, pass --participant, --device, "
+                  f"--start and --end", file=sys.stderr)
+            return 2
+        uploads.append(dict(upload, path=path))
+    manifest = upload_files(args.study_id, uploads, max_workers=args.workers, verbose=args.verbose,
+                            conn=_connection(args))
+    for entry in manifest['uploaded']:
+        print(f"{entry['fileId']}\t{entry['fileName']}")
+    for entry in manifest['failed']:
+        print(f"{entry['fileName']}: {entry['error']}", file=sys.stderr)
+    return 1 if manifest['failed'] else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='dmpy', description='Command line client for the IDEA-FAST DMP')
+    parser.add_argument('--host', help='portal URL (default: DMP_URL or the portal login files)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    state = commands.add_parser('state', help='show the current user and their studies')
+    state.set_defaults(run=_state)
+
+    ls = commands.add_parser('ls', help='list the files of a study')
+    ls.add_argument('study_id')
+    ls.add_argument('-p', '--participant', action='append', help='only this participant (repeatable)')
+    ls.add_argument('-k', '--kind', action='append', help='only this device kind (repeatable)')
+    ls.add_argument('-d', '--device', action='append', help='only this device id (repeatable)')
+    ls.add_argument('--json', action='store_true', help='one JSON object per file instead of tab-separated '
+                                                        + ', '.join(LS_COLUMNS))
+    ls.set_defaults(run=_ls)
+
+    get = commands.add_parser('get', help='download a file')
+    get.add_argument('file_id')
+    get.add_argument('-o', '--output', help='path to write to, resuming a partial download (default: stdout)')
+    get.add_argument('--hash', help='expected sha256 of the content')
+    get.set_defaults(run=_get)
+
+    put = commands.add_parser('put', help='upload device files, skipping those the study already has')
+    put.add_argument('study_id')
+    put.add_argument('paths', nargs='+', metavar='PATH')
+    put.add_argument('--participant', help='participant id (default: from the file name)')
+    put.add_argument('--device', help='device id (default: from the file name)')
+    put.add_argument('--start', help='first day as YYYYMMDD (default: from the file name)')
+    put.add_argument('--end', help='last day as YYYYMMDD (default: from the file name)')
+    put.add_argument('-j', '--workers', type=int, default=4, help='parallel uploads')
+    put.add_argument('-v', '--verbose', action='store_true', help='report each file as it is done')
+    put.set_defaults(run=_put)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.run(args)
+    except KeyboardInterrupt:
+        return 130
+    except Exception as e:
+        print(f"dmpy {args.command}: {e}", file=sys.stderr)
+        return 1
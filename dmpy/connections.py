@@ -1,12 +1,154 @@
-from typing import Dict
-from dmpy.utils import load_query, load_cookie_from_file, load_host_from_file
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from dmpy.utils import is_mutation, load_query, query_hash, load_cookie_from_file, load_host_from_file
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+import threading
+import warnings
+import time
+import tempfile
+import hashlib
+import uuid
 import os
+import io
 import json
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-class DMPConnection:
-    def __init__(self):
+
+class HashingReader:
+    """
+    File-like wrapper over a download stream that hashes the bytes as they are read and checks the
+    digest against the expected hash once the stream is exhausted. Closing it (or leaving its with
+    block without an error) reads and verifies whatever the caller left unread, as readers such as
+    tarfile stop at the end of the archive rather than at the end of the stream.
+    """
+
+    def __init__(self, raw, file_id: str, file_hash: Optional[str] = None):
+        self._raw = raw
+        self._file_id = file_id
+        self._file_hash = file_hash
+        self._hasher = hashlib.sha256()
+        self._closed = False
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size) if size is not None and size >= 0 else self._raw.read()
+        if data:
+            self._hasher.update(data)
+            self.bytes_read += len(data)
+        if not data or size is None or size < 0:
+            self._verify()
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def _verify(self):
+        if self._file_hash and self._hasher.hexdigest() != self._file_hash:
+            raise Exception(f'Hash mismatch for file {self._file_id}: expected {self._file_hash}, '
+                            f'got {self._hasher.hexdigest()}')
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            for _ in iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b''):
+                pass
+        finally:
+            self._closed = True
+            self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            # the read was abandoned, there is nothing to verify
+            self._closed = True
+            self._raw.close()
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body that streams its file part from a file object instead of building
+    the body in memory. It has a known length and can be rewound, so it can be retried.
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, file_name: str, file: BinaryIO, file_length: int):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        quoted_name = file_name.replace('"', '%22')
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{quoted_name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self._file = file
+        self._file_start = file.tell()
+        self._parts = [(io.BytesIO(head), len(head)), (file, file_length), (io.BytesIO(tail), len(tail))]
+        self._length = len(head) + file_length + len(tail)
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        return iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b'')
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence != io.SEEK_SET:
+            offset += self._pos if whence == io.SEEK_CUR else self._length
+        self._pos = offset
+        self._part = 0
+        for index, (part, length) in enumerate(self._parts):
+            part_offset = min(max(offset, 0), length)
+            part.seek(self._file_start + part_offset if part is self._file else part_offset)
+            if offset >= length and index < len(self._parts) - 1:
+                self._part = index + 1
+            offset -= length
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._part < len(self._parts) and (size is None or size < 0 or size > 0):
+            part, length = self._parts[self._part]
+            chunk = part.read(size if size is not None and size >= 0 else -1)
+            if not chunk:
+                self._part += 1
+                continue
+            chunks.append(chunk)
+            if size is not None and size >= 0:
+                size -= len(chunk)
+        data = b''.join(chunks)
+        self._pos += len(data)
+        return data
+
+
+def hash_file(file: BinaryIO, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> Tuple[str, int]:
+    """
+    Return the sha256 hash and the length of the rest of a file object, reading it once
+    """
+    hasher = hashlib.sha256()
+    length = 0
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        hasher.update(chunk)
+        length += len(chunk)
+    return hasher.hexdigest(), length
+
+
+def resolve_host_and_cookie(host: Optional[str] = None, cookie: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """
+    Fill in the portal URL and session cookie from DMP_URL/DMP_COOKIE or the cookie files when not given
+    """
+    if host is None:
         if os.environ.get('DMP_URL'):
             host = os.environ.get('DMP_URL')
         else:
@@ -16,61 +158,507 @@ class DMPConnection:
             else:
                 host = f'https://{host}'
 
+    if cookie is None:
         if os.environ.get('DMP_COOKIE'):
             cookie = os.environ.get('DMP_COOKIE')
         else:
             cookie = load_cookie_from_file()
+    return host.rstrip('/'), cookie
+
+
+def persisted_query_error(body: Any) -> Optional[str]:
+    """
+    Return PERSISTED_QUERY_NOT_FOUND or PERSISTED_QUERY_NOT_SUPPORTED if the server rejected a persisted query
+    """
+    errors = (body.get('errors') if isinstance(body, dict) else None) or []
+    for error in errors:
+        code = (error.get('extensions') or {}).get('code')
+        if error.get('message') == 'PersistedQueryNotFound' or code == 'PERSISTED_QUERY_NOT_FOUND':
+            return 'PERSISTED_QUERY_NOT_FOUND'
+        if error.get('message') == 'PersistedQueryNotSupported' or code == 'PERSISTED_QUERY_NOT_SUPPORTED':
+            return 'PERSISTED_QUERY_NOT_SUPPORTED'
+    return None
+
+
+def iter_json_items(stream: BinaryIO, prefix: str, pairs: bool = False) -> Iterator[Any]:
+    """
+    Parse a GraphQL response incrementally and yield the items of the array at prefix (a dotted
+    ijson path such as 'data.getStudy.files'), or its (key, value) pairs when pairs is set, so only
+    one item is in memory at a time. Raises if the response carried GraphQL errors.
+    """
+    import ijson
+    errors = []
+
+    def events():
+        for prefix_, event, value in ijson.parse(stream, use_float=True):
+            if prefix_ == 'errors.item.message':
+                errors.append(value)
+            yield prefix_, event, value
+
+    if pairs:
+        yield from ijson.kvitems(events(), prefix)
+    else:
+        yield from ijson.items(events(), f'{prefix}.item')
+    if errors:
+        raise Exception(errors)
+
+
+class DMPConnection:
+    def __init__(self,
+                 host: Optional[str] = None,
+                 cookie: Optional[str] = None,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 10,
+                 timeout=(10, 300),
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 persisted_queries: bool = False,
+                 hooks: Optional[List[Callable[[Dict[str, Any]], None]]] = None):
+        """
+        A connection to the DMP backed by a pooled keep-alive session.
+
+        timeout is passed to every request as (connect, read) seconds. Connection errors and
+        502/503/504 responses are retried up to max_retries times with exponential backoff for
+        downloads and GraphQL queries. Mutations and uploads are only retried when the connection
+        could not be made, as a lost response does not mean the server did not apply them.
+        With persisted_queries, GraphQL requests send the sha256 of the query instead of its text
+        (automatic persisted queries) and only send the text when the server does not know the hash.
+        Each hook is called with an event dict after every HTTP request (see add_hook).
+        """
+        host, cookie = resolve_host_and_cookie(host, cookie)
         self._host = host
-        self._host_graphql = f'{host}/graphql'
-        self._cookies = {"connect.sid": cookie}
+        self._host_graphql = f'{self._host}/graphql'
+        self._timeout = timeout
+        self._persisted_queries = persisted_queries
+        self._batching_supported = True
+        self._hooks: List[Callable[[Dict[str, Any]], None]] = list(hooks or [])
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            # urllib3 leaves POST out by default, but the GraphQL queries are all sent as POST
+            allowed_methods=frozenset({'GET', 'HEAD', 'POST'}),
+            raise_on_status=False,
+        )
+        # mutations and uploads go through their own session that only retries failed connections
+        no_resend = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status=0,
+            read=0,
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False,
+        )
+        self._session = self._new_session(retry, pool_connections, pool_maxsize, cookie)
+        self._mutation_session = self._new_session(no_resend, pool_connections, pool_maxsize, cookie)
+
+    @staticmethod
+    def _new_session(retry: Retry, pool_connections: int, pool_maxsize: int,
+                     cookie: Optional[str]) -> requests.Session:
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if cookie:
+            session.cookies.set('connect.sid', cookie)
+        return session
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    def add_hook(self, hook: Callable[[Dict[str, Any]], None]):
+        """
+        Call hook(event) after every HTTP request. The event has the 'operation' (the query name, or
+        file, range or upload), 'kind' (graphql, batch, stream, file, range or upload), the 'target'
+        (file id or uploaded file name, None for queries), response 'status' (None if the request failed), wall time in 'seconds' until the body was read, 'ttfb' (time until the response
+        headers), 'parse_seconds' spent decoding JSON, 'request_bytes', 'response_bytes', 'retries'
+        made by the connection's retry policy, and the 'error' if any.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[Dict[str, Any]], None]):
+        self._hooks.remove(hook)
+
+    def _send(self, method: str, url: str, operation: str, kind: str, target: Optional[str] = None,
+              resend: bool = True, **kwargs) -> Tuple[requests.Response, Dict]:
+        """
+        Send a request through the session and start its instrumentation event; the caller
+        completes it with _emit once the body has been consumed. operation names a fixed set of
+        requests (it labels metrics), target the file the request is about. Without resend, gateway
+        errors and lost responses are not retried
+        """
+        event = {"operation": operation, "kind": kind, "target": target, "status": None, "seconds": None, "ttfb": None,
+                 "parse_seconds": 0.0, "request_bytes": None, "response_bytes": None, "retries": 0,
+                 "error": None, "_started": time.perf_counter()}
+        try:
+            session = self._session if resend else self._mutation_session
+            response = session.request(method, url, timeout=self._timeout, **kwargs)
+        except Exception as e:
+            event["error"] = repr(e)
+            self._emit(event)
+            raise
+        length = response.request.headers.get('Content-Length')
+        event["status"] = response.status_code
+        event["ttfb"] = response.elapsed.total_seconds()
+        event["request_bytes"] = int(length) if length else 0
+        retries = getattr(response.raw, 'retries', None)
+        event["retries"] = len(retries.history) if retries is not None else 0
+        return response, event
+
+    def _emit(self, event: Dict[str, Any], response_bytes: Optional[int] = None, parse_seconds: float = 0.0,
+              error: Optional[BaseException] = None):
+        if not self._hooks:
+            return
+        started = event.pop("_started")
+        event["seconds"] = time.perf_counter() - started - parse_seconds
+        event["parse_seconds"] = parse_seconds
+        if response_bytes is not None:
+            event["response_bytes"] = response_bytes
+        if error is not None:
+            event["error"] = repr(error)
+        for hook in self._hooks:
+            try:
+                hook(dict(event))
+            except Exception as e:
+                warnings.warn(f'dmpy request hook {hook!r} failed: {e!r}')
+
+    def _json(self, response: requests.Response, event: Dict[str, Any]) -> Any:
+        """
+        Decode a JSON response and complete its event, timing the decoding separately
+        """
+        content = response.content
+        parse_started = time.perf_counter()
+        try:
+            body = json.loads(content) if content else None
+        except ValueError:
+            body = None
+        self._emit(event, len(content), time.perf_counter() - parse_started)
+        return body
+
+    def close(self):
+        self._session.close()
+        self._mutation_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def graphql_request(self, name: str, variables: any):
         headers = {
             "Content-Type": "application/json",
         }
         query = load_query(name)
-        payload = {'query': query}
-        if variables:
-            payload['variables'] = variables
-        response = requests.post(self._host_graphql, json={'query': query, 'variables': variables}, headers=headers,
-                                 cookies=self._cookies)
-        if response.status_code != 200:
+        payload = {'query': query, 'variables': variables}
+        if self._persisted_queries:
+            extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash(name)}}
+            response, event = self._send('POST', self._host_graphql, name, 'graphql', resend=not is_mutation(name),
+                                         json={'variables': variables, 'extensions': extensions}, headers=headers)
+            body = self._json(response, event)
+            error = persisted_query_error(body)
+            if error is None:
+                if response.status_code != 200 or body is None:
+                    raise Exception(f'Failed to query {name}: {response.text}')
+                return body
+            if error == 'PERSISTED_QUERY_NOT_SUPPORTED':
+                self._persisted_queries = False
+            else:
+                # the server does not know the hash yet, send the text once so it can register it
+                payload['extensions'] = extensions
+        response, event = self._send('POST', self._host_graphql, name, 'graphql', resend=not is_mutation(name),
+                                     json=payload, headers=headers)
+        body = self._json(response, event)
+        if response.status_code != 200 or body is None:
             raise Exception(f'Failed to query {name}: {response.text}')
-        return response.json()
+        return body
+
+    def graphql_stream(self, name: str, variables: Any, prefix: str, pairs: bool = False) -> Iterator[Any]:
+        """
+        Run a GraphQL query and yield the items (or, with pairs, the (key, value) pairs) found at
+        prefix in its response while it downloads, instead of loading the whole response. Needs ijson.
+        """
+        response, event = self._send('POST', self._host_graphql, name, 'stream',
+                                     json={'query': load_query(name), 'variables': variables}, stream=True)
+        with response:
+            if response.status_code != 200:
+                self._emit(event, len(response.content))
+                raise Exception(f'Failed to query {name}: {response.text}')
+            response.raw.decode_content = True
+            try:
+                yield from iter_json_items(response.raw, prefix, pairs)
+            except Exception as e:
+                self._emit(event, response.raw.tell(), error=e)
+                raise
+            self._emit(event, response.raw.tell())
 
     def get_file(self, file_id: str, stream=True):
         url = f'{self._host}/file/{file_id}'
-        response = requests.get(url, cookies=self._cookies, stream=stream)
+        response, event = self._send('GET', url, 'file', 'file', file_id, stream=stream)
+        content = response.content
+        self._emit(event, len(content))
         if response.status_code != 200:
             raise Exception(f'Failed to download file {file_id}: {response.text}')
-        return response.content
+        return content
+
+    def graphql_batch(self, operations: List[Tuple[str, Any]]) -> List[Dict]:
+        """
+        Run several GraphQL operations, given as (query name, variables), in one HTTP request and return
+        their responses in the same order. Falls back to one request per operation when the server
+        rejects the batch as a whole (it answers a list of operations with one error response), and
+        raises on other failures, as the server may already have run the batch.
+        """
+        if len(operations) == 1 or not self._batching_supported:
+            return [self.graphql_request(name, variables) for name, variables in operations]
+        payload = [{'query': load_query(name), 'variables': variables} for name, variables in operations]
+        # the set of queries, not their count, so batches of any size share one operation
+        response, event = self._send('POST', self._host_graphql, ','.join(sorted({name for name, _ in operations})),
+                                     'batch', resend=not any(is_mutation(name) for name, _ in operations),
+                                     json=payload)
+        results = self._json(response, event)
+        if response.status_code == 200 and isinstance(results, list) and len(results) == len(operations):
+            return results
+        if response.status_code < 500 and isinstance(results, dict) and results.get('errors'):
+            # the batch was read as one invalid operation, so none of the operations ran
+            self._batching_supported = False
+            return [self.graphql_request(name, variables) for name, variables in operations]
+        raise Exception(f'Failed to run batch {", ".join(name for name, _ in operations)}: '
+                        f'{response.status_code} {response.text}')
+
+    def batch(self) -> 'GraphQLBatch':
+        """
+        Collect operations and send them in one request when the with block exits:
+
+            with conn.batch() as batch:
+                fields = batch.add('study_fields', {'studyId': study_id})
+                records = batch.add('data_records', variables)
+            fields.result(), records.result()
+        """
+        return GraphQLBatch(self)
 
-    def upload_file(self, file_name: str, file_content: bytes, variables: any):
+    def _get_stream(self, file_id: str, offset: int = 0) -> Tuple[requests.Response, Dict]:
+        url = f'{self._host}/file/{file_id}'
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        response, event = self._send('GET', url, 'file', 'file', file_id, headers=headers, stream=True)
+        if response.status_code not in (200, 206):
+            text = response.text
+            self._emit(event, len(response.content))
+            response.close()
+            raise Exception(f'Failed to download file {file_id}: {text}')
+        return response, event
+
+    def get_range(self, file_id: str, start: Optional[int], end: int) -> Optional[Tuple[bytes, int]]:
+        """
+        Fetch bytes start..end (inclusive) of a file, or its last `end` bytes when start is None.
+        Returns (data, file size), or None when the server does not honour range requests
+        """
+        url = f'{self._host}/file/{file_id}'
+        byte_range = f'bytes=-{end}' if start is None else f'bytes={start}-{end}'
+        response, event = self._send('GET', url, 'range', 'range', file_id, headers={'Range': byte_range},
+                                     stream=True)
+        with response:
+            if response.status_code == 200:
+                self._emit(event, 0)
+                return None
+            content = response.content
+            self._emit(event, len(content))
+            if response.status_code != 206:
+                raise Exception(f'Failed to download file {file_id}: {response.text}')
+            size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            return content, size
+
+    def iter_file(self, file_id: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE, offset: int = 0):
+        """
+        Yield the content of a file in chunks without buffering it, starting at offset (HTTP Range)
+        """
+        response, event = self._get_stream(file_id, offset)
+        received = 0
+        with response:
+            # the server ignored the range request, drop the bytes we already have
+            skip = offset if response.status_code == 200 else 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    received += len(chunk)
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    yield chunk
+            except Exception as e:
+                self._emit(event, received, error=e)
+                raise
+            self._emit(event, received)
+
+    def open_file(self, file_id: str, file_hash: Optional[str] = None) -> HashingReader:
+        """
+        Open a file for sequential reading. The content is verified against file_hash when fully read
+        """
+        response, event = self._get_stream(file_id)
+        # the body is read by the caller, so only the headers are timed
+        length = response.headers.get('Content-Length')
+        self._emit(event, int(length) if length else None)
+        response.raw.decode_content = True
+        return HashingReader(response.raw, file_id, file_hash)
+
+    def download_file(self, file_id: str, path: str, file_hash: Optional[str] = None, resume: bool = True,
+                      chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_attempts: int = 5) -> str:
+        """
+        Stream a file to path. The data is written to path + '.part' first; an existing part file is
+        resumed with an HTTP Range request, and interrupted transfers are resumed up to max_attempts
+        times. The content is hashed while streaming and checked against file_hash.
+        """
+        part_path = f'{path}.part'
+        hasher = hashlib.sha256()
+        offset = 0
+        if resume and os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            attempt = 1
+            while True:
+                try:
+                    for chunk in self.iter_file(file_id, chunk_size=chunk_size, offset=offset):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        offset += len(chunk)
+                    break
+                except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout):
+                    if attempt >= max_attempts:
+                        raise
+                    attempt += 1
+        if file_hash and hasher.hexdigest() != file_hash:
+            os.remove(part_path)
+            raise Exception(f'Hash mismatch for file {file_id}: expected {file_hash}, got {hasher.hexdigest()}')
+        os.replace(part_path, path)
+        return path
+
+    def upload_file(self, file_name: str, file_content: Union[bytes, str, BinaryIO], variables: any):
+        """
+        Upload a file from bytes, a path or a binary file object. The body is streamed from disk, and the
+        'fileLength' and 'hash' variables are filled in (in one pass over the file) unless already set.
+        """
         query = load_query("upload")
-        
-        operations: Dict[str, Dict] = {
-            'query': query,
-            'variables': variables,
-        }
+        variables = dict(variables)
 
-        map_value: Dict[str, list] = {
-            'x': ['variables.file'],
-        }
+        with tempfile.TemporaryFile() as spool:
+            if isinstance(file_content, (bytes, bytearray, memoryview)):
+                file = io.BytesIO(file_content)
+            elif isinstance(file_content, (str, os.PathLike)):
+                file = open(file_content, 'rb')
+            elif file_content.seekable():
+                file = file_content
+            else:
+                # hash while spooling so a one-shot stream is only read once
+                file = spool
+                hasher = hashlib.sha256()
+                for chunk in iter(lambda: file_content.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    spool.write(chunk)
+                variables.setdefault('hash', hasher.hexdigest())
+                variables.setdefault('fileLength', spool.tell())
+                spool.seek(0)
+            try:
+                start = file.tell()
+                if variables.get('hash') is None or variables.get('fileLength') is None:
+                    variables['hash'], variables['fileLength'] = hash_file(file)
+                    file.seek(start)
 
-        data: Dict[str, str] = {
-            'operations': json.dumps(operations),
-            'map': json.dumps(map_value),
-        }
+                operations: Dict[str, Dict] = {
+                    'query': query,
+                    'variables': variables,
+                }
 
-        files: Dict[str, tuple] = {
-            'x': (file_name, file_content, 'application/octet-stream'),
-        }
+                map_value: Dict[str, list] = {
+                    'x': ['variables.file'],
+                }
+
+                data: Dict[str, str] = {
+                    'operations': json.dumps(operations),
+                    'map': json.dumps(map_value),
+                }
 
-        response: requests.Response = requests.post(self._host_graphql, data=data, files=files, cookies=self._cookies)
+                body = MultipartBody(data, 'x', file_name, file, variables['fileLength'])
 
+                response, event = self._send('POST', self._host_graphql, 'upload', 'upload', file_name, resend=False,
+                                             data=body, headers={'Content-Type': body.content_type})
+            finally:
+                if file is not file_content and file is not spool:
+                    file.close()
+
+        result = self._json(response, event)
         response.raise_for_status()  # Ensure we got a successful response
-        
-        print(response.content)
-        
-        return response.json()
+        if result is None:
+            raise Exception(f'Failed to upload {file_name}: {response.text}')
+        return result
+
+
+class BatchResult:
+    def __init__(self):
+        self._response = None
+        self._done = False
+
+    def result(self) -> Dict:
+        if not self._done:
+            raise Exception('The batch has not been sent yet')
+        return self._response
+
+
+class GraphQLBatch:
+    def __init__(self, conn: DMPConnection):
+        self._conn = conn
+        self._operations: List[Tuple[str, Any]] = []
+        self._results: List[BatchResult] = []
+
+    def add(self, name: str, variables: Any) -> BatchResult:
+        self._operations.append((name, variables))
+        self._results.append(BatchResult())
+        return self._results[-1]
+
+    def send(self):
+        if not self._operations:
+            return
+        responses = self._conn.graphql_batch(self._operations)
+        for result, response in zip(self._results, responses):
+            result._response = response
+            result._done = True
+        self._operations, self._results = [], []
+
+    def __enter__(self) -> 'GraphQLBatch':
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.send()
+
+
+_default_connection: Optional[DMPConnection] = None
+_default_connection_lock = threading.Lock()
+
+
+def get_default_connection() -> DMPConnection:
+    """
+    Return the process-wide connection, creating it from DMP_URL/DMP_COOKIE or the cookie files on first use
+    """
+    global _default_connection
+    with _default_connection_lock:
+        if _default_connection is None:
+            _default_connection = DMPConnection()
+        return _default_connection
+
 
+def set_default_connection(conn: Optional[DMPConnection]):
+    """
+    Replace the process-wide connection. Pass None to have it re-created on next use
+    """
+    global _default_connection
+    with _default_connection_lock:
+        if _default_connection is not None and _default_connection is not conn:
+            _default_connection.close()
+        _default_connection = conn
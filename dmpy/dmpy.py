@@ -1,25 +1,36 @@
-from io import BytesIO
-import math
-from dmpy.connections import DMPConnection
-from dmpy.utils import get_file_type
+from dmpy.connections import DMPConnection, get_default_connection, hash_file
+from dmpy.cache import get_default_cache
+from dmpy.fields import get_default_field_cache, validate_field_inputs
+from dmpy.record_cache import get_default_record_cache
+from dmpy.utils import data_records_variables, file_description, get_file_type
 from colorama import Fore, Style
 from datetime import datetime, timezone
-from typing import List, Dict, Optional, Any
+from typing import TYPE_CHECKING, BinaryIO, List, Dict, Optional, Any, Union
 import json
-# import zipfile
-# import tarfile
-# import rarfile
-# import py7zr
-from io import BytesIO, StringIO
-import pandas as pd
-import copy
-from datetime import datetime
-def state():
+import codecs
+import shutil
+import hashlib
+import threading
+import itertools
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from dmpy.archive import ARCHIVE_TYPES, iter_archive_members, list_archive_members, read_archive_member, decode_text
+from dmpy.archive import iter_lines, iter_text, iter_member_frames_parallel, read_member_frames
+from io import StringIO
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from dmpy.catalog import FileCatalog
+
+
+def state(conn: Optional[DMPConnection] = None):
     """
     Print current user info and studies can be accessed
     """
     # get the connection
-    conn = DMPConnection()
+    conn = conn or get_default_connection()
     # get the whoami
     whoami = conn.graphql_request('whoami', None)
     if 'data' not in whoami:
@@ -48,58 +59,11 @@ def state():
     return studies
 
 
-def list_files(
-        study_id: str,
-        participants: Optional[List[str]] = None,
-        kinds: Optional[List[str]] = None,
-        devices: Optional[List[str]] = None,
-        file_ids: Optional[List[str]] = None,
-):
+def get_file_catalog(study_id: str, conn: Optional[DMPConnection] = None) -> Optional['FileCatalog']:
     """
-    List files in a study
-    """
-
-    def file_json_reformat(file_json):
-        dtx: str = file_json["description"]
-        description: Dict[str, Any] = json.loads(dtx)
-        utt = file_json.get("uploadTime", None)
-        if isinstance(utt, str):
-            utt = int(utt)
-        start_stamp = description.get("startDate", None)
-        end_stamp = description.get("endDate", None)
-        participant = description.get("participantId")
-        if participants is not None and participant not in participants:
-            return None
-        device_id: Optional[str] = description.get("deviceId", None)
-        if devices is not None and device_id not in devices:
-            return None
-        device_kind = device_id[0:3] if device_id is not None else None
-        if kinds is not None and device_kind not in kinds:
-            return None
-        file_id = file_json["id"]
-        if file_ids is not None and file_id not in file_ids:
-            return None
-        return {
-            "fileId": file_id,
-            "fileName": file_json.get("fileName"),
-            "fileSize": file_json["fileSize"],
-            "participantId": participant,
-            "deviceKind": device_kind,
-            "deviceId": device_id,
-            "timeStart": datetime.fromtimestamp(start_stamp * 0.001).strftime(
-                "%Y-%m-%d %H:%M:%S") if start_stamp is not None else None,
-            "timeEnd": datetime.fromtimestamp(end_stamp * 0.001).strftime(
-                "%Y-%m-%d %H:%M:%S") if end_stamp is not None else None,
-            "timeUpload": datetime.fromtimestamp(utt * 0.001).strftime(
-                "%Y-%m-%d %H:%M:%S") if utt is not None else None,
-            "stampStart": start_stamp,
-            "stampEnd": end_stamp,
-            "stampUpload": utt,
-            "uploadedBy": file_json.get("uploadedBy"),
-            "studyId": file_json.get("studyId"),
-        }
-
-    conn = DMPConnection()
+    Fetch the files of a study as a FileCatalog
+    """
+    conn = conn or get_default_connection()
     variables = {
         "studyId": study_id,
     }
@@ -107,234 +71,316 @@ def list_files(
     if 'data' not in all_files:
         print(f"{Fore.LIGHTRED_EX}error to list files in study: {study_id}{Fore.RESET}")
         return
+    from dmpy.catalog import FileCatalog
     study = all_files['data']['getStudy']
-    files = study['files']
-    files2 = [file_json_reformat(f) for f in files if file_json_reformat(f) is not None]
-    return files2
+    return FileCatalog.from_files(study['files'])
 
 
-def get_file_content(file_id: str, stream: bool = True, decode: str = None):
-    conn = DMPConnection()
+def list_files(
+        study_id: str,
+        participants: Optional[List[str]] = None,
+        kinds: Optional[List[str]] = None,
+        devices: Optional[List[str]] = None,
+        file_ids: Optional[List[str]] = None,
+        mirror: bool = False,
+        conn: Optional[DMPConnection] = None,
+):
+    """
+    List files in a study. With mirror=True the study's local FileMirror is refreshed
+    (fetching only what changed) and the files are listed from it
+    """
+    if mirror:
+        from dmpy.mirror import FileMirror
+        file_mirror = FileMirror(study_id)
+        file_mirror.refresh(conn or get_default_connection())
+        return file_mirror.list_files(participants=participants, kinds=kinds, devices=devices, file_ids=file_ids)
+    catalog = get_file_catalog(study_id, conn=conn)
+    if catalog is None:
+        return
+    return catalog.filter(participants=participants, kinds=kinds, devices=devices, file_ids=file_ids).to_records()
+
+
+def files_overlapping(
+        study_id: str,
+        start,
+        end,
+        participants: Optional[List[str]] = None,
+        kinds: Optional[List[str]] = None,
+        devices: Optional[List[str]] = None,
+        mirror: bool = False,
+        conn: Optional[DMPConnection] = None,
+):
+    """
+    List the files in a study whose recording overlaps the time window from start to end, as
+    list_files does (the records can be passed to download_files). start and end are ms stamps,
+    datetimes, dates or ISO strings; a date on its own covers that whole day, e.g.
+    files_overlapping(study_id, '2023-03-01', '2023-03-31', participants=['P00001'])
+    """
+    if mirror:
+        from dmpy.mirror import FileMirror
+        file_mirror = FileMirror(study_id)
+        file_mirror.refresh(conn or get_default_connection())
+        return file_mirror.list_files(participants=participants, kinds=kinds, devices=devices, start=start, end=end)
+    catalog = get_file_catalog(study_id, conn=conn)
+    if catalog is None:
+        return
+    return catalog.overlapping(start, end, participants=participants, kinds=kinds, devices=devices).to_records()
+
+
+def iter_files(
+        study_id: str,
+        participants: Optional[List[str]] = None,
+        kinds: Optional[List[str]] = None,
+        devices: Optional[List[str]] = None,
+        file_ids: Optional[List[str]] = None,
+        chunk_size: int = 10000,
+        conn: Optional[DMPConnection] = None,
+):
+    """
+    Yield the files of a study as list_files dictionaries while the listing downloads, parsing the
+    response incrementally (needs ijson) so memory stays bounded by chunk_size files
+    """
+    from dmpy.catalog import FileCatalog
+    conn = conn or get_default_connection()
+    entries = conn.graphql_stream("files", {"studyId": study_id}, 'data.getStudy.files')
+    while True:
+        chunk = list(itertools.islice(entries, chunk_size))
+        if not chunk:
+            return
+        catalog = FileCatalog.from_files(chunk)
+        yield from catalog.filter(participants=participants, kinds=kinds, devices=devices,
+                                  file_ids=file_ids).to_records()
+
+
+def get_file_content(file_id: str, stream: bool = True, decode: str = None, file_hash: str = None,
+                     use_cache: bool = True, conn: Optional[DMPConnection] = None):
+    conn = conn or get_default_connection()
+    cache = get_default_cache() if use_cache else None
+    if cache is not None:
+        with cache.open_file(conn, file_id, file_hash) as f:
+            content = f.read()
+        # decoded from bytes, as text mode would translate line endings
+        return content.decode(decode) if decode else content
     if decode:
-        return conn.get_file(file_id, stream=stream).decode(decode)
+        # decode chunk by chunk so the raw bytes and the text are never both held in full
+        return ''.join(codecs.iterdecode(conn.iter_file(file_id), decode))
     return conn.get_file(file_id, stream=stream)
 
 
-def archive_preview(file_id: str, file_name: str):
+def iter_file_content(file_id: str, file_hash: str = None, chunk_size: int = 1024 * 1024,
+                      use_cache: bool = True, conn: Optional[DMPConnection] = None):
+    """
+    Yield the content of a file in chunks. If file_hash is given (see 'fileHash' in list_files),
+    an exception is raised after the last chunk when the content does not match it
+    """
+    conn = conn or get_default_connection()
+    cache = get_default_cache() if use_cache else None
+    cached = cache.open_cached(file_id, file_hash) if cache is not None else None
+    if cached is not None:
+        with cached as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+        return
+    with conn.open_file(file_id, file_hash=file_hash) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def download_file(file_id: str, path: str, file_hash: str = None, resume: bool = True,
+                  use_cache: bool = True, conn: Optional[DMPConnection] = None):
+    """
+    Download a file to path with bounded memory, resuming a previous partial download
+    and verifying the content against file_hash
+    """
+    conn = conn or get_default_connection()
+    cache = get_default_cache() if use_cache else None
+    cached = cache.open_cached(file_id, file_hash) if cache is not None else None
+    if cached is not None:
+        with cached as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        return path
+    return conn.download_file(file_id, path, file_hash=file_hash, resume=resume)
+
+
+def _local_file_matches(path: str, file_hash: Optional[str], file_size) -> bool:
+    if not os.path.exists(path):
+        return False
+    if file_hash:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest() == file_hash
+    return file_size is not None and os.path.getsize(path) == int(file_size)
+
+
+def download_files(records: List[Dict[str, Any]], dest_dir: str, max_workers: int = 4, verbose: bool = True,
+                   conn: Optional[DMPConnection] = None):
+    """
+    Download the files returned by list_files into dest_dir with a bounded thread pool.
+
+    Files already in dest_dir with a matching hash are skipped. Files with the same name are
+    saved as <fileId>_<fileName>. Keep max_workers within the connection's pool_maxsize.
+
+    Returns a manifest with the 'succeeded', 'skipped' and 'failed' files plus the total
+    bytes, seconds and throughput (bytes per second) of the run.
+    """
+    conn = conn or get_default_connection()
+    os.makedirs(dest_dir, exist_ok=True)
+    names = [record['fileName'] or record['fileId'] for record in records]
+    duplicated = {name for name, count in Counter(names).items() if count > 1}
+    print_lock = threading.Lock()
+    done = [0]
+
+    def report(message: str):
+        if verbose:
+            with print_lock:
+                done[0] += 1
+                print(f"[{done[0]}/{len(records)}] {message}")
+
+    def download(record, name):
+        entry = {"fileId": record['fileId'], "fileName": record['fileName'],
+                 "path": os.path.join(dest_dir, f"{record['fileId']}_{name}" if name in duplicated else name)}
+        if _local_file_matches(entry['path'], record.get('fileHash'), record.get('fileSize')):
+            report(f"{Fore.LIGHTCYAN_EX}{name} already downloaded{Fore.RESET}")
+            return 'skipped', entry
+        start = time.perf_counter()
+        try:
+            download_file(record['fileId'], entry['path'], file_hash=record.get('fileHash'), conn=conn)
+        except Exception as e:
+            entry['error'] = str(e)
+            report(f"{Fore.LIGHTRED_EX}Failed to download {name}: {e}{Fore.RESET}")
+            return 'failed', entry
+        entry['seconds'] = time.perf_counter() - start
+        entry['bytes'] = os.path.getsize(entry['path'])
+        entry['throughput'] = entry['bytes'] / entry['seconds'] if entry['seconds'] else None
+        report(f"{Fore.LIGHTGREEN_EX}{name}{Fore.RESET} {entry['bytes'] / 1e6:.1f} MB in {entry['seconds']:.1f} s "
+               f"({(entry['throughput'] or 0) / 1e6:.1f} MB/s)")
+        return 'succeeded', entry
+
+    manifest = {"succeeded": [], "skipped": [], "failed": []}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download, record, name) for record, name in zip(records, names)]
+        for future in as_completed(futures):
+            status, entry = future.result()
+            manifest[status].append(entry)
+    manifest['seconds'] = time.perf_counter() - start
+    manifest['bytes'] = sum(entry['bytes'] for entry in manifest['succeeded'])
+    manifest['throughput'] = manifest['bytes'] / manifest['seconds'] if manifest['seconds'] else None
+    if verbose:
+        print(f"Downloaded {len(manifest['succeeded'])} files ({manifest['bytes'] / 1e6:.1f} MB) in "
+              f"{manifest['seconds']:.1f} s ({(manifest['throughput'] or 0) / 1e6:.1f} MB/s), "
+              f"{len(manifest['skipped'])} skipped, {len(manifest['failed'])} failed")
+    return manifest
+
+
+def archive_preview(file_id: str, file_name: str, file_hash: str = None, range_requests: bool = True,
+                    conn: Optional[DMPConnection] = None):
+    """
+    Print and return the member names of an archive. The central directory of a zip archive is
+    range-read from the server, so listing does not download the archive
+    """
+    conn = conn or get_default_connection()
     file_type = get_file_type(file_name)
-    file_stream = get_file_content(file_id)
-    compressed_data = BytesIO(file_stream)
-    if not file_type or file_type not in ["zip", "tar.gz", "rar", "7z"]:
+    if not file_type or file_type not in ARCHIVE_TYPES:
         print("Not an archive")
         return "Not an archive"
-    else:
-        if file_type == 'zip':
-            with zipfile.ZipFile(compressed_data) as zf:
-                print("ZIP file structure:")
-                for file_info in zf.infolist():
-                    print(file_info.filename)
-                return [file_info.filename for file_info in zf.infolist()]
-        elif file_type == 'tar.gz':
-            with tarfile.open(fileobj=compressed_data, mode='r:gz') as tar:
-                print("Tarred GZ file structure:")
-                for tar_info in tar:
-                    print(tar_info.name)
-                return [tar_info.filename for tar_info in tar]
-        elif file_type == 'rar':
-            with rarfile.RarFile(compressed_data) as rf:
-                print("RAR file structure:")
-                for rar_info in rf.infolist():
-                    print(rar_info.filename)
-                    return [rar_info.filename for rar_info in rf.infolist()]
-        elif file_type == '7z':
-            with py7zr.SevenZipFile(compressed_data, mode='r') as z:
-                print("7Z file structure:")
-                for name in z.getnames():
-                    print(name)
-                    return [name for name in z.getnames()]
-
-
-def stream_text_from_archive(file_id, file_name):
-    return stream_data_from_archive(file_id, file_name, data_type='text')
-
-
-def stream_data_from_archive(file_id, file_name, data_type='text'):
-    file_type = get_file_type(file_name)
-    file_stream = get_file_content(file_id)
-    compressed_data = BytesIO(file_stream)
-    if file_type == 'zip':
-        with zipfile.ZipFile(compressed_data) as zf:
-            for file_info in zf.infolist():
-                if file_info.filename.endswith('/'):
-                    continue
-                with zf.open(file_info, 'r') as file:
-                    try:
-                        if data_type == 'binary':
-                            data  = data = file.read()  # Read file as binary data
-                        elif data_type == 'text':
-                            data = StringIO(file.read().decode('utf-8'))
-                        yield file_info.filename, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)  # Reset file pointer
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            print(f"Failed to decode file {file_info.filename} in UTF-8 or ISO-8859-1: {e}")
-
-    elif file_type == 'tar.gz':
-        with tarfile.open(fileobj=compressed_data, mode='r:gz') as tar:
-            for tar_info in tar:
-                if tar_info.isfile():
-                    file = tar.extractfile(tar_info)
-                    try:
-                        if data_type == 'binary':
-                            data  = data = file.read()  # Read file as binary data
-                        elif data_type == 'text':
-                            data = StringIO(file.read().decode('utf-8'))
-                        yield tar_info.name, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)  # Reset file pointer
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            print(f"Failed to decode file {file_info.filename} in UTF-8 or ISO-8859-1: {e}")
-    elif file_type == '7z':
-        with py7zr.SevenZipFile(compressed_data, mode='r') as z:
-            for file_info in z.getnames():
-                if file_info.filename.endswith('/'):
-                    continue
-                try:
-                    with z.read(file_info) as file:
-                        if data_type == 'binary':
-                            data  = data = file.read()  # Read file as binary data
-                        elif data_type == 'text':
-                            data = StringIO(file.read().decode('utf-8'))
-                        yield file_info, z.data
-                except UnicodeDecodeError:
-                        try:
-                            file.seek(0)  # Reset file pointer
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            print(f"Failed to decode file {file_info.filename} in UTF-8 or ISO-8859-1: {e}")
-    elif file_type == 'rar':
-        with rarfile.RarFile(compressed_data) as rf:
-            for file_info in rf.infolist():
-                if file_info.filename.endswith('/'):
-                    continue
-                with rf.open(file_info, 'r') as file:
-                    try:
-                        if data_type == 'binary':
-                            data = file.read()  # Read file as binary data
-                        elif data_type == 'text':
-                            data = StringIO(file.read().decode('utf-8'))
-                        yield file_info.filename, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)  # Reset file pointer
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            print(f"Failed to decode file {file_info.filename} in UTF-8 or ISO-8859-1: {e}")
-
-def stream_text_from_specific_archive_file(file_id, file_name, sub_file_name: str = None):
-    file_type = get_file_type(file_name)
-    file_stream = get_file_content(file_id)
-    compressed_data = BytesIO(file_stream)
-    if file_type == 'zip':
-        with zipfile.ZipFile(compressed_data) as zf:
-            for file_info in zf.infolist():
-                if file_info.filename != sub_file_name:
-                    continue
-                if file_info.filename.endswith('/'):
-                    continue
-                with zf.open(file_info, 'r') as file:
-                    try:
-                        data = StringIO(file.read().decode('utf-8')).getvalue()
-                        return file_info.filename, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            return (f'Could not decode file {file_info.filename} in UTF-8 or ISO-8859-1')
-    elif file_type == 'tar.gz':
-        with tarfile.open(fileobj=compressed_data, mode='r:gz') as tar:
-            for tar_info in tar:
-                if tar_info.name != sub_file_name:
-                    continue
-                if tar_info.isfile():
-                    file = tar.extractfile(tar_info)
-                    try:
-                        data = StringIO(file.read().decode('utf-8')).getvalue()
-                        return tar_info.name, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            return (f'Could not decode file {file_info.filename} in UTF-8 or ISO-8859-1')
-    elif file_type == '7z':
-        with py7zr.SevenZipFile(compressed_data, mode='r') as z:
-            for file_info in z.getnames():
-                if file_info.filename != sub_file_name:
-                    continue    
-                try:
-                    with z.read(file_info) as file:
-                        data = StringIO(file.read().decode('utf-8')).getvalue()
-                        return file_info, z.data
-                except UnicodeDecodeError:
-                        try:
-                            file.seek(0)
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            return (f'Could not decode file {file_info.filename} in UTF-8 or ISO-8859-1')
-    elif file_type == 'rar':
-        with rarfile.RarFile(compressed_data) as rf:
-            for file_info in rf.infolist():
-                if file_info.filename != sub_file_name:
-                    continue
-                with rf.open(file_info, 'r') as file:
-                    try:
-                        data = StringIO(file.read().decode('utf-8')).getvalue()
-                        return file_info.filename, data
-                    except UnicodeDecodeError:
-                        try:
-                            file.seek(0)
-                            data = StringIO(file.read().decode('ISO-8859-1'))
-                            yield file_info.filename, data
-                        except Exception as e:
-                            return (f'Could not decode file {file_info.filename} in UTF-8 or ISO-8859-1')
-
-    return sub_file_name
-
-
-def upload_data(study_id: str, file_name: str, file_content: bytes, participant_id: str, device_id: str,
-                start_date: int, end_date: int):
-    conn = DMPConnection()
+    names = list_archive_members(conn, file_id, file_name, file_hash, range_requests=range_requests)
+    titles = {'zip': "ZIP", 'tar.gz': "Tarred GZ", 'rar': "RAR", '7z': "7Z"}
+    print(f"{titles[file_type]} file structure:")
+    for name in names:
+        print(name)
+    return names
+
+
+def stream_text_from_archive(file_id, file_name, file_hash: str = None, conn: Optional[DMPConnection] = None):
+    return stream_data_from_archive(file_id, file_name, data_type='text', file_hash=file_hash, conn=conn)
+
+
+def stream_data_from_archive(file_id, file_name, data_type='text', file_hash: str = None,
+                             encoding: str = None, conn: Optional[DMPConnection] = None):
+    """
+    Yield (member name, data) for each file in an archive, one member at a time.
+
+    data_type 'text' yields a StringIO, 'lines' an iterator over the member's lines, 'binary' bytes
+    and 'file' a file object that decompresses the member lazily. 'lines' and 'file' are valid until
+    the next member. Text is decoded chunk by chunk, detecting UTF-8 or ISO-8859-1 from the first
+    chunk unless an encoding is given (see dmpy.archive.iter_text).
+    """
+    conn = conn or get_default_connection()
+    for name, file in iter_archive_members(conn, file_id, file_name, file_hash):
+        if data_type == 'file':
+            yield name, file
+        elif data_type == 'binary':
+            yield name, file.read()
+        elif data_type == 'lines':
+            yield name, iter_lines(file, encoding=encoding)
+        elif data_type == 'text':
+            text = StringIO()
+            for chunk in iter_text(file, encoding=encoding):
+                text.write(chunk)
+            text.seek(0)
+            yield name, text
+
+
+def stream_frames_from_archive(file_id, file_name, chunk_rows: int = 100000, file_hash: str = None,
+                               encoding: str = None, processes: int = None, conn: Optional[DMPConnection] = None,
+                               **read_csv_kwargs):
+    """
+    Yield (member name, DataFrame) for the CSV or TSV members of an archive (device exports), each
+    member in chunks of up to chunk_rows rows, decoded as stream_data_from_archive does; extra
+    keyword arguments go to pandas.read_csv. With processes, the members of a zip or rar archive
+    are parsed in parallel in that many worker processes.
+    """
+    conn = conn or get_default_connection()
+    if processes and get_file_type(file_name) in ('zip', 'rar'):
+        yield from iter_member_frames_parallel(conn, file_id, file_name, file_hash, chunk_rows, encoding,
+                                               processes, **read_csv_kwargs)
+        return
+    for name, file in iter_archive_members(conn, file_id, file_name, file_hash):
+        for frame in read_member_frames(file, name, chunk_rows, encoding, **read_csv_kwargs):
+            yield name, frame
+
+
+def stream_text_from_specific_archive_file(file_id, file_name, sub_file_name: str = None, file_hash: str = None,
+                                           range_requests: bool = True, conn: Optional[DMPConnection] = None):
+    """
+    Return (member name, text) of one file in an archive, or None if the archive has no such member.
+    For zip archives only the central directory and the member are range-read from the server
+    """
+    conn = conn or get_default_connection()
+    data = read_archive_member(conn, file_id, file_name, sub_file_name, file_hash, range_requests=range_requests)
+    if data is None:
+        return None
+    return sub_file_name, decode_text(data)
+
+
+def _description_key(description: str):
+    try:
+        parsed = json.loads(description)
+    except (TypeError, ValueError):
+        return None
+    return tuple(parsed.get(key) for key in ("participantId", "deviceId", "startDate", "endDate"))
+
+
+def upload_data(study_id: str, file_name: str, file_content: Union[bytes, str, BinaryIO], participant_id: str,
+                device_id: str, start_date: int, end_date: int, conn: Optional[DMPConnection] = None):
+    """
+    Upload a file to a study. file_content can be bytes, a path or a binary file object; paths and
+    file objects are streamed from disk, and the file's length and hash are sent for verification
+    """
+    conn = conn or get_default_connection()
     variables = {
         'studyId': study_id,
         'file': None,
-        'description': json.dumps({
-                "participantId": participant_id,
-                "deviceId": device_id,
-                "startDate": start_date * 1000,
-                "endDate": end_date * 1000,
-            }
-        )
+        'description': file_description(participant_id, device_id, start_date, end_date)
     }
     try:
         response = conn.upload_file(file_name, file_content, variables)
-        print("Raw server response:",  response)
 
         if "error" in response or "errors" in response:
-            print(f"{Fore.LIGHTRED_EX}Error uploading file {file_name}: {response['error']}{Fore.RESET}")
-            print(response["errors"])
+            errors = response.get("errors") or response.get("error")
+            print(f"{Fore.LIGHTRED_EX}Error uploading file {file_name}: {errors}{Fore.RESET}")
             return
         print(f"{Fore.LIGHTGREEN_EX}File {file_name} uploaded successfully{Fore.RESET}")
 
@@ -344,21 +390,135 @@ def upload_data(study_id: str, file_name: str, file_content: bytes, participant_
     except Exception as e:
         print(f"{Fore.LIGHTRED_EX}Error uploading file {file_name}: {e}{Fore.RESET}")
 
-def get_study_fields(study_id: str, versionId=''):
-    conn = DMPConnection()
+
+def upload_files(study_id: str, uploads: List[Dict[str, Any]], max_workers: int = 4, verbose: bool = True,
+                 conn: Optional[DMPConnection] = None):
+    """
+    Upload many files to a study in parallel, skipping files the study already has.
+
+    Each upload is a dict with 'path', 'participantId', 'deviceId', 'startDate' and 'endDate'
+    (in seconds, as for upload_data) and optionally 'fileName'. The study's file list is fetched
+    once, and each worker hashes a local file and skips it when the study already has a file with
+    the same hash and description, or else uploads it. A file that cannot be read or uploaded is
+    reported as failed without stopping the others.
+
+    Returns a manifest with the 'uploaded' (including the new 'fileId'), 'skipped' (including the
+    existing 'fileId') and 'failed' (including the 'error') uploads.
+    """
+    conn = conn or get_default_connection()
+    all_files = conn.graphql_request("files", {"studyId": study_id})
+    if 'data' not in all_files:
+        raise Exception(f'Failed to list files in study {study_id}: {all_files.get("errors")}')
+    existing = {(f['hash'], _description_key(f['description'])): f['id']
+                for f in all_files['data']['getStudy']['files']}
+
+    print_lock = threading.Lock()
+
+    def upload_one(upload):
+        file_name = upload.get('fileName') or os.path.basename(upload['path'])
+        entry = {"path": upload['path'], "fileName": file_name, "hash": None}
+        # a file that cannot be read or described fails on its own, like a failed upload
+        try:
+            with open(upload['path'], 'rb') as f:
+                entry['hash'], file_length = hash_file(f)
+            description = file_description(upload['participantId'], upload['deviceId'],
+                                             upload['startDate'], upload['endDate'])
+            existing_id = existing.get((entry['hash'], _description_key(description)))
+            if existing_id is not None:
+                entry['fileId'] = existing_id
+                status, message = 'skipped', f"{Fore.LIGHTCYAN_EX}{file_name} already uploaded{Fore.RESET}"
+            else:
+                variables = {'studyId': study_id, 'file': None, 'description': description,
+                             'hash': entry['hash'], 'fileLength': file_length}
+                response = conn.upload_file(file_name, upload['path'], variables)
+                if response.get('errors'):
+                    raise Exception(response['errors'])
+                entry['fileId'] = response['data']['uploadFile']['id']
+                status, message = 'uploaded', f"{Fore.LIGHTGREEN_EX}File {file_name} uploaded successfully{Fore.RESET}"
+        except Exception as e:
+            entry['error'] = str(e)
+            status, message = 'failed', f"{Fore.LIGHTRED_EX}Error uploading file {file_name}: {e}{Fore.RESET}"
+        if verbose:
+            with print_lock:
+                print(message)
+        return status, entry
+
+    manifest = {"uploaded": [], "skipped": [], "failed": []}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(upload_one, upload) for upload in uploads]
+        for future in as_completed(futures):
+            status, entry = future.result()
+            manifest[status].append(entry)
+    return manifest
+
+
+def parse_device_file_name(name: str) -> Optional[Dict[str, Any]]:
+    """
+    Read participantId, deviceId, startDate and endDate (in seconds, the start of the first and the
+    end of the last day in UTC) from a <participantId>-<deviceId>-<YYYYMMDD>-<YYYYMMDD>.<ext> file
+    name, or return None if it does not follow the convention
+    """
+    parts = os.path.basename(name).split('.', 1)[0].split('-')
+    try:
+        participant_id, device_id, start, end = parts
+        start_date = datetime.strptime(start, "%Y%m%d").replace(tzinfo=timezone.utc)
+        end_date = datetime.strptime(end, "%Y%m%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return {
+        "participantId": participant_id,
+        "deviceId": device_id,
+        "startDate": int(start_date.timestamp()),
+        "endDate": int(end_date.timestamp()) + 24 * 3600 - 1,
+    }
+
+
+def upload_directory(study_id: str, directory: str, max_workers: int = 4, verbose: bool = True,
+                     conn: Optional[DMPConnection] = None):
+    """
+    Upload the device files in a directory with upload_files. File names must follow the
+    <participantId>-<deviceId>-<YYYYMMDD>-<YYYYMMDD>.<ext> convention; the dates are taken as the
+    start of the first day and the end of the last day in UTC. Other files are ignored with a warning.
+    """
+    uploads = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        upload = parse_device_file_name(name)
+        if upload is None:
+            print(f"{Fore.YELLOW}Skipping {name}: not named <participant>-<device>-<start>-<end>{Fore.RESET}")
+            continue
+        uploads.append(dict(upload, path=path))
+    return upload_files(study_id, uploads, max_workers=max_workers, verbose=verbose, conn=conn)
+
+
+def get_study_fields(study_id: str, versionId='', use_cache: bool = True, conn: Optional[DMPConnection] = None):
+    """
+    Return the fields of a study. Results are kept in the process-wide FieldCache for its TTL and
+    dropped when fields are created or deleted through dmpy; pass use_cache=False to always ask the server.
+    """
+    conn = conn or get_default_connection()
+    cache = get_default_field_cache() if use_cache else None
+    if cache is not None:
+        fields = cache.get(conn.host, study_id, versionId)
+        if fields is not None:
+            return fields
     variables = {
         "studyId": study_id,
     }
     if versionId == None:
         variables['versionId'] = None
     study_fields = conn.graphql_request('study_fields', variables)
-    return study_fields['data']['getStudyFields']
+    fields = study_fields['data']['getStudyFields']
+    if cache is not None:
+        cache.put(conn.host, study_id, versionId, fields)
+    return fields
 
 
 def create_new_field(study_id: str, field_id: str, field_name: str, data_type: str, possible_values: List = None,
-                     unit: str = None, comments: str = None, table_name: str = None):
-    if data_type == "cat" and possible_values is None:
-        raise Exception("possible values needed when data_type is 'cat'")
+                     unit: str = None, comments: str = None, table_name: str = None,
+                     conn: Optional[DMPConnection] = None):
     field_input = {
         "fieldId": field_id,
         "fieldName": field_name,
@@ -372,54 +532,156 @@ def create_new_field(study_id: str, field_id: str, field_name: str, data_type: s
         field_input["comments"] = comments
     if table_name:
         field_input["tableName"] = table_name
-    variables = {
-        "studyId": study_id,
-        "fieldInput": field_input
-    }
-    conn = DMPConnection()
-    response = conn.graphql_request('create_field', variables)
-    if 'errors' in response:
-        raise Exception(response['errors'])
-    return response['data']['createNewField']
+    return create_new_fields(study_id, [field_input], conn=conn)
+
+
+def create_new_fields(study_id: str, field_inputs: List[Dict[str, Any]], chunk_size: int = 500,
+                      conn: Optional[DMPConnection] = None):
+    """
+    Create many fields at once. Each field is a FieldInput dict (fieldId, fieldName, dataType and
+    optionally possibleValues, unit, comments, tableName). The whole list is validated before
+    anything is sent, then created with one mutation per chunk_size fields. Returns the
+    createNewField responses of all chunks, concatenated.
+    """
+    problems = validate_field_inputs(field_inputs)
+    if problems:
+        raise Exception('\n'.join(problems))
+    conn = conn or get_default_connection()
+    results = []
+    try:
+        for start in range(0, len(field_inputs), chunk_size):
+            variables = {
+                "studyId": study_id,
+                "fieldInput": field_inputs[start:start + chunk_size]
+            }
+            response = conn.graphql_request('create_field', variables)
+            if 'errors' in response:
+                raise Exception(response['errors'])
+            results.extend(response['data']['createNewField'])
+    finally:
+        get_default_field_cache().invalidate(conn.host, study_id)
+    return results
 
 
 def get_data_records(study_id: str, 
                      field_ids: List[str] = None, 
                      data_format: str = None, 
                      version_id: str = '0',
-                     table_requested: str = None):
-    conn = DMPConnection()
-    variables = {
-        "studyId": study_id,
-        "queryString": {
-            "data_requested": field_ids,
-            "format": "raw",
-            "new_fields": None,
-            "cohort": None,
-        }
-    }
+                     table_requested: str = None,
+                     as_dataframe: bool = False,
+                     layout: str = 'wide',
+                     use_cache: bool = True,
+                     conn: Optional[DMPConnection] = None):
+    """
+    Return the data records of a study as {subject: {visit: {field: value}}}, or with as_dataframe
+    as a typed DataFrame in the given layout (see get_data_records_df). Only raw records can be
+    decoded into a DataFrame, so as_dataframe raises with another data_format or a table_requested.
+    Results are kept in the on-disk RecordCache unless use_cache is False.
+    """
+    if as_dataframe:
+        if data_format not in (None, 'raw') or table_requested:
+            raise Exception(f'as_dataframe only decodes raw records, not data_format {data_format!r} '
+                            f'with table_requested {table_requested!r}')
+        return get_data_records_df(study_id, field_ids=field_ids, version_id=version_id, layout=layout,
+                                   use_cache=use_cache, conn=conn)
+    conn = conn or get_default_connection()
+    query = dict(study_id=study_id, field_ids=field_ids, data_format=data_format, version_id=version_id,
+                 table_requested=table_requested)
+    return _fetch_data_records(conn, [query], use_cache)[0]
+
+
+def _fetch_data_records(conn: DMPConnection, queries: List[Dict[str, Any]], use_cache: bool):
+    """
+    Run get_data_records queries through the record cache, fetching the ones not cached in one batch
+    """
+    cache = get_default_record_cache() if use_cache else None
+    keys = [cache.key(conn.host, **query) for query in queries] if cache is not None else [None] * len(queries)
+    results = [cache.get(key) for key in keys] if cache is not None else [None] * len(queries)
+    missing = [position for position, result in enumerate(results) if result is None]
+    if missing:
+        responses = conn.graphql_batch([('data_records', data_records_variables(**queries[position]))
+                                        for position in missing])
+        for position, response in zip(missing, responses):
+            results[position] = response['data']['getDataRecords']["data"]
+            if cache is not None and results[position] is not None:
+                cache.put(keys[position], results[position])
+    return results
+
+
+def get_data_records_df(study_id: str,
+                        field_ids: List[str] = None,
+                        version_id: str = '0',
+                        layout: str = 'wide',
+                        fields: Optional[List[dict]] = None,
+                        use_cache: bool = True,
+                        conn: Optional[DMPConnection] = None) -> 'pd.DataFrame':
+    """
+    Return the raw data records of a study as a DataFrame, with each field's column typed from its
+    dataType (int, dec, date, or cat with possibleValues as categories). layout='wide' gives a row
+    per subject and visit and a column per field, layout='long' a row per value. The study fields
+    are fetched in the same request as the records unless given or cached.
+    """
+    from dmpy.records import records_to_frame
+    conn = conn or get_default_connection()
+    query = dict(study_id=study_id, field_ids=field_ids, version_id=version_id)
+    if fields is None and use_cache:
+        fields = get_default_field_cache().get(conn.host, study_id, '')
+    record_cache = get_default_record_cache() if use_cache else None
+    records = record_cache.get(record_cache.key(conn.host, **query)) if record_cache is not None else None
+    if fields is None and records is None:
+        study_fields, data_records = conn.graphql_batch([('study_fields', {"studyId": study_id}),
+                                                        ('data_records', data_records_variables(**query))])
+        if 'errors' in study_fields:
+            raise Exception(study_fields['errors'])
+        if 'errors' in data_records:
+            raise Exception(data_records['errors'])
+        fields = study_fields['data']['getStudyFields']
+        records = data_records['data']['getDataRecords']["data"]
+        get_default_field_cache().put(conn.host, study_id, '', fields)
+        if record_cache is not None:
+            record_cache.put(record_cache.key(conn.host, **query), records)
+    if fields is None:
+        fields = get_study_fields(study_id, use_cache=use_cache, conn=conn)
+    if records is None:
+        records = _fetch_data_records(conn, [query], use_cache)[0]
+    return records_to_frame(records, fields, layout=layout)
+
+
+def iter_data_records(study_id: str,
+                      field_ids: List[str] = None,
+                      data_format: str = None,
+                      version_id: str = '0',
+                      table_requested: str = None,
+                      conn: Optional[DMPConnection] = None):
+    """
+    Yield (subject id, {visit: {field: value}}) pairs of get_data_records while the response
+    downloads, parsing it incrementally (needs ijson) so only one subject is held in memory
+    """
+    conn = conn or get_default_connection()
+    variables = data_records_variables(study_id, field_ids, data_format, version_id, table_requested)
+    yield from conn.graphql_stream('data_records', variables, 'data.getDataRecords.data', pairs=True)
 
-    if data_format:
-        variables["queryString"]["format"] = data_format
-    if not version_id:
-        variables["versionId"] = None
-    if version_id == '-1':
-        variables["versionId"] = version_id
-    if table_requested:
-        variables["queryString"]["table_requested"] = table_requested
 
-    data_records = conn.graphql_request('data_records', variables)
-    return data_records['data']['getDataRecords']["data"]
+def get_data_records_batch(queries: List[Dict[str, Any]], use_cache: bool = True,
+                           conn: Optional[DMPConnection] = None):
+    """
+    Run several get_data_records queries in one request. Each query is a dict of get_data_records
+    arguments (study_id, field_ids, data_format, version_id, table_requested); the results are
+    returned in the same order. Queries found in the RecordCache are not sent.
+    """
+    conn = conn or get_default_connection()
+    return _fetch_data_records(conn, queries, use_cache)
 
 
-def upload_data_in_array(study_id: str, data: List[dict]):
-    conn = DMPConnection()
+def upload_data_in_array(study_id: str, data: List[dict], conn: Optional[DMPConnection] = None):
+    conn = conn or get_default_connection()
     variables = {
         'studyId': study_id,
         'data': data
     }
     try:
         response = conn.graphql_request('upload_data_in_array', variables)
+        _invalidate_data_records(conn, study_id)
         # if "error" in response:
         #     print(f"{Fore.LIGHTRED_EX}Error uploading data: {response['error']}{Fore.RESET}")
         # else:
@@ -429,192 +691,132 @@ def upload_data_in_array(study_id: str, data: List[dict]):
         print(f"{Fore.LIGHTRED_EX}Error uploading data: {e}{Fore.RESET}")
 
 
-def delete_study_field(study_id: str, field_id: str):
-    conn = DMPConnection()
+def _invalidate_data_records(conn: DMPConnection, study_id: str):
+    cache = get_default_record_cache()
+    if cache is not None:
+        cache.invalidate(conn.host, study_id)
+
+
+PERMANENT_CLIP_ERRORS = {"CLIENT_MALFORMED_INPUT", "NO_PERMISSION_ERROR", "CLIENT_ACTION_ON_NON_EXISTENT_ENTRY"}
+
+
+def _clip_chunks(positions: List[int], data: List[dict], chunk_size: int, max_chunk_bytes: Optional[int]):
+    """
+    Split clip positions into chunks of at most chunk_size clips and, if given, about max_chunk_bytes of JSON
+    """
+    chunk, chunk_bytes = [], 0
+    for position in positions:
+        size = len(json.dumps(data[position])) + 1 if max_chunk_bytes else 0
+        if chunk and (len(chunk) >= chunk_size or (max_chunk_bytes and chunk_bytes + size > max_chunk_bytes)):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(position)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def upload_data_in_array_chunked(study_id: str, data: List[dict], chunk_size: int = 1000,
+                                 max_chunk_bytes: Optional[int] = None, max_workers: int = 4,
+                                 max_attempts: int = 3, backoff_factor: float = 1.0, verbose: bool = True,
+                                 conn: Optional[DMPConnection] = None):
+    """
+    Upload data clips in chunks of at most chunk_size clips (and max_chunk_bytes of JSON), sending
+    up to max_workers chunks at once. Clips the server reports as unsuccessful, and whole chunks
+    whose request failed or timed out, are sent again up to max_attempts times in total, with
+    exponential backoff; clips rejected as malformed or not permitted are not retried.
+
+    Returns a report with the number of 'total' and 'succeeded' clips, the 'failed' clips (each
+    with its 'index' in data, 'clip', 'code' and 'description'), and the 'attempts', 'requests' and
+    'seconds' it took.
+    """
+    conn = conn or get_default_connection()
+    started = time.time()
+    failures: Dict[int, dict] = {}
+    pending = list(range(len(data)))
+    report = {"total": len(data), "succeeded": 0, "failed": [], "attempts": 0, "requests": 0, "seconds": 0.0}
+
+    def send(chunk):
+        variables = {'studyId': study_id, 'data': [data[position] for position in chunk]}
+        try:
+            response = conn.graphql_request('upload_data_in_array', variables)
+            results = (response.get('data') or {}).get('uploadDataInArray')
+            if response.get('errors') or not isinstance(results, list) or len(results) != len(chunk):
+                raise Exception(response.get('errors') or 'unexpected uploadDataInArray response')
+        except Exception as e:
+            return [(position, {"code": None, "description": str(e)}, True) for position in chunk]
+        return [(position, result, result.get('code') not in PERMANENT_CLIP_ERRORS)
+                for position, result in zip(chunk, results) if not result.get('successful')]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending and report["attempts"] < max_attempts:
+            if report["attempts"]:
+                time.sleep(backoff_factor * 2 ** (report["attempts"] - 1))
+            report["attempts"] += 1
+            chunks = list(_clip_chunks(pending, data, chunk_size, max_chunk_bytes))
+            report["requests"] += len(chunks)
+            round_failures, retry = {}, []
+            for failed in executor.map(send, chunks):
+                for position, result, retryable in failed:
+                    round_failures[position] = result
+                    if retryable:
+                        retry.append(position)
+            for position in pending:
+                if position in round_failures:
+                    failures[position] = round_failures[position]
+                else:
+                    failures.pop(position, None)
+            pending = sorted(retry)
+
+    _invalidate_data_records(conn, study_id)
+    report["failed"] = [{"index": position, "clip": data[position], "code": result.get("code"),
+                         "description": result.get("description")} for position, result in sorted(failures.items())]
+    report["succeeded"] = len(data) - len(failures)
+    report["seconds"] = time.time() - started
+    if verbose:
+        color = Fore.LIGHTRED_EX if failures else Fore.LIGHTGREEN_EX
+        print(f"{color}Uploaded {report['succeeded']}/{report['total']} clips in {report['requests']} requests "
+              f"({report['attempts']} attempts, {report['seconds']:.1f}s){Fore.RESET}")
+    return report
+
+
+def delete_study_field(study_id: str, field_id: str, conn: Optional[DMPConnection] = None):
+    conn = conn or get_default_connection()
     variables = {
         "studyId": study_id,
         "fieldId": field_id
     }
     response = conn.graphql_request('deleteField', variables)
+    get_default_field_cache().invalidate(conn.host, study_id)
     print(response)
     return response['data']['deleteField']
 
 
 # the following functions are used temporarily
-def fetch_adam_data(study_id: str, domain: str):
+def fetch_adam_data(study_id: str, domain: str, conn: Optional[DMPConnection] = None):
     """
     Fetches and returns data related to the specified study and domain.
 
     Parameters:
     study_id (str): The unique identifier of the study.
     domain (str): The domain from which to fetch data. Available options:
-            ADDI
+            ADDI, and the domains of dmpy.adam.ADAM_DOMAINS (ADPRO, ADCL, ADSL)
+    conn (DMPConnection): The connection to use, defaults to the process-wide connection.
 
     Returns:
     Data related to the study and domain. The type and structure of the data
     depend on the domain specified.
     """
-    ATUP_mapping = {
-        "1": "Start of TUP 1",
-        "2": "End of TUP 1",
-        "3": "Start of TUP 2",
-        "4": "End of TUP 2",
-        "5": "Start of TUP 3",
-        "6": "End of TUP 3",
-        "7": "Start of TUP 4",
-        "8": "End of TUP 4",
-    }
-
-    derived_fields = ["1144", "1167", "derived_Demographics_Region", "derived_Demographics_Country", "derived_Demographics_Country", "1168", "dataset_id", "derived_Demographics_BMI", "1145", "1151", "derived_Demographics_Age", "derived_Demographics_AgeCat", "1148", "1146", "1141", "1143", "NONE", "derived_FACITF_score", "derived_fVAS_fvas", "derived_mMFS_score", "695", "derived_ESS_score", "derived_sqVAS_sqvas", "derived_MOSSS_SLPD4", "derived_MOSSS_SLPSNR1", "derived_MOSSS_SLPSOB1", "derived_MOSSS_SLPA2", "derived_MOSSS_SLPS3", "derived_MOSSS_SLP6", "derived_MOSSS_SLP9", "derived_MOSSS_SLPQRAW", "derived_MOSSS_SLPOP1", "1241", "1242", "1249", "1250", "1235", "1236", "NONE", "derived_MDSUPDRSII_mdsupdrs2_score", "derived_MDSUPDRSII_disease_severity_cat_id", "derived_MDSUPDRSIII_mdsupdrs3_score", "derived_MDSUPDRSIII_disease_severity_cat_id", "derived_UHDRS_tfc_score", "derived_UHDRS_disease_severity_cat_id", "derived_ESSDAI_ESSDAI_score", "derived_ESSDAI_disease_severity_cat_id", "derived_SLEDAI2K_SLEDAI_score", "derived_SLEDAI2K_disease_severity_cat_id", "derived_DiseaseActivityScore_DAS28_CRP", "derived_DiseaseActivityScore_disease_severity_cat_id", "derived_LabParameters_calprotectin", "derived_LabParameters_disease_severity_cat_id","derived_FACITF_DateofAssessment", "derived_fVAS_DateofAssessment", "derived_mMFS_DateofAssessment", "derived_KSS_DateofAssessment", "derived_ESS_DateofAssessment","derived_sqVAS_DateofAssessment","derived_MOSSS_DateofAssessment","derived_PGIF_DateofAssessment","derived_PGISQ_DateofAssessment","derived_PGIDS_DateofAssessment",
-            "derived_SubjectgroupCharacterisation_timesincediagnosis", "derived_TUP1_start_date", "derived_TUP2_start_date","derived_TUP3_start_date","derived_TUP4_start_date","derived_TUP1_stop_date","derived_TUP2_stop_date","derived_TUP3_stop_date","derived_TUP4_stop_date", "derived_Demographics_DateofAssessment"
-        ]
-
+    from dmpy.adam import ADAM_DOMAINS, build_addi
     default_version = None
     if domain == 'ADDI':
-        addi_data = get_data_records(
-            study_id=study_id,
-            field_ids=["derived_ADDI"],
-            version_id=default_version
-        )
-        dataset_id_data = get_data_records(
-            study_id=study_id,
-            field_ids=['dataset_id'],
-            version_id=default_version
-        )
-        dataframe = []
-        desired_order = ['USUBJID', 'STUDYID', 'ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'ATM', 'TIMING', 'AVAL', 'AVALC', 'PARAM', 'PARAMCD']
-        dataframe.append(desired_order)
-        param_mapping = {
-            'ACTIVI01': "Where were you mainly in the last hour, inside, outside, motorised transport (bus, car, train?)",
-            'ACTIVI02': "Were you mainly doing (employed) work or studies, yes, no.",
-            'ACTIVI03': "Were you mostly on a break during your last hour of (paid) work or studies, yes, no.",
-            'ACTIVI04': "Mark on the line the level of physical activity during this time, 0 = low physical activity (desk work), 100 = High physical activity (physical work)",
-            'ACTIVI05': "What activity have you mainly done in the last hour, Housekeeping/Gardening",
-            'ACTIVI06': "What activity have you mainly done in the last hour, Shopping, Walking, Sports incl. cycling, Gardening, Relaxing, Social interaction/events",
-            'DIARY01': "How fatigued to you feel overall, 0 = Not at all fatigued, 100 = worst possible fatigued",
-            'DIARY02': "How fatigued to you feel physically, 0 = Not at all fatigued physically, 100 = worst possible fatigued physically",
-            'DIARY03': "How fatigued to you feel mentally, 0 = Not at all fatigued mentally, 100 = worst possible fatigued mentally",
-            'DIARY04': "How anxious do you feel, 0 = No at all anxious, 100 = worst possible anxiousness",
-            'DIARY05': "How low is your mood, 0 = My mood is not low at all, 100 = Lowest possible mood",
-            'DIARY06': "How much pain are you having, 0 = No pain at all, 100 = Worst possible pain",
-            'DIARY07': "How was your sleep last night 0 = Best possible sleep, 100 = Worst possible sleep",
-            'DIARY08': "Please choose the response below that best describes your sleep quality last night, 1 = No sleep problems, 2 = Mild sleep problems, 3 = Moderate sleep problems, 4 = Severe sleep problems, 5 = Very severe sleep problems",
-            'DIARY09': "Please choose the response below that best describes the overall change in your sleep quality today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse",
-            'KSS': "How do you feel at the moment, where 1 = extremely alert, 2 = very alert, 3 = alert, 4 = rather alert, 5 = neither alert nor sleepy, 6 = some signs of sleepiness, 7 = sleepy, but no effort to keep awake, 8 = sleepy, but some effort to keep awake,",
-            'MOBILY01': "How do you rate your mobility with regard to stiffness, rigidity and/or slowness that affects your daily life within this last hour, 0 =Normal, -1 = Mild impaired mobility, -2 = Moderately impaired mobility, -3 Severely impaired mobility",
-            'MOBILY02': "How do you rate your mobility with regard to involuntary extra movements that affects your daily life within this last hour, 0 = Normal, 1 = Mild dyskinesia, 2 = Moderate dyskinesia, 3 = Severe dyskinesia",
-            'PGISCE1': "Please choose the response below that best describes the severity of your overall fatigue in the past 24 hours, 1 = No fatigue, 2 ? Mild fatigue, 3 = Moderate fatigue, 4 = Severe fatigue, 5 = Very severe fatigue",
-            'PGISCE2': "Please choose the response below that best described the change in your overall fatigue today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse",
-            'PGISCE3': "Please choose the response below that best describes the severity of your daytime sleepiness in the past 24 hours, 1 = No daytime sleepiness, 2 = Mild daytime sleepiness, 3 = Moderate daytime sleepiness, 4 = Severe daytime sleepiness, 5 = Very severe daytime sleepiness",
-            'PGISCE4': "Please choose the response below that best describes the change in your daytime sleepiness today compared to yesterday, 1= Very much improved, 2 = Much improved, 3 = Minimally improved, 4 = No change, 5 ? Minimally worse, 6 = Much worse, 7 = Very much worse"
-        }
-
-        for subjectId in addi_data:
-            for visitId in addi_data[subjectId]:
-                if visitId == '0':
-                    continue
-                tmp = [subjectId, 'IDEAFAST COS']
-                if dataset_id_data.get(subjectId, {}).get(visitId):
-                    if dataset_id_data[subjectId][visitId]['dataset_id'] == '1':
-                        tmp.append('ISA')
-                    elif dataset_id_data[subjectId][visitId]['dataset_id'] == '2':
-                        tmp.append('ESA')
-                    else:
-                        tmp.append('')
-                else:
-                    tmp.append('')
-                tmp.append(str(visitId))
-                tmp.append('Visit ' + str(visitId))
-                tmp.append('TUP ' + str(math.ceil(int(visitId) / 2)))
-                tmp.append(ATUP_mapping[str(visitId)])
-
-                # print(addi_data[subjectId][visitId], type(addi_data[subjectId][visitId]))
-                data_clip = json.loads(json.loads(addi_data[subjectId][visitId]['derived_ADDI']).replace("'", '"'))
-                # print(type(data_clip), data_clip)
-                for item in data_clip:
-                    tmp1 = copy.deepcopy(tmp)
-                    tmp1.append(item['ADT'])
-                    tmp1.append(item['ATM'])
-                    tmp1.append(item['TIMING'])
-                    for key in list(param_mapping.keys()):
-                        if key in item:
-                            tmp2 = copy.deepcopy(tmp1)
-                        else:
-                            continue
-                        tmp2.append(item[key])
-                        tmp2.append(item[str(key)])
-                        tmp2.append(param_mapping[key])
-                        tmp2.append(key)
-                        dataframe.append(tmp2)
-        df = pd.DataFrame(dataframe)
-        return df
-    elif domain == 'ADPRO':
-        desired_order = ['USUBJID', 'STUDYID', 'ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'ADY', 'AVAL', 'AVALC', 'FORMID', 'FORMNAME', 'PARAM', 'PARAMCD']
-        format1 = "%Y-%m-%dT%H:%M:%S.%f"
-        format2 = "%Y-%m-%d %H:%M:%S"
-        adpro_data = get_data_records(
-            study_id=study_id,
-            field_ids=derived_fields,
-            data_format="standardized-cdisc:adam:adpro",
-            version_id="-1"
-        )
-
-
-        for item in adpro_data['ADPRO']:
-            for key in desired_order:
-                if key not in item:
-                    item[key] = ''
-        tup_data = get_data_records(
-            study_id=study_id,
-            field_ids=['derived_TUP1_start_date', 'derived_TUP2_start_date', 'derived_TUP3_start_date', 'derived_TUP4_start_date'],
-            version_id="-1"
-        )
-        for item in adpro_data['ADPRO']:
-            subjectId = item['USUBJID']
-            visitId = item['VISITNUM']
-            ADT = item['ADT']
-            if subjectId and visitId and ADT and subjectId in tup_data:
-                tup_key = 'derived_TUP' + str(int(math.ceil(int(visitId)/2))) + '_start_date'
-                result = 'NA'
-                if tup_key in tup_data[subjectId]['0']:
-                    time1_dt = datetime.strptime(ADT, format1)
-                    time2_dt = datetime.strptime(tup_data[subjectId]['0'][tup_key], format2)
-                    # Calculate the difference
-                    if time1_dt < time2_dt:
-                        result = "Invalid"
-                    else:
-                        difference = time1_dt - time2_dt
-                        # You can format the difference as needed
-                        result = str(difference)
-            item['ADY'] = result
-        df = pd.DataFrame(adpro_data['ADPRO'])
-        return df[desired_order]
-    elif domain == 'ADCL':
-        desired_order = ['USUBJID','STUDYID','ANALYSISSET', 'VISITNUM', 'AVISIT', 'TUPNUM', 'ATUP', 'ADT', 'AVAL', 'AVALC', 'FORMID', 'FORMNAME', 'PARAM', 'PARAMCD']
-        adcl_data = get_data_records(
-            study_id=study_id,
-            field_ids=derived_fields,
-            data_format="standardized-cdisc:adam:adcl",
-            version_id="-1"
-        )
-        for item in adcl_data['ADCL']:
-            for key in desired_order:
-                if key not in item:
-                    item[key] = ''
-        df = pd.DataFrame(adcl_data['ADCL'])
-        return df[desired_order]
-    elif domain == 'ADSL':
-        desired_order = ['USUBJID','SITE','REGION','COUNTRY','STUDYID','COHORT','DEMOCOLLDTC','ANALYSISSET','BMI','HEIGHT','WEIGHT','AGE','AGEU','AGECAT','GENDER','OCCUPATION','EDUCATION','ETHNICITY','TIMESINCEDIAG','TUP1DT','TUP1TZ','TUP2DT','TUP2TZ','TUP3DT','TUP3TZ','TUP4DT','TUP4TZ']
-        adsl_data = get_data_records(
-            study_id=study_id,
-            field_ids=derived_fields,
-            data_format="standardized-cdisc:adam:adsl",
-            version_id="-1"
-        )
-        for item in adsl_data['ADSL']:
-            for key in desired_order:
-                if key not in item:
-                    item[key] = ''
-        df = pd.DataFrame(adsl_data['ADSL'])
-        return df[desired_order]
+        addi_data, dataset_id_data = get_data_records_batch([
+            dict(study_id=study_id, field_ids=["derived_ADDI"], version_id=default_version),
+            dict(study_id=study_id, field_ids=['dataset_id'], version_id=default_version),
+        ], conn=conn)
+        return build_addi(addi_data, dataset_id_data)
+    adam_domain = ADAM_DOMAINS.get(domain)
+    if adam_domain is None:
+        return
+    return adam_domain.build(get_data_records_batch(adam_domain.queries(study_id), conn=conn))
     
@@ -0,0 +1,93 @@
+from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+import os
+
+FIELD_DATA_TYPES = ["int", "dec", "str", "bool", "date", "file", "json", "cat"]
+FIELD_INPUT_KEYS = ["fieldId", "fieldName", "tableName", "dataType", "possibleValues", "unit", "comments"]
+
+
+class FieldCache:
+    def __init__(self, ttl: Optional[float] = None):
+        """
+        An in-memory cache of study field lists keyed by portal, study and version. Entries expire
+        after ttl seconds (DMP_FIELD_CACHE_TTL, default 300); a ttl of 0 disables the cache.
+        """
+        if ttl is None:
+            ttl = float(os.environ.get('DMP_FIELD_CACHE_TTL', 300))
+        self.ttl = ttl
+        self._entries: Dict[Tuple[str, str, Any], Tuple[float, List[dict]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str, study_id: str, version_id: Any) -> Optional[List[dict]]:
+        with self._lock:
+            entry = self._entries.get((host, study_id, version_id))
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[(host, study_id, version_id)]
+                return None
+            return list(entry[1])
+
+    def put(self, host: str, study_id: str, version_id: Any, fields: List[dict]):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(host, study_id, version_id)] = (time.monotonic(), list(fields))
+
+    def invalidate(self, host: Optional[str] = None, study_id: Optional[str] = None):
+        """
+        Drop the cached fields of a study (all versions), of every study on a portal, or everything
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if (host is None or key[0] == host) and (study_id is None or key[1] == study_id):
+                    del self._entries[key]
+
+
+def validate_field_inputs(field_inputs: List[Dict[str, Any]]) -> List[str]:
+    """
+    Check a list of FieldInput dicts before sending them and return the problems found, if any
+    """
+    problems = []
+    seen = set()
+    for position, field_input in enumerate(field_inputs):
+        field_id = field_input.get("fieldId")
+        name = f"field {field_id}" if field_id else f"field #{position}"
+        for key in ("fieldId", "fieldName", "dataType"):
+            if not field_input.get(key):
+                problems.append(f"{name}: {key} is required")
+        unknown = set(field_input) - set(FIELD_INPUT_KEYS)
+        if unknown:
+            problems.append(f"{name}: unknown keys {', '.join(sorted(unknown))}")
+        data_type = field_input.get("dataType")
+        if data_type and data_type not in FIELD_DATA_TYPES:
+            problems.append(f"{name}: dataType must be one of {', '.join(FIELD_DATA_TYPES)}, got {data_type}")
+        possible_values = field_input.get("possibleValues")
+        if data_type == "cat" and not possible_values:
+            problems.append(f"{name}: possible values needed when data_type is 'cat'")
+        if possible_values and any(not isinstance(value, dict) or value.get("code") is None
+                                   for value in possible_values):
+            problems.append(f"{name}: each possible value needs a code")
+        if field_id in seen:
+            problems.append(f"{name}: duplicate fieldId")
+        seen.add(field_id)
+    return problems
+
+
+_default_field_cache: Optional[FieldCache] = None
+_default_field_cache_lock = threading.Lock()
+
+
+def get_default_field_cache() -> FieldCache:
+    global _default_field_cache
+    with _default_field_cache_lock:
+        if _default_field_cache is None:
+            _default_field_cache = FieldCache()
+        return _default_field_cache
+
+
+def set_default_field_cache(cache: Optional[FieldCache]):
+    global _default_field_cache
+    with _default_field_cache_lock:
+        _default_field_cache = cache
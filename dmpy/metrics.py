@@ -0,0 +1,173 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import threading
+import bisect
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile from the bucket counts (the upper bound of the bucket it falls in)
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Operation:
+    def __init__(self, buckets: Sequence[float]):
+        self.seconds = _Histogram(buckets)
+        self.ttfb = _Histogram(buckets)
+        self.parse_seconds = 0.0
+        self.statuses: Dict[str, int] = {}
+        self.errors = 0
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+class MetricsAggregator:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        Collect the events of DMPConnection hooks into per-operation histograms of wall time and
+        time to first byte, with status counts, retries, bytes and the time spent parsing responses:
+
+            metrics = MetricsAggregator()
+            conn = DMPConnection(hooks=[metrics])
+            ...
+            metrics.print_summary()
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._operations: Dict[Tuple[str, str], _Operation] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Dict[str, Any]):
+        key = (event.get('kind') or '', event.get('operation') or '')
+        with self._lock:
+            operation = self._operations.get(key)
+            if operation is None:
+                operation = self._operations[key] = _Operation(self.buckets)
+            if event.get('seconds') is not None:
+                operation.seconds.observe(event['seconds'])
+            if event.get('ttfb') is not None:
+                operation.ttfb.observe(event['ttfb'])
+            status = str(event['status']) if event.get('status') is not None else 'none'
+            operation.statuses[status] = operation.statuses.get(status, 0) + 1
+            operation.errors += bool(event.get('error')) or (event.get('status') or 0) >= 400 or status == 'none'
+            operation.retries += event.get('retries') or 0
+            operation.request_bytes += event.get('request_bytes') or 0
+            operation.response_bytes += event.get('response_bytes') or 0
+            operation.parse_seconds += event.get('parse_seconds') or 0.0
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        Return one dict per operation with request and error counts, mean, p50, p95 and max wall
+        time and time to first byte, total parse time, retries and bytes, slowest operations first
+        """
+        with self._lock:
+            rows = []
+            for (kind, name), operation in self._operations.items():
+                seconds, ttfb = operation.seconds, operation.ttfb
+                rows.append({
+                    'kind': kind,
+                    'operation': name,
+                    'requests': sum(operation.statuses.values()),
+                    'errors': operation.errors,
+                    'statuses': dict(operation.statuses),
+                    'retries': operation.retries,
+                    'seconds_total': seconds.total,
+                    'seconds_mean': seconds.total / seconds.count if seconds.count else 0.0,
+                    'seconds_p50': seconds.quantile(0.5),
+                    'seconds_p95': seconds.quantile(0.95),
+                    'seconds_max': seconds.max,
+                    'ttfb_mean': ttfb.total / ttfb.count if ttfb.count else 0.0,
+                    'ttfb_p95': ttfb.quantile(0.95),
+                    'parse_seconds_total': operation.parse_seconds,
+                    'request_bytes': operation.request_bytes,
+                    'response_bytes': operation.response_bytes,
+                })
+        return sorted(rows, key=lambda row: row['seconds_total'], reverse=True)
+
+    def print_summary(self):
+        header = f"{'operation':<32} {'n':>6} {'err':>4} {'retry':>5} {'mean s':>8} {'p95 s':>8} {'ttfb s':>8} " \
+                 f"{'parse s':>8} {'MB in':>8} {'MB out':>8}"
+        print(header)
+        for row in self.summary():
+            name = f"{row['kind']}:{row['operation']}"
+            print(f"{name[:32]:<32} {row['requests']:>6} {row['errors']:>4} {row['retries']:>5} "
+                  f"{row['seconds_mean']:>8.3f} {row['seconds_p95']:>8.3f} {row['ttfb_mean']:>8.3f} "
+                  f"{row['parse_seconds_total']:>8.3f} {row['response_bytes'] / 1e6:>8.2f} "
+                  f"{row['request_bytes'] / 1e6:>8.2f}")
+
+    def prometheus(self, prefix: str = 'dmpy') -> str:
+        """
+        Export the metrics in the Prometheus text exposition format
+        """
+        def labels(kind: str, name: str, **extra: str) -> str:
+            pairs = {'kind': kind, 'operation': name, **extra}
+            return ','.join(f'{key}="{_escape(value)}"' for key, value in pairs.items())
+
+        lines: List[str] = []
+        with self._lock:
+            operations = sorted(self._operations.items())
+            for metric, attribute, help_text in (
+                    ('request_seconds', 'seconds', 'Wall time of DMP requests, including reading the response'),
+                    ('ttfb_seconds', 'ttfb', 'Time until the response headers of DMP requests')):
+                lines.append(f'# HELP {prefix}_{metric} {help_text}')
+                lines.append(f'# TYPE {prefix}_{metric} histogram')
+                for (kind, name), operation in operations:
+                    histogram: _Histogram = getattr(operation, attribute)
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{prefix}_{metric}_bucket{{{labels(kind, name, le=repr(float(bound)))}}} '
+                                     f'{cumulative}')
+                    lines.append(f'{prefix}_{metric}_bucket{{{labels(kind, name, le="+Inf")}}} {histogram.count}')
+                    lines.append(f'{prefix}_{metric}_sum{{{labels(kind, name)}}} {histogram.total}')
+                    lines.append(f'{prefix}_{metric}_count{{{labels(kind, name)}}} {histogram.count}')
+
+            lines.append(f'# HELP {prefix}_requests_total DMP requests by response status')
+            lines.append(f'# TYPE {prefix}_requests_total counter')
+            for (kind, name), operation in operations:
+                for status, count in sorted(operation.statuses.items()):
+                    lines.append(f'{prefix}_requests_total{{{labels(kind, name, status=status)}}} {count}')
+
+            for metric, attribute, help_text in (
+                    ('request_errors_total', 'errors', 'DMP requests that failed or returned an error status'),
+                    ('request_retries_total', 'retries', 'Retries made by the connection retry policy'),
+                    ('request_bytes_total', 'request_bytes', 'Bytes sent to the DMP'),
+                    ('response_bytes_total', 'response_bytes', 'Bytes received from the DMP'),
+                    ('parse_seconds_total', 'parse_seconds', 'Time spent decoding DMP responses')):
+                lines.append(f'# HELP {prefix}_{metric} {help_text}')
+                lines.append(f'# TYPE {prefix}_{metric} counter')
+                for (kind, name), operation in operations:
+                    lines.append(f'{prefix}_{metric}{{{labels(kind, name)}}} {getattr(operation, attribute)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
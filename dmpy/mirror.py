@@ -0,0 +1,139 @@
+from dmpy.catalog import FILE_COLUMNS, FileCatalog, file_columns, to_stamp
+from dmpy.utils import dmpy_home
+from contextlib import contextmanager
+from typing import List, Optional
+import sqlite3
+import time
+import os
+
+COLUMN_DEFINITIONS = ", ".join(f'"{column}"' + (" TEXT PRIMARY KEY" if column == "fileId" else "")
+                               for column in FILE_COLUMNS)
+SELECT_COLUMNS = ", ".join(f'"{column}"' for column in FILE_COLUMNS)
+FILTER_COLUMNS = {"participants": "participantId", "devices": "deviceId", "file_ids": "fileId"}
+
+
+class FileMirror:
+    def __init__(self, study_id: str, path: Optional[str] = None):
+        """
+        A local SQLite copy of a study's file metadata that is kept up to date with delta refreshes
+        """
+        if path is None:
+            path = os.path.join(dmpy_home(), 'mirror', f'{study_id}.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.study_id = study_id
+        self.path = path
+        with self._connect() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS files ({COLUMN_DEFINITIONS})')
+            db.execute('CREATE INDEX IF NOT EXISTS files_participant ON files ("participantId")')
+            db.execute('CREATE INDEX IF NOT EXISTS files_device ON files ("deviceId")')
+            db.execute('CREATE INDEX IF NOT EXISTS files_start ON files ("stampStart")')
+            db.execute('CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value)')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _get_sync(self, db, key: str):
+        row = db.execute('SELECT value FROM sync WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def last_sync(self) -> Optional[float]:
+        """
+        Unix time of the last refresh that checked the server
+        """
+        with self._connect() as db:
+            return self._get_sync(db, 'last_sync')
+
+    def refresh(self, conn, max_age: float = 0) -> dict:
+        """
+        Bring the mirror up to date. The study's file ids are fetched to find the files added or
+        removed since the last refresh. getStudy cannot list only some files, so when files were
+        added the full listing is fetched, and only the new files are stored. Nothing is fetched if
+        the last refresh is less than max_age seconds old.
+
+        Returns the number of 'added' and 'removed' files.
+        """
+        last_sync = self.last_sync
+        if last_sync is not None and time.time() - last_sync < max_age:
+            return {"added": 0, "removed": 0}
+        response = conn.graphql_request('file_ids', {"studyId": self.study_id})
+        if 'data' not in response:
+            raise Exception(f'Failed to list files in study {self.study_id}: {response.get("errors")}')
+        remote = {f['id'] for f in response['data']['getStudy']['files']}
+        with self._connect() as db:
+            local = {row[0] for row in db.execute('SELECT "fileId" FROM files')}
+        added = remote - local
+        removed = local - remote
+        rows = []
+        if added:
+            response = conn.graphql_request('files', {"studyId": self.study_id})
+            if 'data' not in response:
+                raise Exception(f'Failed to list files in study {self.study_id}: {response.get("errors")}')
+            columns = file_columns(f for f in response['data']['getStudy']['files'] if f['id'] in added)
+            rows = list(zip(*(columns[column] for column in FILE_COLUMNS)))
+        with self._connect() as db:
+            db.executemany(f'INSERT OR REPLACE INTO files VALUES ({", ".join("?" * len(FILE_COLUMNS))})', rows)
+            db.executemany('DELETE FROM files WHERE "fileId" = ?', [(file_id,) for file_id in removed])
+            # the longest file bounds how far before a time window an overlapping file can start
+            max_span = db.execute('SELECT MAX("stampEnd" - "stampStart") FROM files').fetchone()[0]
+            db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?)', ('max_span', max_span))
+            db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?)', ('last_sync', time.time()))
+        return {"added": len(rows), "removed": len(removed)}
+
+    def catalog(self,
+                participants: Optional[List[str]] = None,
+                kinds: Optional[List[str]] = None,
+                devices: Optional[List[str]] = None,
+                file_ids: Optional[List[str]] = None,
+                start=None,
+                end=None) -> FileCatalog:
+        """
+        Return the mirrored files matching the filters as a FileCatalog, without contacting the server.
+        With start and end (see dmpy.catalog.to_stamp) only files overlapping that window are read,
+        through an index on their start.
+        """
+        conditions, parameters = [], []
+        for name, values in (("participants", participants), ("devices", devices), ("file_ids", file_ids)):
+            if values is not None:
+                values = list(values)
+                conditions.append(f'"{FILTER_COLUMNS[name]}" IN ({", ".join("?" * len(values))})')
+                parameters.extend(values)
+        if kinds is not None:
+            kinds = list(kinds)
+            conditions.append(f'substr("deviceId", 1, 3) IN ({", ".join("?" * len(kinds))})')
+            parameters.extend(kinds)
+        query = f'SELECT {SELECT_COLUMNS} FROM files'
+        with self._connect() as db:
+            if start is not None and end is not None:
+                start, end = to_stamp(start), to_stamp(end, end=True)
+                max_span = self._get_sync(db, 'max_span')
+                if max_span is None:
+                    conditions.append('"stampStart" <= ? AND "stampEnd" >= ?')
+                    parameters.extend([end, start])
+                else:
+                    conditions.append('"stampStart" BETWEEN ? AND ? AND "stampEnd" >= ?')
+                    parameters.extend([start - max_span, end, start])
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            query += ' ORDER BY rowid'
+            rows = db.execute(query, parameters).fetchall()
+        columns = dict(zip(FILE_COLUMNS, (list(column) for column in zip(*rows)))) if rows else \
+            {column: [] for column in FILE_COLUMNS}
+        return FileCatalog.from_columns(columns)
+
+    def list_files(self,
+                   participants: Optional[List[str]] = None,
+                   kinds: Optional[List[str]] = None,
+                   devices: Optional[List[str]] = None,
+                   file_ids: Optional[List[str]] = None,
+                   start=None,
+                   end=None) -> List[dict]:
+        return self.catalog(participants=participants, kinds=kinds, devices=devices, file_ids=file_ids,
+                            start=start, end=end).to_records()
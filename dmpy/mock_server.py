@@ -0,0 +1,380 @@
+"""
+A local stand-in for the DMP's /graphql and /file/<id> endpoints, for trying dmpy without the portal.
+
+    with MockDMPServer() as server:
+        server.add_study('study')
+        server.add_file('study', 'P1-AX6-20230522-20230522.txt', b'...', 'P1', 'AX6P1', 1684713600, 1684799999)
+        conn = server.connection()
+        list_files('study', conn=conn)
+
+Only the operations dmpy sends are implemented, with just enough behaviour to exercise the client.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+import threading
+import tarfile
+import zipfile
+import hashlib
+import random
+import email
+import json
+import time
+import uuid
+import io
+import re
+
+_ROOT_FIELD = re.compile(r'(?:query|mutation)\b[^{]*\{\s*(\w+)')
+
+
+class MockDMPServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, persisted_queries: bool = True,
+                 batching: bool = True):
+        self.studies: Dict[str, Dict[str, Any]] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.persisted_queries = persisted_queries
+        self.batching = batching
+        self.stored_queries: Dict[str, str] = {}
+        self.stats = {"requests": 0, "bytes_received": 0, "bytes_sent": 0}
+        self.operations: List[str] = []
+        # statuses to answer the next requests with instead of handling them, e.g. [503] for a gateway error
+        # or [200] for a proxy page that is not JSON
+        self.fail_statuses: List[int] = []
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MockDMPServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> 'MockDMPServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def connection(self, **kwargs):
+        from dmpy.connections import DMPConnection
+        return DMPConnection(host=self.url, cookie='mock', **kwargs)
+
+    def add_study(self, study_id: str, name: Optional[str] = None) -> Dict[str, Any]:
+        study = {"id": study_id, "name": name or study_id, "files": [], "records": {}, "fields": [], "tables": {}}
+        self.studies[study_id] = study
+        return study
+
+    def add_file(self, study_id: str, file_name: str, content: bytes, participant_id: str, device_id: str,
+                 start_date: int, end_date: int, upload_time: Optional[int] = None) -> str:
+        """
+        Add a file to a study; dates are in seconds as for upload_data
+        """
+        description = json.dumps({"participantId": participant_id, "deviceId": device_id,
+                                  "startDate": start_date * 1000, "endDate": end_date * 1000})
+        return self._store_file(study_id, file_name, content, description, upload_time)
+
+    def _store_file(self, study_id: str, file_name: str, content: bytes, description: str,
+                    upload_time: Optional[int] = None) -> str:
+        file_id = str(uuid.uuid4())
+        entry = {
+            "id": file_id,
+            "fileName": file_name,
+            "studyId": study_id,
+            "projectId": None,
+            "fileSize": str(len(content)),
+            "description": description,
+            "uploadTime": str(upload_time if upload_time is not None else int(time.time() * 1000)),
+            "uploadedBy": "mock",
+            "hash": hashlib.sha256(content).hexdigest(),
+            "__typename": "File",
+        }
+        with self._lock:
+            self.file_contents[file_id] = content
+            self.studies[study_id]["files"].append(entry)
+        return file_id
+
+    def add_synthetic_study(self, study_id: str, participants: int = 10, devices: int = 2,
+                            files_per_device: int = 5, file_size: int = 1024 * 1024, archive_format: str = 'zip',
+                            archive_members: int = 4, subjects: int = 50, visits: int = 6, fields: int = 20,
+                            seed: int = 0) -> Dict[str, Any]:
+        """
+        Add a study filled with generated data: participants * devices * files_per_device device files,
+        each an archive ('zip' or 'tar.gz') of archive_members CSV accelerometer exports with about
+        file_size bytes of text in total (or the text itself for archive_format 'txt'), and data records
+        for subjects * visits visits with fields numeric fields, the derived_ADDI, dataset_id and TUP start
+        date fields, and the ADPRO, ADCL and ADSL tables read by fetch_adam_data.
+        """
+        rng = random.Random(seed)
+        study = self.add_study(study_id)
+        day = 86400
+        start = 1672531200  # 2023-01-01
+        for p in range(participants):
+            participant_id = f'P{p:05d}'
+            for d in range(devices):
+                device_id = f'AX6{d:05d}'
+                for f in range(files_per_device):
+                    first = start + (p * 7 + f * 3) * day
+                    last = first + 2 * day - 1
+                    content = synthetic_archive(rng, archive_format, archive_members, file_size)
+                    dates = '-'.join(time.strftime('%Y%m%d', time.gmtime(stamp)) for stamp in (first, last))
+                    self.add_file(study_id, f'{participant_id}-{device_id}-{dates}.{archive_format}', content,
+                                  participant_id, device_id, first, last)
+
+        study["fields"] = [{"fieldId": f'F{i:04d}', "fieldName": f'Field {i}', "tableName": None,
+                            "dataType": "dec", "possibleValues": None, "unit": None, "comments": None,
+                            "studyId": study_id, "dateAdded": "0"} for i in range(fields)]
+        params = list(_ADDI_PARAMS)
+        adpro, adcl, adsl = [], [], []
+        for s in range(subjects):
+            subject_id = f'S{s:05d}'
+            records = {'0': {f'derived_TUP{t}_start_date': f'2023-{1 + 3 * (t - 1):02d}-01 08:00:00'
+                             for t in range(1, 5)}}
+            for v in range(1, visits + 1):
+                visit_id = str(v)
+                values = {f'F{i:04d}': str(round(rng.uniform(0, 100), 3)) for i in range(fields)}
+                clips = []
+                for c in range(3):
+                    clip = {'ADT': f'2023-{1 + 3 * ((v - 1) // 2):02d}-{c + 10}', 'ATM': f'{c + 9}:00',
+                            'TIMING': rng.choice(['AM', 'PM'])}
+                    for param in rng.sample(params, 4):
+                        clip[param] = str(rng.randint(0, 100))
+                    clips.append(clip)
+                values['derived_ADDI'] = json.dumps(str(clips))
+                values['dataset_id'] = rng.choice(['1', '2'])
+                records[visit_id] = values
+                adt = f'2023-{1 + 3 * ((v - 1) // 2):02d}-{rng.randint(1, 28):02d}T10:00:00.000'
+                for form in range(3):
+                    adpro.append({'USUBJID': subject_id, 'STUDYID': 'IDEAFAST COS', 'VISITNUM': visit_id,
+                                  'AVISIT': f'Visit {visit_id}', 'ADT': adt, 'AVAL': str(rng.randint(0, 10)),
+                                  'FORMID': str(form), 'PARAMCD': f'PRO{form}'})
+                adcl.append({'USUBJID': subject_id, 'STUDYID': 'IDEAFAST COS', 'VISITNUM': visit_id, 'ADT': adt,
+                             'AVAL': str(rng.randint(0, 10)), 'PARAMCD': 'CL'})
+            study["records"][subject_id] = records
+            adsl.append({'USUBJID': subject_id, 'STUDYID': 'IDEAFAST COS', 'AGE': str(rng.randint(18, 80)),
+                         'AGEU': 'YEARS', 'COUNTRY': rng.choice(['DE', 'NL', 'UK'])})
+        study["tables"]['standardized-cdisc:adam:adpro'] = {'ADPRO': adpro}
+        study["tables"]['standardized-cdisc:adam:adcl'] = {'ADCL': adcl}
+        study["tables"]['standardized-cdisc:adam:adsl'] = {'ADSL': adsl}
+        return study
+
+    # GraphQL operations, keyed by root field
+
+    def _resolve(self, field: str, variables: Dict[str, Any], upload: Optional[tuple] = None) -> Any:
+        if field == 'whoAmI':
+            return {
+                "id": "mock", "username": "mock", "type": "STANDARD", "firstname": "Mock", "lastname": "User",
+                "email": "mock@localhost", "organisation": None, "description": None,
+                "access": {"id": "mock", "projects": [],
+                           "studies": [{"id": s["id"], "name": s["name"]} for s in self.studies.values()]},
+                "createdAt": "0", "expiredAt": str(int(time.time() * 1000) + 86400000),
+            }
+        study = self.studies.get(variables.get('studyId'))
+        if study is None:
+            raise Exception(f"Study {variables.get('studyId')} does not exist")
+        if field == 'getStudy':
+            return {"id": study["id"], "name": study["name"], "createdBy": "mock", "files": study["files"]}
+        if field == 'getStudyFields':
+            return study["fields"]
+        if field == 'createNewField':
+            inputs = variables['fieldInput']
+            for field_input in inputs if isinstance(inputs, list) else [inputs]:
+                study["fields"] = [f for f in study["fields"] if f["fieldId"] != field_input["fieldId"]]
+                study["fields"].append(dict({"studyId": study["id"], "tableName": None, "possibleValues": None,
+                                             "unit": None, "comments": None, "dateAdded": str(int(time.time()))},
+                                            **field_input))
+            return [{"code": None, "description": "Field created"}]
+        if field == 'deleteField':
+            deleted = [f for f in study["fields"] if f["fieldId"] == variables['fieldId']]
+            study["fields"] = [f for f in study["fields"] if f["fieldId"] != variables['fieldId']]
+            return deleted[0] if deleted else None
+        if field == 'getDataRecords':
+            query = variables.get('queryString') or {}
+            data_format = query.get('format') or 'raw'
+            if data_format != 'raw':
+                return {"data": study["tables"].get(data_format, {})}
+            requested = query.get('data_requested')
+            if requested is None:
+                return {"data": study["records"]}
+            requested = set(requested)
+            return {"data": {subject: {visit: {k: v for k, v in fields.items() if k in requested}
+                                       for visit, fields in visits.items()}
+                             for subject, visits in study["records"].items()}}
+        if field == 'uploadDataInArray':
+            results = []
+            known_fields = {f["fieldId"] for f in study["fields"]}
+            for clip in variables.get('data') or []:
+                if known_fields and clip.get("fieldId") not in known_fields:
+                    results.append({"id": clip.get("fieldId"), "code": "CLIENT_MALFORMED_INPUT",
+                                    "description": f"Field {clip.get('fieldId')}: Field not found",
+                                    "successful": False})
+                    continue
+                visits = study["records"].setdefault(clip["subjectId"], {})
+                visits.setdefault(clip["visitId"], {})[clip["fieldId"]] = clip.get("value")
+                results.append({"id": clip.get("fieldId"), "code": None, "description": None, "successful": True})
+            return results
+        if field == 'uploadFile':
+            file_name, content = upload
+            if variables.get('hash') and variables['hash'] != hashlib.sha256(content).hexdigest():
+                raise Exception('File hash does not match')
+            file_id = self._store_file(study["id"], file_name, content, variables['description'])
+            return next(f for f in study["files"] if f["id"] == file_id)
+        raise Exception(f'Operation {field} is not supported by the mock server')
+
+    def execute(self, request: Dict[str, Any], upload: Optional[tuple] = None) -> Dict[str, Any]:
+        query = request.get('query')
+        persisted = (request.get('extensions') or {}).get('persistedQuery')
+        if persisted:
+            if not self.persisted_queries:
+                return {"errors": [{"message": "PersistedQueryNotSupported",
+                                    "extensions": {"code": "PERSISTED_QUERY_NOT_SUPPORTED"}}]}
+            if query is None:
+                query = self.stored_queries.get(persisted['sha256Hash'])
+                if query is None:
+                    return {"errors": [{"message": "PersistedQueryNotFound",
+                                        "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]}
+            elif hashlib.sha256(query.encode('utf-8')).hexdigest() != persisted['sha256Hash']:
+                return {"errors": [{"message": "provided sha does not match query"}]}
+            else:
+                self.stored_queries[persisted['sha256Hash']] = query
+        match = _ROOT_FIELD.search(query or '')
+        if match is None:
+            return {"errors": [{"message": "Could not parse query"}]}
+        field = match.group(1)
+        self.operations.append(field)
+        try:
+            return {"data": {field: self._resolve(field, request.get('variables') or {}, upload)}}
+        except Exception as e:
+            return {"errors": [{"message": str(e)}], "data": None}
+
+
+_ADDI_PARAMS = ['ACTIVI01', 'ACTIVI04', 'DIARY01', 'DIARY02', 'DIARY03', 'DIARY06', 'KSS', 'PGISCE1', 'PGISCE3']
+
+
+def synthetic_text(rng: random.Random, size: int) -> bytes:
+    """
+    Generate about size bytes of CSV accelerometer samples (timestamp,x,y,z); a block of random
+    lines is repeated, so large files are cheap to generate but still compress like real exports
+    """
+    lines = [f'{1672531200000 + i * 10},{rng.gauss(0, 1):.4f},{rng.gauss(0, 1):.4f},{rng.gauss(1, 0.2):.4f}\n'
+             for i in range(2000)]
+    block = ''.join(lines).encode('utf-8')
+    header = b'timestamp,x,y,z\n'
+    repeats = max(0, size - len(header)) // len(block) + 1
+    return header + (block * repeats)[:max(0, size - len(header))]
+
+
+def synthetic_archive(rng: random.Random, archive_format: str, members: int, size: int) -> bytes:
+    if archive_format == 'txt':
+        return synthetic_text(rng, size)
+    buffer = io.BytesIO()
+    member_size = size // max(1, members)
+    if archive_format == 'zip':
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for m in range(members):
+                zf.writestr(f'export_{m}.csv', synthetic_text(rng, member_size))
+    elif archive_format == 'tar.gz':
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            for m in range(members):
+                data = synthetic_text(rng, member_size)
+                info = tarfile.TarInfo(f'export_{m}.csv')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    else:
+        raise Exception(f'Unsupported archive format {archive_format}, expected zip, tar.gz or txt')
+    return buffer.getvalue()
+
+
+def _make_handler(server: MockDMPServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client went away, e.g. a cancelled download
+                pass
+
+        def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+            with server._lock:
+                server.stats["bytes_sent"] += len(body)
+
+        def _count_request(self, size: int):
+            with server._lock:
+                server.stats["requests"] += 1
+                server.stats["bytes_received"] += size
+
+        def _fail(self) -> bool:
+            with server._lock:
+                status = server.fail_statuses.pop(0) if server.fail_statuses else None
+            if status is None:
+                return False
+            self._send(status, b'Injected failure', 'text/plain')
+            return True
+
+        def do_GET(self):
+            self._count_request(0)
+            if self._fail():
+                return
+            match = re.fullmatch(r'/file/([^/?]+)', self.path)
+            content = server.file_contents.get(match.group(1)) if match else None
+            if content is None:
+                return self._send(404, b'File not found', 'text/plain')
+            byte_range = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            if byte_range is None or not content:
+                return self._send(200, content, 'application/octet-stream')
+            first, last = byte_range.groups()
+            if first == '':
+                start, end = max(0, len(content) - int(last)), len(content) - 1
+            else:
+                start, end = int(first), min(int(last), len(content) - 1) if last else len(content) - 1
+            if start >= len(content):
+                return self._send(416, b'', 'text/plain', {'Content-Range': f'bytes */{len(content)}'})
+            self._send(206, content[start:end + 1], 'application/octet-stream',
+                       {'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            self._count_request(len(body))
+            if self._fail():
+                return
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('multipart/form-data'):
+                message = email.message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+                parts = {part.get_param('name', header='content-disposition'): part
+                         for part in message.get_payload()}
+                operations = json.loads(parts['operations'].get_payload(decode=True))
+                file_part = parts[next(iter(json.loads(parts['map'].get_payload(decode=True))))]
+                result = server.execute(operations, (file_part.get_filename(), file_part.get_payload(decode=True)))
+            else:
+                request = json.loads(body)
+                if isinstance(request, list) and not server.batching:
+                    return self._send(400, json.dumps({"errors": [{"message": "Batching is not supported"}]})
+                                      .encode('utf-8'))
+                if isinstance(request, list):
+                    result = [server.execute(r) for r in request]
+                else:
+                    result = server.execute(request)
+            self._send(200, json.dumps(result).encode('utf-8'))
+
+    return Handler
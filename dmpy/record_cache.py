@@ -0,0 +1,201 @@
+from dmpy.cache import FileCache
+from dmpy.utils import dmpy_home
+from typing import Any, Dict, List, Optional
+import importlib.util
+import threading
+import hashlib
+import json
+import glob
+import time
+import os
+
+DEFAULT_RECORD_CACHE_SIZE = 1024 ** 3
+DEFAULT_RECORD_CACHE_TTL = 300
+LATEST_VERSIONS = (None, '', '0', '-1')
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class RecordCache:
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        A size-bounded on-disk cache of get_data_records results, stored as Parquet and keyed by
+        portal, study, field ids, format, version and table.
+
+        Results of a concrete version never change and are kept until evicted; results of the
+        latest version (version_id None, '', '0' or '-1') expire after ttl seconds and are dropped
+        when data is uploaded to the study through dmpy. Files are memory-mapped when read.
+        """
+        if directory is None:
+            directory = os.environ.get('DMP_RECORD_CACHE_DIR') or os.path.join(dmpy_home(), 'records')
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('DMP_RECORD_CACHE_SIZE', DEFAULT_RECORD_CACHE_SIZE))
+        if ttl is None:
+            ttl = float(os.environ.get('DMP_RECORD_CACHE_TTL', DEFAULT_RECORD_CACHE_TTL))
+        self.ttl = ttl
+        self.files = FileCache(directory, max_bytes)
+
+    @property
+    def max_bytes(self) -> int:
+        return self.files.max_bytes
+
+    def key(self, host: str, study_id: str, field_ids: Optional[List[str]] = None, data_format: Optional[str] = None,
+            version_id: Optional[str] = '0', table_requested: Optional[str] = None) -> str:
+        """
+        Return the cache key of a get_data_records query; the order of field_ids does not matter
+        """
+        query = json.dumps([host, study_id, sorted(set(field_ids)) if field_ids is not None else None,
+                            data_format or 'raw', version_id, table_requested])
+        pinned = 'latest' if version_id in LATEST_VERSIONS else 'pinned'
+        return f'{_digest(f"{host} {study_id}")}.{pinned}.{_digest(query)}.parquet'
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return a cached result, or None when it is missing or has expired
+        """
+        import pyarrow.parquet as pq
+        path = self.files.get(key)
+        if path is None:
+            return None
+        try:
+            metadata = pq.read_schema(path, memory_map=True).metadata or {}
+            if '.latest.' in key and time.time() - float(metadata.get(b'created', 0)) >= self.ttl:
+                self._remove(key)
+                return None
+            table = pq.read_table(path, memory_map=True)
+        except (OSError, ValueError):
+            return None
+        return _decode(table, metadata.get(b'layout', b'').decode())
+
+    def put(self, key: str, result: Any):
+        if '.latest.' in key and self.ttl <= 0:
+            return
+        import pyarrow.parquet as pq
+        table = _encode(result)
+        self.files.put(key, lambda tmp_path: pq.write_table(table, tmp_path))
+
+    def invalidate(self, host: str, study_id: str):
+        """
+        Drop the cached latest-version results of a study
+        """
+        for path in glob.glob(os.path.join(self.files.directory, f'{_digest(f"{host} {study_id}")}.latest.*')):
+            self._remove(os.path.basename(path))
+
+    def clear(self):
+        self.files.clear()
+
+    def _remove(self, key: str):
+        try:
+            os.remove(os.path.join(self.files.directory, key))
+        except FileNotFoundError:
+            pass
+
+
+def _is_records(result: Any) -> bool:
+    return isinstance(result, dict) and all(
+        isinstance(visits, dict) and all(isinstance(fields, dict) for fields in visits.values())
+        for visits in result.values())
+
+
+def _encode(result: Any):
+    """
+    Store raw records as one row per value with dictionary-encoded subjectId, visitId and fieldId
+    columns (a null fieldId marks an empty visit, a null visitId a subject without visits), and
+    any other result as one JSON document per top-level key
+    """
+    import pyarrow as pa
+    from dmpy.records import flatten_records
+    metadata = {'created': str(time.time())}
+    if _is_records(result):
+        subjects, visits, rows, field_ids, values = flatten_records(result)
+        filled = set(rows.tolist())
+        empty_visits = [row for row in range(len(subjects)) if row not in filled]
+        empty_subjects = [subject for subject, subject_visits in result.items() if not subject_visits]
+        row_subjects = [subjects[row] for row in rows] + [subjects[row] for row in empty_visits] + empty_subjects
+        row_visits = [visits[row] for row in rows] + [visits[row] for row in empty_visits] + [None] * len(empty_subjects)
+        field_ids = field_ids + [None] * (len(empty_visits) + len(empty_subjects))
+        values = values + [None] * (len(empty_visits) + len(empty_subjects))
+        try:
+            value_column = pa.array(values, type=pa.string())
+            metadata['layout'] = 'records'
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # values that are not all strings are kept exactly as JSON
+            value_column = pa.array([json.dumps(value) for value in values], type=pa.string())
+            metadata['layout'] = 'records-json'
+        table = pa.table({
+            'subjectId': pa.array(row_subjects, type=pa.string()).dictionary_encode(),
+            'visitId': pa.array(row_visits, type=pa.string()).dictionary_encode(),
+            'fieldId': pa.array(field_ids, type=pa.string()).dictionary_encode(),
+            'value': value_column,
+        })
+    else:
+        items = list(result.items()) if isinstance(result, dict) else [(None, result)]
+        table = pa.table({
+            'key': pa.array([key for key, _ in items], type=pa.string()),
+            'json': pa.array([json.dumps(value) for _, value in items], type=pa.string()),
+        })
+        metadata['layout'] = 'json' if isinstance(result, dict) else 'json-value'
+    return table.replace_schema_metadata(metadata)
+
+
+def _strings(table, column: str) -> List[Optional[str]]:
+    """
+    Expand a dictionary-encoded column through its dictionary; converting the dictionary array
+    element by element is far slower
+    """
+    import pyarrow as pa
+    array = table.column(column).combine_chunks()
+    if not pa.types.is_dictionary(array.type):
+        return array.to_pylist()
+    dictionary = array.dictionary.to_pylist() + [None]
+    indices = array.indices.fill_null(len(dictionary) - 1).to_numpy(zero_copy_only=False)
+    return [dictionary[index] for index in indices.tolist()]
+
+
+def _decode(table, layout: str) -> Any:
+    if layout in ('records', 'records-json'):
+        values = table.column('value').to_pylist()
+        if layout == 'records-json':
+            values = [json.loads(value) for value in values]
+        result: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for subject_id, visit_id, field_id, value in zip(_strings(table, 'subjectId'), _strings(table, 'visitId'),
+                                                         _strings(table, 'fieldId'), values):
+            subject_visits = result.setdefault(subject_id, {})
+            if visit_id is None:
+                continue
+            visit_fields = subject_visits.setdefault(visit_id, {})
+            if field_id is not None:
+                visit_fields[field_id] = value
+        return result
+    values = [json.loads(value) for value in table.column('json').to_pylist()]
+    if layout == 'json-value':
+        return values[0]
+    return dict(zip(table.column('key').to_pylist(), values))
+
+
+_default_record_cache: Optional[RecordCache] = None
+_default_record_cache_lock = threading.Lock()
+
+
+def get_default_record_cache() -> Optional[RecordCache]:
+    """
+    Return the process-wide record cache, or None when it is disabled with DMP_RECORD_CACHE_SIZE=0
+    or pyarrow is not installed
+    """
+    global _default_record_cache
+    with _default_record_cache_lock:
+        if _default_record_cache is None:
+            if importlib.util.find_spec('pyarrow') is None:
+                return None
+            _default_record_cache = RecordCache()
+        if _default_record_cache.max_bytes <= 0:
+            return None
+        return _default_record_cache
+
+
+def set_default_record_cache(cache: Optional[RecordCache]):
+    global _default_record_cache
+    with _default_record_cache_lock:
+        _default_record_cache = cache
@@ -0,0 +1,103 @@
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["subjectId", "visitId"]
+LAYOUTS = ("long", "wide")
+
+
+def field_types(fields: Iterable[dict]) -> Dict[str, dict]:
+    """
+    Index study fields (as returned by get_study_fields) by field id; later entries win, so the
+    most recent definition of a field is used
+    """
+    return {field["fieldId"]: field for field in fields}
+
+
+def flatten_records(records: Dict[str, Dict[str, Dict[str, Any]]]):
+    """
+    Flatten getDataRecords data ({subject: {visit: {field: value}}}) in a single pass into the
+    subject and visit of each row and parallel (row, field, value) lists, one entry per cell
+    """
+    subjects, visits, rows, field_ids, values = [], [], [], [], []
+    for subject_id, subject_visits in records.items():
+        for visit_id, visit_fields in subject_visits.items():
+            row = len(subjects)
+            subjects.append(subject_id)
+            visits.append(visit_id)
+            rows.extend([row] * len(visit_fields))
+            field_ids.extend(visit_fields.keys())
+            values.extend(visit_fields.values())
+    return subjects, visits, np.array(rows, dtype=np.intp), field_ids, values
+
+
+def decode_values(values: pd.Series, field: Optional[dict]) -> pd.Series:
+    """
+    Convert the raw values of one field to the dtype of its dataType: Int64 for int, float64 for
+    dec, datetime64 for date, and categorical for cat, with the possibleValues codes as categories.
+    Values that do not parse become missing; fields without metadata keep their raw values.
+    """
+    data_type = (field or {}).get("dataType")
+    if data_type == "int":
+        numbers = pd.to_numeric(values, errors="coerce")
+        # decimals in an int field are kept rather than truncated
+        if (numbers.dropna() % 1 != 0).any():
+            return numbers.astype("float64")
+        return numbers.astype("Int64")
+    if data_type == "dec":
+        return pd.to_numeric(values, errors="coerce").astype("float64")
+    if data_type == "date":
+        if pd.api.types.infer_dtype(values, skipna=True) in ("integer", "floating", "mixed-integer-float"):
+            # JSON numbers are millisecond timestamps
+            return pd.to_datetime(pd.to_numeric(values, errors="coerce"), unit="ms")
+        return pd.to_datetime(values.astype(object), errors="coerce", format="mixed")
+    if data_type == "cat":
+        value_codes, uniques = pd.factorize(values)
+        uniques = [str(value) for value in uniques]
+        categories = [str(value["code"]) for value in (field.get("possibleValues") or [])]
+        # values outside possibleValues are kept as extra categories rather than dropped
+        known = set(categories)
+        categories += [value for value in dict.fromkeys(uniques) if value not in known]
+        category_codes = pd.Index(categories).get_indexer(uniques) if uniques else np.empty(0, dtype=np.intp)
+        codes = np.where(value_codes >= 0, category_codes[value_codes] if len(category_codes) else -1, -1)
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=values.index)
+    return values.astype(object)
+
+
+def records_to_frame(records: Dict[str, Dict[str, Dict[str, Any]]],
+                     fields: Optional[Iterable[dict]] = None,
+                     layout: str = "wide") -> pd.DataFrame:
+    """
+    Decode getDataRecords data into a DataFrame, typing each field's values from its study field
+    definition (see decode_values).
+
+    layout='wide' gives one row per subject and visit with a column per field; layout='long' gives
+    one row per value with subjectId, visitId, fieldId and value columns, where value has the
+    common dtype of the fields it holds.
+    """
+    if layout not in LAYOUTS:
+        raise Exception(f"Unknown layout {layout}, expected one of {', '.join(LAYOUTS)}")
+    types = field_types(fields or [])
+    subjects, visits, rows, field_ids, values = flatten_records(records)
+    codes, uniques = pd.factorize(pd.Series(field_ids, dtype=object))
+    values = pd.Series(values, dtype=object)
+    positions = pd.Series(np.arange(len(codes))).groupby(codes).indices if len(codes) else {}
+    decoded = {field_id: decode_values(values.iloc[positions[code]], types.get(field_id))
+               for code, field_id in enumerate(uniques)}
+
+    if layout == "long":
+        value = pd.concat(decoded.values()).sort_index() if decoded else pd.Series(dtype=object)
+        return pd.DataFrame({
+            "subjectId": pd.Categorical(np.asarray(subjects, dtype=object)[rows]),
+            "visitId": pd.Categorical(np.asarray(visits, dtype=object)[rows]),
+            "fieldId": pd.Categorical.from_codes(codes, categories=uniques) if len(codes) else pd.Categorical([]),
+            "value": value.reset_index(drop=True),
+        })
+
+    frame = {"subjectId": pd.Categorical(subjects), "visitId": pd.Categorical(visits)}
+    row_index = pd.RangeIndex(len(subjects))
+    for code, field_id in enumerate(uniques):
+        column = decoded[field_id]
+        column.index = rows[positions[code]]
+        frame[field_id] = column.reindex(row_index)
+    return pd.DataFrame(frame, index=row_index)
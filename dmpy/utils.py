@@ -1,16 +1,48 @@
+import functools
 import getpass
+import hashlib
+import json
 import os
-from typing import Optional
+import re
+from typing import Dict, List, Optional
+
+
+@functools.lru_cache(maxsize=None)
+def _query_registry() -> Dict[str, str]:
+    """
+    Read every .graphql file once, on first use
+    """
+    query_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'graphql')
+    queries = {}
+    for file_name in os.listdir(query_dir):
+        name, extension = os.path.splitext(file_name)
+        if extension == '.graphql':
+            with open(os.path.join(query_dir, file_name), 'r') as f:
+                queries[name] = f.read()
+    return queries
 
 
 def load_query(query_name: str) -> str:
-    file_name = f'{query_name}.graphql'
-    parent = os.path.dirname(os.path.abspath(__file__))
-    query_file_path = os.path.join(parent, 'graphql', file_name)
-    if not os.path.exists(query_file_path):
-        raise FileNotFoundError(f'Could not find query file {file_name}')
-    with open(query_file_path, 'r') as f:
-        return f.read()
+    queries = _query_registry()
+    if query_name not in queries:
+        raise FileNotFoundError(f'Could not find query file {query_name}.graphql')
+    return queries[query_name]
+
+
+@functools.lru_cache(maxsize=None)
+def query_hash(query_name: str) -> str:
+    """
+    sha256 of a query's text, as used by automatic persisted queries
+    """
+    return hashlib.sha256(load_query(query_name).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def is_mutation(query_name: str) -> bool:
+    """
+    Whether a query file holds a mutation, which must not be resent when its response is lost
+    """
+    return re.search(r'^\s*mutation\b', load_query(query_name), re.MULTILINE) is not None
 
 
 def load_cookie_from_file() -> Optional[str]:
@@ -31,9 +63,61 @@ def load_host_from_file() -> Optional[str]:
         return None
 
 
+def dmpy_home() -> str:
+    """
+    Directory for dmpy's local state (caches, mirrors), DMP_HOME or /tmp/<user>/dmpy
+    """
+    if os.environ.get('DMP_HOME'):
+        return os.environ.get('DMP_HOME')
+    return f'/tmp/{getpass.getuser()}/dmpy'
+
+
 def get_file_type(fname: str) -> str:
     base, extension = os.path.splitext(fname)
     if extension == ".gz" and base.endswith(".tar"):
         return "tar.gz"
     else:
         return extension.lstrip(".")
+
+
+def file_description(participant_id: str, device_id: str, start_date: int, end_date: int) -> str:
+    """
+    The description of an uploaded device file; dates are in seconds and sent in milliseconds
+    """
+    return json.dumps({
+            "participantId": participant_id,
+            "deviceId": device_id,
+            "startDate": start_date * 1000,
+            "endDate": end_date * 1000,
+        }
+    )
+
+
+def data_records_variables(study_id: str,
+                           field_ids: List[str] = None,
+                           data_format: str = None,
+                           version_id: str = '0',
+                           table_requested: str = None) -> dict:
+    """
+    The getDataRecords variables of a get_data_records query, shared by the sync and async clients
+    """
+    variables = {
+        "studyId": study_id,
+        "queryString": {
+            "data_requested": field_ids,
+            "format": "raw",
+            "new_fields": None,
+            "cohort": None,
+        }
+    }
+
+    if data_format:
+        variables["queryString"]["format"] = data_format
+    if not version_id:
+        variables["versionId"] = None
+    elif version_id != '0':
+        # '-1' and concrete versions are sent, '0' leaves the server's default
+        variables["versionId"] = version_id
+    if table_requested:
+        variables["queryString"]["table_requested"] = table_requested
+    return variables
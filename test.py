@@ -29,11 +29,6 @@ end_date = int(time.mktime(time.strptime("2024-01-27", "%Y-%m-%d"))) * 1000
 # Path to the file you want to upload
 file_path = file_name
  
-# Read the file content in binary mode
-with open(file_path, 'rb') as file:
-    file_content = file.read()
-    print(file_content)
-
 print(study_id, file_name, participant_id, device_id, start_date, end_date)
-# Test the upload function
-uploaded_file_id = upload_data(study_id, file_name, file_content, participant_id, device_id, start_date, end_date)
+# Test the upload function, the file is streamed from its path
+uploaded_file_id = upload_data(study_id, file_name, file_path, participant_id, device_id, start_date, end_date)
@@ -0,0 +1,38 @@
+import pytest
+
+from dmpy.mock_server import MockDMPServer
+
+STUDY_ID = 'study'
+
+
+@pytest.fixture(autouse=True)
+def dmpy_home(tmp_path, monkeypatch):
+    """
+    Keep the caches and mirrors of each test in its own directory
+    """
+    from dmpy.cache import set_default_cache
+    from dmpy.fields import set_default_field_cache
+    from dmpy.record_cache import set_default_record_cache
+    monkeypatch.setenv('DMP_HOME', str(tmp_path / 'dmpy'))
+    for name in ('DMP_CACHE_DIR', 'DMP_CACHE_SIZE', 'DMP_RECORD_CACHE_SIZE', 'DMP_FIELD_CACHE_TTL'):
+        monkeypatch.delenv(name, raising=False)
+    set_default_cache(None)
+    set_default_field_cache(None)
+    set_default_record_cache(None)
+    yield tmp_path / 'dmpy'
+    set_default_cache(None)
+    set_default_field_cache(None)
+    set_default_record_cache(None)
+
+
+@pytest.fixture
+def server():
+    with MockDMPServer() as server:
+        server.add_study(STUDY_ID)
+        yield server
+
+
+@pytest.fixture
+def conn(server):
+    with server.connection(backoff_factor=0) as conn:
+        yield conn
@@ -0,0 +1,32 @@
+import json
+import math
+
+from dmpy.adam import ADAM_DOMAINS, build_addi
+
+
+def test_only_absent_values_are_filled():
+    domain = ADAM_DOMAINS['ADCL']
+    rows = [{'USUBJID': 'S1', 'AVAL': None, 'AVALC': float('nan'), 'EXTRA': 1}, {'USUBJID': 'S2', 'AVAL': 3}]
+    frame = domain.build([{'ADCL': rows}])
+    assert list(frame.columns) == domain.columns
+    assert frame.loc[0, 'AVAL'] is None
+    assert math.isnan(frame.loc[0, 'AVALC'])
+    assert frame.loc[1, 'AVALC'] == ''
+    assert frame.loc[1, 'AVAL'] == 3
+    assert (frame['FORMID'] == '').all()
+
+
+def test_empty_table_has_the_domain_columns():
+    frame = ADAM_DOMAINS['ADSL'].build([None])
+    assert frame.empty and list(frame.columns) == ADAM_DOMAINS['ADSL'].columns
+
+
+def test_addi_keeps_parameters_answered_with_null():
+    clips = [{'ADT': '2023-05-22', 'ATM': '10:00', 'TIMING': 'AM', 'KSS': None, 'DIARY01': '40'},
+             {'ADT': '2023-05-22', 'ATM': '16:00', 'TIMING': 'PM', 'DIARY01': '60'}]
+    addi_data = {'S1': {'1': {'derived_ADDI': json.dumps(json.dumps(clips).replace('"', "'"))}}}
+    frame = build_addi(addi_data, {'S1': {'1': {'dataset_id': '1'}}})
+    assert list(frame['PARAMCD']) == ['DIARY01', 'KSS', 'DIARY01']
+    assert list(frame['AVALC']) == ['40', None, '60']
+    assert math.isnan(frame.loc[1, 'AVAL'])
+    assert list(frame['ANALYSISSET']) == ['ISA'] * 3
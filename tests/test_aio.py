@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from conftest import STUDY_ID
+from dmpy import list_files
+
+aio = pytest.importorskip('dmpy.aio')
+
+
+def _run(server, work, **kwargs):
+    async def main():
+        async with aio.AsyncDMPConnection(host=server.url, cookie='mock', **kwargs) as conn:
+            return await work(conn)
+    return asyncio.run(main())
+
+
+def test_async_client_matches_the_sync_functions(server, conn, tmp_path):
+    path = tmp_path / 'P1-AX6P1-20230522-20230522.txt'
+    path.write_bytes(b'timestamp,x\r\n1,2\r\n' * 1000)
+
+    async def work(async_conn):
+        file_id = await aio.upload_data(STUDY_ID, path.name, str(path), 'P1', 'AX6P1', 1684713600, 1684799999,
+                                        conn=async_conn)
+        await aio.upload_data_in_array(STUDY_ID, [{'subjectId': 'S1', 'visitId': '1', 'fieldId': 'AGE',
+                                                   'value': '40'}], conn=async_conn)
+        files = await aio.list_files(STUDY_ID, conn=async_conn)
+        records = await aio.get_data_records(STUDY_ID, conn=async_conn)
+        downloaded = await async_conn.download_file(file_id, str(tmp_path / 'copy'), files[0]['fileHash'])
+        return file_id, files, records, downloaded
+
+    file_id, files, records, downloaded = _run(server, work, persisted_queries=True)
+    assert files == list_files(STUDY_ID, conn=conn)
+    assert files[0]['fileId'] == file_id
+    assert files[0]['fileHash'] == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert records == {'S1': {'1': {'AGE': '40'}}}
+    with open(downloaded, 'rb') as f:
+        assert f.read() == path.read_bytes()
+
+
+def test_async_download_checks_the_hash(server, tmp_path):
+    file_id = server.add_file(STUDY_ID, 'P1-AX6P1-20230522-20230522.txt', b'content', 'P1', 'AX6P1',
+                              1684713600, 1684799999)
+    with pytest.raises(Exception, match='Hash mismatch'):
+        _run(server, lambda async_conn: async_conn.download_file(file_id, str(tmp_path / 'copy'), '0' * 64))
+    assert not (tmp_path / 'copy').exists()
+
+
+@pytest.mark.parametrize('persisted_queries', [False, True])
+def test_async_client_raises_on_responses_that_are_not_json(server, conn, persisted_queries):
+    server.fail_statuses = [200]
+    with pytest.raises(Exception, match='Failed to query files: Injected failure'):
+        conn.graphql_request('files', {'studyId': STUDY_ID})
+    server.fail_statuses = [200]
+    with pytest.raises(Exception, match='Failed to query files: Injected failure'):
+        _run(server, lambda async_conn: aio.list_files(STUDY_ID, conn=async_conn), persisted_queries=persisted_queries)
+
+
+def test_async_upload_raises_on_responses_that_are_not_json(server, tmp_path):
+    path = tmp_path / 'P1-AX6P1-20230522-20230522.txt'
+    path.write_bytes(b'content')
+    server.fail_statuses = [200]
+    with pytest.raises(Exception, match=f'Failed to upload {path.name}: Injected failure'):
+        _run(server, lambda async_conn: aio.upload_data(STUDY_ID, path.name, str(path), 'P1', 'AX6P1',
+                                                        1684713600, 1684799999, conn=async_conn))
@@ -0,0 +1,86 @@
+import io
+import os
+import random
+import zipfile
+
+import pytest
+
+from conftest import STUDY_ID
+from dmpy import archive_preview, stream_data_from_archive
+from dmpy.archive import RANGE_BLOCK_SIZE, ZIP_TAIL_SIZE, _zip_indexes, read_archive_member
+from dmpy.dmpy import stream_text_from_specific_archive_file
+from dmpy.mock_server import synthetic_archive
+
+TAR_NAME = 'P1-AX6P1-20230522-20230522.tar.gz'
+
+
+@pytest.fixture
+def tar_file(server):
+    content = synthetic_archive(random.Random(0), 'tar.gz', 3, 30000)
+    file_id = server.add_file(STUDY_ID, TAR_NAME, content, 'P1', 'AX6P1', 1684713600, 1684799999)
+    return file_id, server.studies[STUDY_ID]['files'][-1]['hash']
+
+
+@pytest.fixture
+def no_file_cache(monkeypatch):
+    monkeypatch.setenv('DMP_CACHE_SIZE', '0')
+
+
+def test_tar_gz_is_verified_against_its_hash(conn, tar_file, no_file_cache):
+    file_id, file_hash = tar_file
+    assert archive_preview(file_id, TAR_NAME, file_hash, conn=conn) == [f'export_{m}.csv' for m in range(3)]
+    members = dict(stream_data_from_archive(file_id, TAR_NAME, 'binary', file_hash, conn=conn))
+    assert sorted(members) == [f'export_{m}.csv' for m in range(3)]
+
+
+def test_tar_gz_with_wrong_hash_raises(conn, tar_file, no_file_cache):
+    file_id, _ = tar_file
+    with pytest.raises(Exception, match='Hash mismatch'):
+        archive_preview(file_id, TAR_NAME, '0' * 64, conn=conn)
+    with pytest.raises(Exception, match='Hash mismatch'):
+        list(stream_data_from_archive(file_id, TAR_NAME, 'binary', '0' * 64, conn=conn))
+
+
+def test_tar_gz_is_downloaded_once_into_the_cache(server, conn, tar_file, dmpy_home):
+    file_id, file_hash = tar_file
+    archive_preview(file_id, TAR_NAME, file_hash, conn=conn)
+    list(stream_data_from_archive(file_id, TAR_NAME, 'text', file_hash, conn=conn))
+    assert stream_text_from_specific_archive_file(file_id, TAR_NAME, 'export_1.csv', file_hash, conn=conn)
+    assert server.stats['requests'] == 1
+    assert os.listdir(dmpy_home / 'cache') != []
+
+
+def test_zip_member_is_range_read_through_the_central_directory(server, conn, dmpy_home):
+    rng = random.Random(0)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+        for m in range(4):
+            zf.writestr(f'export_{m}.bin', rng.randbytes(500000))
+    content = buffer.getvalue()
+    file_id = server.add_file(STUDY_ID, 'P1-AX6P1-20230522-20230522.zip', content, 'P1', 'AX6P1',
+                              1684713600, 1684799999)
+    file_hash = server.studies[STUDY_ID]['files'][-1]['hash']
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        member = zf.getinfo('export_1.bin')
+        expected = zf.read(member)
+    events = []
+    conn.add_hook(events.append)
+
+    def read_member():
+        events.clear()
+        data = read_archive_member(conn, file_id, 'P1-AX6P1-20230522-20230522.zip', 'export_1.bin', file_hash)
+        assert data == expected
+        assert {event['kind'] for event in events} == {'range'}
+        return len(events), sum(event['response_bytes'] for event in events)
+
+    requests, received = read_member()
+    member_bytes = member.compress_size + 30 + len(member.filename)
+    assert received <= ZIP_TAIL_SIZE + member_bytes + RANGE_BLOCK_SIZE
+    assert received < len(content) / 2
+    assert os.path.exists(dmpy_home / 'cache' / f'zipindex.{file_hash}')
+
+    # a new process only has the index in the file cache
+    _zip_indexes.clear()
+    cached_requests, cached_received = read_member()
+    assert cached_requests == requests - 1
+    assert cached_received <= member_bytes + RANGE_BLOCK_SIZE
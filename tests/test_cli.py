@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import STUDY_ID
+from dmpy.catalog import FileCatalog
+from dmpy.cli import _file_records
+
+FILTERS = [
+    dict(participants=None, kinds=None, devices=None),
+    dict(participants=['P1', 'P3'], kinds=None, devices=None),
+    dict(participants=None, kinds=['AX6'], devices=['AX6P2', 'MMMP1']),
+    dict(participants=[], kinds=None, devices=None),
+    dict(participants=None, kinds=None, devices=[]),
+    dict(participants=['nobody'], kinds=None, devices=None),
+]
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_ls_records_match_list_files(server, conn, filters):
+    server.add_study('empty')
+    for participant, device in [('P1', 'AX6P1'), ('P1', 'MMMP1'), ('P2', 'AX6P2'), ('P3', 'BTFP3')]:
+        server.add_file(STUDY_ID, f'{participant}-{device}-20230522-20230522.txt', b'content', participant, device,
+                        1684713600, 1684799999)
+    for study_id in (STUDY_ID, 'empty'):
+        files = conn.graphql_request('files', {'studyId': study_id})['data']['getStudy']['files']
+        assert _file_records(files, **filters) == FileCatalog.from_files(files).filter(**filters).to_records()
@@ -0,0 +1,73 @@
+import pytest
+
+from conftest import STUDY_ID
+
+
+def test_graphql_post_is_retried_on_gateway_errors(server, conn):
+    server.fail_statuses = [503, 502]
+    events = []
+    conn.add_hook(events.append)
+    body = conn.graphql_request('files', {'studyId': STUDY_ID})
+    assert body['data']['getStudy']['files'] == []
+    assert server.stats['requests'] == 3
+    assert events[-1]['retries'] == 2
+
+
+def test_download_is_retried_on_gateway_errors(server, conn):
+    file_id = server.add_file(STUDY_ID, 'P1-AX6P1-20230522-20230522.txt', b'content', 'P1', 'AX6P1',
+                              1684713600, 1684799999)
+    server.fail_statuses = [504]
+    assert conn.get_file(file_id) == b'content'
+    assert server.stats['requests'] == 2
+
+
+def test_mutations_are_not_resent_on_gateway_errors(server, conn):
+    server.fail_statuses = [504]
+    data = [{'subjectId': 'S1', 'visitId': '1', 'fieldId': 'AGE', 'value': '40'}]
+    with pytest.raises(Exception, match='Failed to query upload_data_in_array'):
+        conn.graphql_request('upload_data_in_array', {'studyId': STUDY_ID, 'data': data})
+    assert server.stats['requests'] == 1
+    assert server.studies[STUDY_ID]['records'] == {}
+
+
+def test_uploads_are_not_resent_on_gateway_errors(server, conn):
+    server.fail_statuses = [502]
+    description = '{"participantId": "P1", "deviceId": "AX6P1", "startDate": 0, "endDate": 0}'
+    with pytest.raises(Exception, match='502'):
+        conn.upload_file('P1-AX6P1-20230522-20230522.txt', b'content',
+                         {'studyId': STUDY_ID, 'file': None, 'description': description})
+    assert server.stats['requests'] == 1
+    assert server.studies[STUDY_ID]['files'] == []
+
+
+def _batch(conn):
+    with conn.batch() as batch:
+        fields = batch.add('study_fields', {'studyId': STUDY_ID})
+        files = batch.add('files', {'studyId': STUDY_ID})
+    return fields.result(), files.result()
+
+
+def test_batch_runs_in_one_request(server, conn):
+    fields, files = _batch(conn)
+    assert fields['data']['getStudyFields'] == []
+    assert files['data']['getStudy']['files'] == []
+    assert server.stats['requests'] == 1
+
+
+def test_batch_falls_back_when_the_server_rejects_batches(server, conn):
+    server.batching = False
+    fields, files = _batch(conn)
+    assert files['data']['getStudy']['files'] == []
+    assert server.stats['requests'] == 3
+    _batch(conn)
+    assert server.stats['requests'] == 5
+
+
+def test_batch_raises_on_server_errors_without_resending(server, conn):
+    server.fail_statuses = [500]
+    with pytest.raises(Exception, match='Failed to run batch'):
+        _batch(conn)
+    assert server.operations == []
+    _batch(conn)
+    assert server.stats['requests'] == 2
+    assert server.operations == ['getStudyFields', 'getStudy']
@@ -0,0 +1,140 @@
+import itertools
+import os
+
+import pytest
+
+from conftest import STUDY_ID
+from dmpy import (download_file, download_files, get_default_cache, get_file_content, iter_file_content, list_files,
+                  upload_files)
+from dmpy.catalog import FILE_COLUMNS, FileCatalog
+
+CONTENT = 'timestamp,value\r\n1,é\r\n2,è\r'.encode('utf-8')
+
+
+@pytest.fixture
+def text_file(server):
+    return server.add_file(STUDY_ID, 'P1-AX6P1-20230522-20230522.txt', CONTENT, 'P1', 'AX6P1',
+                           1684713600, 1684799999)
+
+
+def test_cached_text_keeps_line_endings(conn, text_file):
+    miss = get_file_content(text_file, decode='utf-8', conn=conn)
+    hit = get_file_content(text_file, decode='utf-8', conn=conn)
+    uncached = get_file_content(text_file, decode='utf-8', use_cache=False, conn=conn)
+    assert miss == hit == uncached == CONTENT.decode('utf-8')
+    assert get_file_content(text_file, conn=conn) == CONTENT
+
+
+def test_upload_files_reports_unreadable_files(server, conn, tmp_path):
+    path = tmp_path / 'P1-AX6P1-20230522-20230522.txt'
+    path.write_bytes(CONTENT)
+    upload = {'participantId': 'P1', 'deviceId': 'AX6P1', 'startDate': 1684713600, 'endDate': 1684799999}
+    uploads = [dict(upload, path=str(path)), dict(upload, path=str(tmp_path / 'missing.txt'))]
+    manifest = upload_files(STUDY_ID, uploads, verbose=False, conn=conn)
+    assert [entry['fileName'] for entry in manifest['uploaded']] == [path.name]
+    assert [entry['fileName'] for entry in manifest['failed']] == ['missing.txt']
+    assert 'No such file' in manifest['failed'][0]['error']
+    again = upload_files(STUDY_ID, uploads[:1], verbose=False, conn=conn)
+    assert again['skipped'][0]['fileId'] == manifest['uploaded'][0]['fileId']
+
+
+def _evict_after_lookup(cache, monkeypatch, method):
+    original = getattr(cache, method)
+    evicted = []
+
+    def lookup(*args):
+        path = original(*args)
+        if path is not None and not evicted:
+            # another process evicts the entry between the lookup and the open
+            os.remove(path)
+            evicted.append(path)
+        return path
+    monkeypatch.setattr(cache, method, lookup)
+    return evicted
+
+
+def test_entries_evicted_before_open_are_fetched_again(server, conn, text_file, monkeypatch):
+    cache = get_default_cache()
+    get_file_content(text_file, conn=conn)
+    evicted = _evict_after_lookup(cache, monkeypatch, 'fetch_file')
+    assert get_file_content(text_file, conn=conn) == CONTENT
+    assert evicted and server.stats['requests'] == 2
+
+
+def test_entries_evicted_before_open_are_cache_misses(server, conn, text_file, monkeypatch, tmp_path):
+    cache = get_default_cache()
+    get_file_content(text_file, conn=conn)
+    _evict_after_lookup(cache, monkeypatch, 'lookup_file')
+    assert b''.join(iter_file_content(text_file, conn=conn)) == CONTENT
+    monkeypatch.undo()
+    get_file_content(text_file, conn=conn)
+    _evict_after_lookup(cache, monkeypatch, 'lookup_file')
+    download_file(text_file, str(tmp_path / 'copy'), conn=conn)
+    assert (tmp_path / 'copy').read_bytes() == CONTENT
+
+
+def test_pinned_files_survive_eviction(conn, text_file):
+    cache = get_default_cache()
+    with cache.pinned_file(conn, text_file) as path:
+        cache.max_bytes = 0
+        cache.evict()
+        assert cache.lookup_file(text_file) is None
+        with open(path, 'rb') as f:
+            assert f.read() == CONTENT
+    assert not os.path.exists(path)
+
+
+def test_download_files_keeps_files_with_the_same_name_apart(server, conn, tmp_path):
+    first = server.add_file(STUDY_ID, 'export.txt', b'first', 'P1', 'AX6P1', 1684713600, 1684799999)
+    second = server.add_file(STUDY_ID, 'export.txt', b'second', 'P2', 'AX6P2', 1684713600, 1684799999)
+    other = server.add_file(STUDY_ID, 'other.txt', b'other', 'P1', 'AX6P1', 1684713600, 1684799999)
+    manifest = download_files(list_files(STUDY_ID, conn=conn), str(tmp_path), verbose=False, conn=conn)
+    assert len(manifest['succeeded']) == 3
+    assert (tmp_path / f'{first}_export.txt').read_bytes() == b'first'
+    assert (tmp_path / f'{second}_export.txt').read_bytes() == b'second'
+    assert (tmp_path / 'other.txt').read_bytes() == b'other'
+    assert not (tmp_path / 'export.txt').exists()
+
+
+# (participantId, deviceId, stampStart, stampEnd): nested intervals, intervals touching each other
+# and open-ended stamps
+INTERVALS = [('P1', 'AX6P1', 0, 100), ('P1', 'AX6P1', 10, 20), ('P1', 'AX6P1', 30, 40), ('P1', 'MMMP1', 50, 200),
+             ('P1', 'MMMP1', 60, 70), ('P2', 'AX6P2', 0, 10), ('P2', 'AX6P2', 10, 20), ('P2', 'AX6P2', 20, 20),
+             ('P2', 'MMMP2', None, 50), ('P2', 'MMMP2', 10, None), ('P1', 'AX6P1', None, None)]
+BOUNDS = [-1, 0, 5, 10, 15, 20, 30, 40, 45, 50, 70, 100, 200, 250]
+SELECTIONS = [dict(), dict(participants=['P1']), dict(participants=['P2', 'P3'], kinds=['AX6']),
+              dict(devices=['MMMP1', 'AX6P2']), dict(kinds=['MMM']), dict(participants=['P1'], devices=['MMMP1'])]
+
+
+def _catalog(intervals):
+    columns = {column: [None] * len(intervals) for column in FILE_COLUMNS}
+    columns['fileId'] = [f'file{n}' for n in range(len(intervals))]
+    columns['fileSize'] = [0] * len(intervals)
+    columns['participantId'] = [participant for participant, _, _, _ in intervals]
+    columns['deviceId'] = [device for _, device, _, _ in intervals]
+    columns['stampStart'] = [start for _, _, start, _ in intervals]
+    columns['stampEnd'] = [end for _, _, _, end in intervals]
+    return FileCatalog.from_columns(columns)
+
+
+def _brute_force(intervals, start, end, participants=None, kinds=None, devices=None):
+    return [f'file{n}' for n, (participant, device, file_start, file_end) in enumerate(intervals)
+            if file_start is not None and file_end is not None and file_start <= end and file_end >= start
+            and (participants is None or participant in participants)
+            and (kinds is None or device[0:3] in kinds) and (devices is None or device in devices)]
+
+
+@pytest.mark.parametrize('selection', SELECTIONS)
+def test_overlapping_files_match_a_brute_force_filter(selection):
+    catalog = _catalog(INTERVALS)
+    for start, end in itertools.combinations_with_replacement(BOUNDS, 2):
+        found = [record['fileId'] for record in catalog.overlapping(start, end, **selection).to_records()]
+        assert found == _brute_force(INTERVALS, start, end, **selection), (start, end)
+
+
+def test_overlapping_in_an_empty_catalog():
+    catalog = _catalog([])
+    for selection in SELECTIONS:
+        assert catalog.overlapping(0, 100, **selection).to_records() == []
+    all_files, by_participant = catalog.intervals()
+    assert len(all_files[1]) == 0 and by_participant == {}
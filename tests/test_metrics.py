@@ -0,0 +1,19 @@
+from conftest import STUDY_ID
+from dmpy import MetricsAggregator, get_file_content, upload_data
+
+
+def test_file_requests_share_one_series_per_kind(server, conn):
+    metrics = MetricsAggregator()
+    events = []
+    conn.add_hook(metrics)
+    conn.add_hook(events.append)
+    file_ids = [server.add_file(STUDY_ID, f'P{i}-AX6P{i}-20230522-20230522.txt', b'content', f'P{i}', f'AX6P{i}',
+                                1684713600, 1684799999) for i in range(3)]
+    for file_id in file_ids:
+        get_file_content(file_id, use_cache=False, conn=conn)
+    upload_data(STUDY_ID, 'P9-AX6P9-20230522-20230522.txt', b'content', 'P9', 'AX6P9', 1684713600, 1684799999,
+                conn=conn)
+    assert {(row['kind'], row['operation'], row['requests']) for row in metrics.summary()} == \
+        {('file', 'file', 3), ('upload', 'upload', 1)}
+    assert [event['target'] for event in events] == file_ids + ['P9-AX6P9-20230522-20230522.txt']
+    assert file_ids[0] not in metrics.prometheus()
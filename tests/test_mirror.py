@@ -0,0 +1,26 @@
+from conftest import STUDY_ID
+from dmpy import FileMirror
+
+
+def _add_file(server, participant):
+    return server.add_file(STUDY_ID, f'{participant}-AX6{participant}-20230522-20230522.txt', b'content',
+                           participant, f'AX6{participant}', 1684713600, 1684799999)
+
+
+def test_refresh_fetches_the_listing_only_when_files_were_added(server, conn):
+    events = []
+    conn.add_hook(events.append)
+    mirror = FileMirror(STUDY_ID)
+    first = _add_file(server, 'P1')
+    assert mirror.refresh(conn) == {"added": 1, "removed": 0}
+    assert [event['operation'] for event in events] == ['file_ids', 'files']
+
+    events.clear()
+    assert mirror.refresh(conn) == {"added": 0, "removed": 0}
+    assert [event['operation'] for event in events] == ['file_ids']
+
+    second = _add_file(server, 'P2')
+    server.studies[STUDY_ID]['files'] = [f for f in server.studies[STUDY_ID]['files'] if f['id'] != first]
+    assert mirror.refresh(conn) == {"added": 1, "removed": 1}
+    assert [record['fileId'] for record in mirror.list_files()] == [second]
+    assert mirror.list_files(participants=['P2'])[0]['deviceId'] == 'AX6P2'
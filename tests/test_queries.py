@@ -0,0 +1,40 @@
+from conftest import STUDY_ID
+from dmpy import get_data_records, iter_data_records, iter_files, list_files, upload_data_in_array
+
+
+def _add_files(server, count):
+    for i in range(count):
+        server.add_file(STUDY_ID, f'P{i}-AX6P{i}-20230522-20230522.txt', b'content', f'P{i}', f'AX6P{i}',
+                        1684713600, 1684799999)
+
+
+def test_persisted_queries_send_the_text_once(server):
+    _add_files(server, 2)
+    with server.connection(persisted_queries=True) as conn:
+        assert len(list_files(STUDY_ID, conn=conn)) == 2
+        assert len(server.stored_queries) == 1
+        requests = server.stats['requests']
+        bytes_received = server.stats['bytes_received']
+        assert len(list_files(STUDY_ID, conn=conn)) == 2
+        assert server.stats['requests'] == requests + 1
+        assert server.stats['bytes_received'] - bytes_received < bytes_received / 2
+
+
+def test_persisted_queries_fall_back_when_unsupported(server):
+    _add_files(server, 1)
+    server.persisted_queries = False
+    with server.connection(persisted_queries=True) as conn:
+        assert len(list_files(STUDY_ID, conn=conn)) == 1
+        assert len(list_files(STUDY_ID, conn=conn)) == 1
+    assert server.stats['requests'] == 3
+    assert server.stored_queries == {}
+
+
+def test_streamed_listings_match_the_full_responses(server, conn):
+    _add_files(server, 25)
+    upload_data_in_array(STUDY_ID, [{'subjectId': f'S{i}', 'visitId': '1', 'fieldId': 'AGE', 'value': str(i)}
+                                    for i in range(10)], conn=conn)
+    assert list(iter_files(STUDY_ID, chunk_size=7, conn=conn)) == list_files(STUDY_ID, conn=conn)
+    assert list(iter_files(STUDY_ID, participants=['P3'], conn=conn)) == list_files(STUDY_ID, participants=['P3'],
+                                                                                    conn=conn)
+    assert dict(iter_data_records(STUDY_ID, conn=conn)) == get_data_records(STUDY_ID, use_cache=False, conn=conn)
@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+from conftest import STUDY_ID
+from dmpy import (create_new_field, get_data_records, get_data_records_df, upload_data_in_array,
+                  upload_data_in_array_chunked)
+from dmpy.record_cache import LATEST_VERSIONS, RecordCache
+from dmpy.utils import data_records_variables
+
+
+@pytest.fixture
+def records(server, conn):
+    create_new_field(STUDY_ID, 'AGE', 'Age', 'int', conn=conn)
+    create_new_field(STUDY_ID, 'WEIGHT', 'Weight', 'dec', conn=conn)
+    create_new_field(STUDY_ID, 'SEX', 'Sex', 'cat', possible_values=[{'code': 'F'}, {'code': 'M'}], conn=conn)
+    upload_data_in_array(STUDY_ID, [
+        {'subjectId': 'S1', 'visitId': '1', 'fieldId': 'AGE', 'value': '40'},
+        {'subjectId': 'S1', 'visitId': '1', 'fieldId': 'WEIGHT', 'value': '71.5'},
+        {'subjectId': 'S2', 'visitId': '1', 'fieldId': 'SEX', 'value': 'M'},
+    ], conn=conn)
+
+
+def test_records_are_decoded_into_typed_columns(conn, records):
+    frame = get_data_records_df(STUDY_ID, conn=conn).set_index('subjectId')
+    assert str(frame['AGE'].dtype) == 'Int64'
+    assert frame.loc['S1', 'AGE'] == 40 and pd.isna(frame.loc['S2', 'AGE'])
+    assert frame['WEIGHT'].dtype == 'float64'
+    assert list(frame['SEX'].cat.categories) == ['F', 'M']
+    long = get_data_records(STUDY_ID, as_dataframe=True, layout='long', conn=conn)
+    assert len(long) == 3
+
+
+def test_as_dataframe_rejects_table_formats(conn, records):
+    with pytest.raises(Exception, match='only decodes raw records'):
+        get_data_records(STUDY_ID, data_format='standardized-cdisc:adam:adcl', as_dataframe=True, conn=conn)
+    with pytest.raises(Exception, match='only decodes raw records'):
+        get_data_records(STUDY_ID, table_requested='ADCL', as_dataframe=True, conn=conn)
+
+
+@pytest.mark.parametrize('version_id', [None, '', '0', '-1', 'a1b2c3'])
+def test_pinned_record_cache_keys_match_the_version_sent(tmp_path, version_id):
+    key = RecordCache(str(tmp_path)).key('host', STUDY_ID, ['AGE'], version_id=version_id)
+    variables = data_records_variables(STUDY_ID, ['AGE'], version_id=version_id)
+    sent = variables.get('versionId', '0')
+    assert ('.pinned.' in key) == (sent not in LATEST_VERSIONS)
+    if '.pinned.' in key:
+        assert sent == version_id
+
+
+def test_chunked_upload_retries_only_the_failed_chunk(server, conn, monkeypatch):
+    create_new_field(STUDY_ID, 'AGE', 'Age', 'int', conn=conn)
+    data = [{'subjectId': f'S{n}', 'visitId': '1', 'fieldId': 'AGE', 'value': str(40 + n)} for n in range(6)]
+    sent = []
+    graphql_request = conn.graphql_request
+
+    def record(name, variables):
+        if name == 'upload_data_in_array':
+            sent.append([clip['subjectId'] for clip in variables['data']])
+        return graphql_request(name, variables)
+
+    monkeypatch.setattr(conn, 'graphql_request', record)
+    started = server.stats['requests']
+    server.fail_statuses = [500]
+    report = upload_data_in_array_chunked(STUDY_ID, data, chunk_size=2, max_workers=1, backoff_factor=0,
+                                          verbose=False, conn=conn)
+    assert (report['succeeded'], report['failed'], report['attempts'], report['requests']) == (6, [], 2, 4)
+    assert server.stats['requests'] - started == 4
+    assert sent == [['S0', 'S1'], ['S2', 'S3'], ['S4', 'S5'], ['S0', 'S1']]
+    assert get_data_records(STUDY_ID, conn=conn) == {f'S{n}': {'1': {'AGE': str(40 + n)}} for n in range(6)}